@@ -0,0 +1,134 @@
+'''
+Adaptive batch sizing for multi-row inserts
+
+A multi-row INSERT binds one parameter per column per row, so a batch can
+hold at most the connection's bound-parameter limit divided by the
+column count. Below that cap the best size depends on the machine, so an
+AdaptiveBatcher times every batch and keeps moving its size in whichever
+direction raised rows per second, turning back when throughput drops.
+
+batcher_for() keeps one batcher per database, table and column count, so
+what is learned carries over from one chunk and one load to the next.
+'''
+import sqlite3
+import threading
+import time
+import weakref
+
+# Used when the sqlite3 module cannot report the connection's limit
+DEFAULT_LIMIT = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+INITIAL_ROWS = 500
+MINIMUM_ROWS = 16
+STEP = 1.5
+# Throughput must fall by more than this fraction to reverse direction
+TOLERANCE = 0.05
+
+_batchers = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def variable_limit(database):
+    '''
+    Returns the most parameters one statement may bind on database
+    '''
+    try:
+        return database.connection().getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    except AttributeError:
+        return DEFAULT_LIMIT
+
+
+def max_rows(database, columns):
+    '''
+    Returns the most rows of columns values one statement can insert
+    '''
+    return max(1, variable_limit(database) // max(1, columns))
+
+
+class AdaptiveBatcher:
+    '''
+    Chooses insert batch sizes from measured rows per second
+
+    Sizes stay between minimum and max_rows. Safe to share between the
+    threads writing one database.
+    '''
+    def __init__(self, max_rows_, size=INITIAL_ROWS, minimum=MINIMUM_ROWS):
+        self.max_rows = max_rows_
+        self.minimum = min(minimum, max_rows_)
+        self.size = max(self.minimum, min(size, max_rows_))
+        self.rate = None
+        self._grow = True
+        self._lock = threading.Lock()
+
+    def limit(self, max_rows_):
+        '''
+        Applies a new row cap, e.g. after reconnecting with another limit
+        '''
+        with self._lock:
+            self.max_rows = max_rows_
+            self.minimum = min(self.minimum, max_rows_)
+            self.size = min(self.size, max_rows_)
+
+    def record(self, rows, seconds):
+        '''
+        Adjusts the batch size after rows were written in seconds
+
+        Batches smaller than the current size (the tail of a load) are
+        ignored since they say little about the size being tried.
+        '''
+        with self._lock:
+            if rows < self.size:
+                return
+            rate = rows / max(seconds, 1e-9)
+            if self.rate is not None and rate < self.rate * (1 - TOLERANCE):
+                self._grow = not self._grow
+            self.rate = rate
+            size = self.size * STEP if self._grow else self.size / STEP
+            self.size = int(max(self.minimum, min(self.max_rows, round(size))))
+
+    def run(self, rows, write):
+        '''
+        Calls write(batch) on successive batches of rows, timing each
+
+        Returns the number of batches written.
+        '''
+        start, batches = 0, 0
+        while start < len(rows):
+            batch = rows[start:start + self.size]
+            began = time.perf_counter()
+            write(batch)
+            self.record(len(batch), time.perf_counter() - began)
+            start += len(batch)
+            batches += 1
+        return batches
+
+
+def batcher_for(database, table, columns):
+    '''
+    Returns the shared AdaptiveBatcher for inserting columns values per
+    row into table on database
+    '''
+    limit = max_rows(database, columns)
+    with _lock:
+        batchers = _batchers.setdefault(database, {})
+        key = (table, columns)
+        if key not in batchers:
+            batchers[key] = AdaptiveBatcher(limit)
+        batcher = batchers[key]
+    batcher.limit(limit)
+    return batcher
+
+
+def insert_rows(model, rows, database):
+    '''
+    Inserts rows (dicts with the same keys) into model with adaptively
+    sized multi-row INSERTs
+
+    Returns the number of statements executed.
+    '''
+    if not rows:
+        return 0
+    meta = model._meta  # pylint: disable=W0212
+    # peewee also binds fields left to their defaults, so count every field
+    columns = max(len(rows[0]), len(meta.sorted_fields))
+    batcher = batcher_for(database, meta.table_name, columns)
+    return batcher.run(rows, lambda batch: model.insert_many(batch).execute(database))
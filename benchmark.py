@@ -0,0 +1,278 @@
+'''
+Benchmarks for the social network storage options
+
+Usage:
+    python benchmark.py keys [--users N] [--statuses N] [--lookups N]
+    python benchmark.py compression [--users N] [--statuses N] [--samples N]
+    python benchmark.py load [--users N] [--statuses N] [--budgets none,16M,1M]
+
+Each benchmark builds throw-away databases in a temporary directory from
+synthetic data and prints its measurements.
+'''
+import os
+import csv
+import time
+import random
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import peewee as pw
+import main as sn
+import memory
+import loader
+import snapshots
+import socialnetwork_model as sm
+
+TEXT_MODELS = [sm.TextUsers, sm.TextStatus]
+COMPACT_MODELS = [sm.CompactUsers, sm.CompactStatus]
+WORDS = ('the a my our this today morning weekend coffee code weather hike seattle '
+         'finally really just got new great love going time back home work team '
+         'project game friends dinner sunny rain park run with for and at in on '
+         'is was so very happy tired excited to of from after before').split()
+
+
+def synthetic_users(count):
+    '''
+    Returns count user rows shaped like accounts.csv
+    '''
+    return [{'user_id': f'Someone.Person{i}',
+             'user_name': 'Someone',
+             'user_last_name': 'Person',
+             'user_email': f'someone.person{i}@goodmail.com'} for i in range(count)]
+
+
+def synthetic_statuses(user_rows, count):
+    '''
+    Returns count status rows spread across user_rows
+    '''
+    rng = random.Random(0)
+    rows = []
+    for i in range(count):
+        user_id = user_rows[i % len(user_rows)]['user_id']
+        words = rng.choices(WORDS, k=rng.randint(4, 20))
+        rows.append({'status_id': f'{user_id}_{i:05d}',
+                     'user_id': user_id,
+                     'status_text': ' '.join(words).capitalize() + '!'})
+    return rows
+
+
+def build_text_database(path, user_rows, status_rows):
+    '''
+    Creates a text key database at path and fills it with the given rows
+    '''
+    database = pw.SqliteDatabase(path, pragmas={'foreign_keys': 1})
+    with database.bind_ctx(TEXT_MODELS):
+        database.create_tables(TEXT_MODELS)
+        with database.atomic():
+            for i in range(0, len(user_rows), 5000):
+                sm.TextUsers.insert_many(user_rows[i:i+5000]).execute(database)
+            for i in range(0, len(status_rows), 5000):
+                sm.TextStatus.insert_many(status_rows[i:i+5000]).execute(database)
+    database.close()
+
+
+def sample_ids(user_rows, status_rows, count):
+    '''
+    Picks a repeatable random sample of status_ids and user_ids to look up
+    '''
+    rng = random.Random(0)
+    status_ids = [row['status_id'] for row in rng.sample(status_rows, count)]
+    user_ids = [row['user_id'] for row in rng.sample(user_rows, min(count, len(user_rows)))]
+    return status_ids, user_ids
+
+
+def time_lookups(path, models, status_ids, user_ids):
+    '''
+    Times status lookups by status_id and per-user status counts
+
+    Returns (seconds per status lookup, seconds per user count).
+    '''
+    users, status = models
+    database = pw.SqliteDatabase(path)
+    with database.bind_ctx(models):
+        start = time.perf_counter()
+        for status_id in status_ids:
+            status.get(status.status_id == status_id)
+        per_status = (time.perf_counter() - start) / len(status_ids)
+        start = time.perf_counter()
+        for user_id in user_ids:
+            (status.select()
+             .join(users)
+             .where(users.user_id == user_id)
+             .count())
+        per_user = (time.perf_counter() - start) / len(user_ids)
+    database.close()
+    return per_status, per_user
+
+
+def benchmark_keys(args):
+    '''
+    Compares file size and lookup speed of text and compact key schemas
+    '''
+    user_rows = synthetic_users(args.users)
+    status_rows = synthetic_statuses(user_rows, args.statuses)
+    status_ids, user_ids = sample_ids(user_rows, status_rows, args.lookups)
+    with tempfile.TemporaryDirectory() as tmp:
+        text_path = os.path.join(tmp, 'text.db')
+        compact_path = os.path.join(tmp, 'compact.db')
+        build_text_database(text_path, user_rows, status_rows)
+        start = time.perf_counter()
+        snapshots.migrate_to_compact_keys(text_path, compact_path)
+        migrate_time = time.perf_counter() - start
+        print(f'{args.users} users, {args.statuses} statuses, '
+              f'migration took {migrate_time:.2f}s')
+        print(f'{"schema":<10}{"size (KiB)":>12}{"status get (us)":>18}'
+              f'{"user count (us)":>18}')
+        for name, path, models in [('text', text_path, TEXT_MODELS),
+                                   ('compact', compact_path, COMPACT_MODELS)]:
+            per_status, per_user = time_lookups(path, models, status_ids, user_ids)
+            print(f'{name:<10}{os.path.getsize(path) / 1024:>12.0f}'
+                  f'{per_status * 1e6:>18.1f}{per_user * 1e6:>18.1f}')
+
+
+def time_codec(field, texts):
+    '''
+    Times field's encoding and decoding of texts
+
+    Returns (seconds per encode, seconds per decode).
+    '''
+    start = time.perf_counter()
+    stored = [field.db_value(text) for text in texts]
+    per_encode = (time.perf_counter() - start) / len(texts)
+    start = time.perf_counter()
+    for value in stored:
+        field.python_value(value)
+    per_decode = (time.perf_counter() - start) / len(texts)
+    return per_encode, per_decode
+
+
+def benchmark_compression(args):
+    '''
+    Compares file size and encode/decode cost of plain, zlib and
+    dictionary compressed status_text
+    '''
+    user_rows = synthetic_users(args.users)
+    status_rows = synthetic_statuses(user_rows, args.statuses)
+    texts = [row['status_text'] for row in status_rows]
+    field = sm.TextStatus.status_text
+    compress, dictionary = field.compress, field.dictionary
+    trained = sm.train_dictionary(random.Random(0).sample(texts, min(args.samples, len(texts))))
+    print(f'{args.statuses} statuses, {len(trained)} byte dictionary from '
+          f'{args.samples} samples')
+    print(f'{"storage":<12}{"size (KiB)":>12}{"encode (us)":>14}{"decode (us)":>14}')
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, enabled, data in [('plain', False, None),
+                                        ('zlib', True, None),
+                                        ('zlib+dict', True, trained)]:
+                field.compress = enabled
+                field.use_dictionary(data)
+                path = os.path.join(tmp, f'{name}.db')
+                build_text_database(path, user_rows, status_rows)
+                per_encode, per_decode = time_codec(field, texts)
+                print(f'{name:<12}{os.path.getsize(path) / 1024:>12.0f}'
+                      f'{per_encode * 1e6:>14.1f}{per_decode * 1e6:>14.1f}')
+    finally:
+        field.compress = compress
+        field.use_dictionary(dictionary)
+
+
+def write_csv(path, columns, rows):
+    '''
+    Writes rows to a CSV file; columns maps each header to a row key
+    '''
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        writer.writerows([row[key] for key in columns.values()] for row in rows)
+
+
+def time_load(tmp, mode, budget, users_csv, statuses_csv):
+    '''
+    Loads users and then statuses into a new database in tmp
+
+    Runs in a fresh process so its peak RSS belongs to this load. Returns
+    (seconds, tracker report) for the status load.
+    '''
+    path = os.path.join(tmp, f'{mode}_{budget}.db')
+    database = pw.SqliteDatabase(path, pragmas=sm.PRAGMAS)
+    sm.create_tables(sm.MODELS, database)
+    sn.load_users(users_csv, sn.init_user_collection(db=database))
+    status_collection = sn.init_status_collection(db=database)
+    tracker = memory.MemoryTracker(budget)
+    start = time.perf_counter()
+    if mode == 'strict':
+        loader.load_collection_strict(statuses_csv, loader.status_keys(), status_collection,
+                                      tracker=tracker)
+    else:
+        loader.load_collection_tolerant(statuses_csv, loader.status_keys(), status_collection,
+                                        os.path.join(tmp, 'rejects.csv'), tracker=tracker)
+    seconds = time.perf_counter() - start
+    database.close()
+    return seconds, tracker.report()
+
+
+def benchmark_load(args):
+    '''
+    Compares speed and memory of status loads under memory budgets
+    '''
+    user_rows = synthetic_users(args.users)
+    status_rows = synthetic_statuses(user_rows, args.statuses)
+    mib = 1 << 20
+    with tempfile.TemporaryDirectory() as tmp:
+        users_csv = os.path.join(tmp, 'users.csv')
+        statuses_csv = os.path.join(tmp, 'statuses.csv')
+        write_csv(users_csv, {'USER_ID': 'user_id', 'EMAIL': 'user_email',
+                              'NAME': 'user_name', 'LASTNAME': 'user_last_name'}, user_rows)
+        write_csv(statuses_csv, {'STATUS_ID': 'status_id', 'USER_ID': 'user_id',
+                                 'STATUS_TEXT': 'status_text'}, status_rows)
+        print(f'{args.statuses} statuses ({os.path.getsize(statuses_csv) / mib:.1f} MiB csv)')
+        print(f'{"mode":<10}{"budget":>10}{"rows/s":>10}{"peak rows":>11}'
+              f'{"buffered (MiB)":>16}{"peak RSS (MiB)":>16}{"early flushes":>15}')
+        for mode in ('strict', 'tolerant'):
+            for budget in args.budgets:
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    seconds, report = pool.submit(time_load, tmp, mode, budget,
+                                                  users_csv, statuses_csv).result()
+                label = 'none' if budget is None else f'{budget / mib:g}M'
+                rss = 'n/a' if report['max_rss'] is None else f'{report["max_rss"] / mib:.0f}'
+                print(f'{mode:<10}{label:>10}{args.statuses / seconds:>10.0f}'
+                      f'{report["peak_rows"]:>11}{report["peak_bytes"] / mib:>16.1f}'
+                      f'{rss:>16}{report["early_flushes"]:>15}')
+
+
+def parse_budgets(value):
+    '''
+    Parses a comma separated list of memory budgets; none means no budget
+    '''
+    return [None if part.strip().lower() == 'none' else memory.parse_size(part)
+            for part in value.split(',')]
+
+
+def main(argv=None):
+    '''
+    Parses the command line and runs the selected benchmark
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+    keys = commands.add_parser('keys', help='text vs compact primary keys')
+    keys.add_argument('--users', type=int, default=1000)
+    keys.add_argument('--statuses', type=int, default=100000)
+    keys.add_argument('--lookups', type=int, default=2000)
+    keys.set_defaults(run=benchmark_keys)
+    compression = commands.add_parser('compression', help='plain vs compressed status_text')
+    compression.add_argument('--users', type=int, default=1000)
+    compression.add_argument('--statuses', type=int, default=100000)
+    compression.add_argument('--samples', type=int, default=2000)
+    compression.set_defaults(run=benchmark_compression)
+    load = commands.add_parser('load', help='status loads under memory budgets')
+    load.add_argument('--users', type=int, default=1000)
+    load.add_argument('--statuses', type=int, default=200000)
+    load.add_argument('--budgets', type=parse_budgets, default=[None, 16 << 20, 1 << 20])
+    load.set_defaults(run=benchmark_load)
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+'''
+Bulk load mode for large loads into empty or mostly empty tables
+
+While a database is in bulk load mode (see bulk_load) the secondary
+indexes of the tables being loaded are dropped, each load transaction
+defers its foreign key checks to the commit, and the rows of each insert
+are sorted by key. The indexes are rebuilt and the foreign keys checked
+once when the load ends.
+'''
+import time
+import logging
+import contextlib
+import socialnetwork_model as sm
+
+# Tables holding more rows than this are loaded with their indexes in
+# place; rebuilding would cost more than maintaining them (see bulk_load)
+BULK_LOAD_MAX_ROWS = 100000
+
+_bulk_loads = set()
+
+
+def secondary_indexes(model, database=None):
+    '''
+    Returns (name, sql) of the indexes on model's table that a load can
+    drop: not unique and not backing a PRIMARY KEY or UNIQUE constraint
+
+    Unique indexes stay, as they enforce keys and serve the loaders'
+    duplicate screening.
+    '''
+    database = database or sm.model_database(model)
+    rows = database.execute_sql(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+        'AND sql IS NOT NULL ORDER BY name',
+        (model._meta.table_name,)).fetchall()  # pylint: disable=W0212
+    return [(name, sql) for name, sql in rows
+            if not sql.upper().startswith('CREATE UNIQUE')]
+
+
+def has_more_rows(model, database, count):
+    '''
+    Whether model's table holds more than count rows, counting no further
+    '''
+    table = model._meta.table_name  # pylint: disable=W0212
+    return database.execute_sql(
+        f'SELECT COUNT(*) FROM (SELECT 1 FROM "{table}" LIMIT {count + 1})').fetchone()[0] > count
+
+
+def bulk_loading(database):
+    '''
+    Whether database is in bulk load mode
+    '''
+    return database in _bulk_loads
+
+
+def defer_foreign_keys(database):
+    '''
+    Defers the foreign key checks of the open transaction to its commit
+    when database is in bulk load mode
+    '''
+    if database in _bulk_loads:
+        database.execute_sql('PRAGMA defer_foreign_keys = ON')
+
+
+def in_key_order(model, rows, database):
+    '''
+    Returns loader rows sorted by model's key when database is in bulk
+    load mode
+
+    Only the rows given are sorted: a strict load passes the whole file,
+    but a tolerant or budgeted load passes one chunk at a time, so the
+    chunks themselves are only in key order if the file is.
+    '''
+    if database not in _bulk_loads:
+        return rows
+    key = sm.key_field(model).name
+    return sorted(rows, key=lambda row: row[key])
+
+
+@contextlib.contextmanager
+def bulk_load(models, database=None, max_rows=BULK_LOAD_MAX_ROWS):
+    '''
+    Bulk load mode for large loads into empty or mostly empty tables
+
+    Drops the secondary indexes of models' tables, marks database so
+    loads defer foreign key checks to each commit and sort the rows of
+    each insert by key (see in_key_order), and afterwards rebuilds the
+    indexes (each by one sort of the table) and checks the tables'
+    foreign keys in one pass. If a table already holds more than max_rows
+    rows the load runs normally.
+
+    Indexes are missing while the load runs, so queries on the tables are
+    slow meanwhile. Yields a report dict: enabled, indexes rebuilt,
+    rebuild_seconds and foreign_key_errors.
+    '''
+    database = database or sm.model_database(models[0])
+    report = {'enabled': False, 'indexes': [], 'rebuild_seconds': 0.0,
+              'foreign_key_errors': 0}
+    if database in _bulk_loads or any(has_more_rows(model, database, max_rows)
+                                      for model in models):
+        logging.info('Loading %s with its indexes in place.', database.database)
+        yield report
+        return
+    dropped = []
+    with database.atomic():
+        for model in models:
+            for name, sql in secondary_indexes(model, database):
+                database.execute_sql(f'DROP INDEX "{name}"')
+                dropped.append((name, sql))
+    logging.info('Dropped %s indexes of %s for a bulk load.', len(dropped), database.database)
+    report.update(enabled=True, indexes=[name for name, _ in dropped])
+    _bulk_loads.add(database)
+    try:
+        yield report
+    finally:
+        _bulk_loads.discard(database)
+        start = time.perf_counter()
+        with database.atomic():
+            for _, sql in dropped:
+                database.execute_sql(sql)
+        report['rebuild_seconds'] = time.perf_counter() - start
+        report['foreign_key_errors'] = check_foreign_keys(models, database)
+        logging.info('Rebuilt %s indexes of %s in %.3fs.', len(dropped),
+                     database.database, report['rebuild_seconds'])
+
+
+def check_foreign_keys(models, database=None):
+    '''
+    Runs PRAGMA foreign_key_check on models' tables; logs and returns the
+    number of rows whose parent is missing
+    '''
+    database = database or sm.model_database(models[0])
+    errors = 0
+    for model in models:
+        table = model._meta.table_name  # pylint: disable=W0212
+        for row in database.execute_sql(f'PRAGMA foreign_key_check("{table}")'):
+            logging.error('Row %s of %s has no parent in %s.', row[1], table, row[2])
+            errors += 1
+    return errors
@@ -0,0 +1,145 @@
+'''
+Base class of the user and status collections
+
+A RoutedCollection sends each operation to the database holding its
+user: the model's own database, another database given as db, or one
+shard of a sharding.ShardSet. It also carries the optional group
+committer and write scheduler shared by the collection's writes.
+'''
+import socialnetwork_model as sm
+import groupcommit
+
+
+class RoutedCollection:
+    '''
+    Base for collections that may be sharded or pointed at a database
+
+    shards is a ShardSet or None; db is a database to use instead of the
+    one the model is bound to (None keeps the model's own).
+    '''
+
+    def __init__(self, model, shards=None, db=None):
+        self.database = model
+        self.shards = shards
+        self.db = db
+        self.committer = None
+        self.scheduler = None
+
+    def db_for(self, user_id):
+        '''
+        Returns the database holding user_id; None means the model's own
+        '''
+        if self.shards is None:
+            return self.db
+        return self.shards.database_for(user_id)
+
+    def databases(self):
+        '''
+        Returns every database the collection spans
+        '''
+        if self.shards is None:
+            return [self.db or sm.model_database(self.database)]
+        return self.shards.databases
+
+    def write_db(self, database):
+        '''
+        Returns database, or the model's own database when it is None
+        '''
+        return database or sm.model_database(self.database)
+
+    def select_many(self, query, field, keys, user_id_of=lambda key: key):
+        '''
+        Runs query for rows whose field is one of keys
+
+        Keys are looked up sm.IN_BATCH at a time with IN (...), in the
+        shard user_id_of(key) routes them to; shards are read in parallel.
+        Returns the rows found as a list.
+        '''
+        def select(database, part):
+            rows = []
+            for i in range(0, len(part), sm.IN_BATCH):
+                rows.extend(query.where(field.in_(part[i:i + sm.IN_BATCH])).execute(database))
+            return rows
+
+        keys = list(keys)
+        if self.shards is None:
+            return select(self.db, keys)
+        parts = self.shards.partition(keys, user_id_of)
+        return [row for rows in self.shards.map(select, parts) for row in rows]
+
+    def changes_since(self, seq=0, limit=None, shard=0):
+        '''
+        Streams the change log of one database (see sm.changes_since)
+
+        Each shard keeps its own log and sequence numbers, so consumers of
+        a sharded collection track one seq per shard.
+        '''
+        return sm.changes_since(seq, limit, self.databases()[shard])
+
+    def start_group_commit(self, max_ops=groupcommit.MAX_OPS,
+                           max_delay=groupcommit.MAX_DELAY):
+        '''
+        Switches the collection's writes to group commit
+
+        Until stop_group_commit() the write methods return Futures that
+        resolve once their batch has committed (see groupcommit).
+        '''
+        if self.committer is None:
+            self.committer = groupcommit.GroupCommitter(
+                [self.write_db(database) for database in self.databases()],
+                max_ops, max_delay, self.scheduler)
+            self.committer.start()
+        return self.committer
+
+    def stop_group_commit(self):
+        '''
+        Commits the writes still queued and returns to one commit per write
+        '''
+        committer, self.committer = self.committer, None
+        if committer is not None:
+            committer.stop()
+
+    def use_scheduler(self, scheduler):
+        '''
+        Attaches a scheduler.WriteScheduler (None detaches it)
+
+        Loads then write in short slices and the collection's single-record
+        operations take priority between them. Collections sharing a
+        database should share the scheduler.
+        '''
+        self.scheduler = scheduler
+
+    def unload(self, rows, database):
+        '''
+        Deletes rows written by a bulk insert (dicts keyed by field name)
+        and undoes bulk_inserted
+
+        Backs out the committed slices of a scheduled all-or-nothing load
+        that failed part way.
+        '''
+        model = self.database
+        key = sm.key_field(model)
+        values = [row[key.name] for row in rows]
+        with database.atomic():
+            for i in range(0, len(values), sm.IN_BATCH):
+                model.delete().where(key.in_(values[i:i + sm.IN_BATCH])).execute(database)
+            self.bulk_removed(rows, database)
+
+    def bulk_removed(self, rows, database):
+        '''
+        Called by unload inside its transaction; collections override this
+        to undo what bulk_inserted did
+        '''
+
+    def maintain(self, force=False):
+        '''
+        Runs sm.maintain on every database; returns their reports
+        '''
+        return [sm.maintain(database, force) for database in self.databases()]
+
+    def bulk_inserted(self, rows, database):
+        '''
+        Called inside the load transaction after rows (dicts keyed by field
+        name) were inserted into database; collections override this to
+        keep derived data current
+        '''
@@ -0,0 +1,42 @@
+'''
+Shared fixtures for the unittests
+'''
+import unittest
+import peewee as pw
+import main
+import socialnetwork_model as sm
+
+test_db = pw.SqliteDatabase(':memory:')
+
+
+class ModelTestCase(unittest.TestCase):
+    '''
+    Base for tests that run against the models in an in-memory database
+
+    Each test gets fresh tables (created by sm.create_tables, so indexes
+    and change log triggers are in place) with foreign keys on, and a
+    user_collection and status_collection over them. Subclasses set
+    models to test another schema and call super().setUp() and
+    super().tearDown() around their own fixtures.
+    '''
+    models = sm.MODELS
+
+    def setUp(self):
+        '''
+        Bind the models to the in-memory database and create the tables.
+        '''
+        test_db.bind(self.models, bind_refs=False, bind_backrefs=False)
+        test_db.connect(reuse_if_open=True)
+        sm.create_tables(self.models, test_db)
+        test_db.execute_sql('PRAGMA foreign_keys = ON;')
+        self.user_collection = main.init_user_collection()
+        self.user_collection.database = self.models[0]
+        self.status_collection = main.init_status_collection()
+        self.status_collection.database = self.models[1]
+
+    def tearDown(self):
+        '''
+        Drop the tables and close the database.
+        '''
+        test_db.drop_tables(self.models)
+        test_db.close()
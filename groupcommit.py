@@ -0,0 +1,165 @@
+'''
+Group commit for single-record writes
+
+SQLite syncs the file on every commit, which caps one-row-per-transaction
+writers at a few hundred writes per second. A GroupCommitter runs queued
+writes in a background thread and commits them together: a batch is
+flushed once max_ops writes are waiting or max_delay seconds after its
+first write arrived, whichever comes first.
+
+Each write runs inside its own savepoint, so one that raises is rolled
+back alone. Its concurrent.futures.Future is resolved only after the
+batch's transaction has committed, i.e. once the write is durable.
+
+Collections opt in with start_group_commit(); their write methods (marked
+with @queued) then return Futures instead of results.
+'''
+import time
+import queue
+import logging
+import functools
+import threading
+import contextlib
+from concurrent.futures import Future
+
+MAX_OPS = 256
+MAX_DELAY = 0.005
+_STOP = object()
+
+
+class GroupCommitter(threading.Thread):
+    '''
+    Background thread committing queued writes in batches
+
+    databases are the databases the writes may touch; a transaction is
+    opened on each (SQLite only locks the ones actually written). With a
+    scheduler.WriteScheduler each flush takes one priority turn.
+    '''
+    # pylint: disable=R0902
+    def __init__(self, databases, max_ops=MAX_OPS, max_delay=MAX_DELAY, scheduler=None):
+        super().__init__(name='group-commit', daemon=True)
+        self.databases = list(databases)
+        self.scheduler = scheduler
+        self.max_ops = max_ops
+        self.max_delay = max_delay
+        self.batches = 0
+        self.writes = 0
+        self.stopping = False
+        self._queue = queue.Queue()
+        # Orders submits against stop() so nothing is queued after _STOP
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args, **kwargs):
+        '''
+        Queues function(*args, **kwargs) and returns a Future for its result
+
+        Raises RuntimeError once stop() has been called.
+        '''
+        with self._lock:
+            if self.stopping or not self.is_alive():
+                raise RuntimeError('group commit is not running')
+            future = Future()
+            self._queue.put((future, function, args, kwargs))
+        return future
+
+    def run(self):
+        last = False
+        while not last:
+            first = self._queue.get()
+            if first is _STOP:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_ops:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    last = True
+                    break
+                batch.append(item)
+            self.flush(batch)
+        self.reject_queued()
+
+    def reject_queued(self):
+        '''
+        Fails the futures of writes still queued after _STOP, so no caller
+        waits forever on a write that will never run
+        '''
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _STOP and item[0].set_running_or_notify_cancel():
+                item[0].set_exception(RuntimeError('group commit stopped'))
+
+    def flush(self, batch):
+        '''
+        Runs a batch of writes in one transaction per database, then
+        resolves their futures
+        '''
+        outcomes = []
+        try:
+            with contextlib.ExitStack() as transaction:
+                if self.scheduler is not None:
+                    # The whole batch is one priority turn (see scheduler)
+                    transaction.enter_context(self.scheduler.priority())
+                for database in self.databases:
+                    transaction.enter_context(database.atomic())
+                for future, function, args, kwargs in batch:
+                    if future.set_running_or_notify_cancel():
+                        outcomes.append((future,) + self._call(function, args, kwargs))
+        except Exception as err:  # pylint: disable=W0718
+            logging.error('Group commit of %s writes failed: %s', len(batch), err)
+            for future, _, _, _ in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        self.batches += 1
+        self.writes += len(outcomes)
+        for future, error, result in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def _call(self, function, args, kwargs):
+        '''
+        Runs one write in a savepoint; returns (exception, result)
+        '''
+        try:
+            with contextlib.ExitStack() as savepoint:
+                for database in self.databases:
+                    savepoint.enter_context(database.atomic())
+                return None, function(*args, **kwargs)
+        except Exception as err:  # pylint: disable=W0718
+            return err, None
+
+    def stop(self, timeout=None):
+        '''
+        Flushes the writes already queued and stops the thread
+        '''
+        with self._lock:
+            if not self.stopping:
+                self.stopping = True
+                self._queue.put(_STOP)
+        self.join(timeout)
+
+
+def queued(method):
+    '''
+    Marks a collection write method to go through the collection's
+    GroupCommitter when one is running
+
+    Calls made by the committer thread itself (e.g. delete_user calling
+    tombstone_user) run directly.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        committer = self.committer
+        if committer is None or threading.current_thread() is committer:
+            return method(self, *args, **kwargs)
+        return committer.submit(method, self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,55 @@
+'''
+Background jobs that maintain a collection
+
+A PeriodicJob thread repeats one round of work on a collection at a
+fixed interval; the tombstone purger (users.Purger) and status retention
+(user_status.Retention) are built on it.
+'''
+import logging
+import threading
+import peewee as pw
+
+
+class PeriodicJob(threading.Thread):
+    '''
+    Background thread that calls run_once() every interval seconds until
+    stop() is called
+
+    Subclasses implement run_once() against self.collection, deleting
+    batch_size rows per transaction and sleeping pause seconds between
+    batches, so other writers are never blocked for long. An
+    OperationalError (such as a locked database) is logged and the job
+    tried again next interval; the thread closes its connections to the
+    collection's databases when it ends.
+    '''
+
+    def __init__(self, name, collection, interval, batch_size=500, pause=0.01):
+        super().__init__(name=name, daemon=True)
+        self.collection = collection
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.stopped = threading.Event()
+
+    def run_once(self):
+        '''
+        Does one round of the job
+        '''
+        raise NotImplementedError
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.run_once()
+            except pw.OperationalError as err:
+                logging.error('%s failed, retrying later: %s', self.name, err)
+            self.stopped.wait(self.interval)
+        for database in self.collection.databases():
+            database.close()
+
+    def stop(self, timeout=None):
+        '''
+        Stops the job and waits for it to finish
+        '''
+        self.stopped.set()
+        self.join(timeout)
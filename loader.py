@@ -0,0 +1,918 @@
+'''
+Loads user and status files into the collections
+
+Single files are loaded all-or-nothing or tolerantly (bad rows go to a
+rejects file), and directories are parsed by worker processes and written
+here in file name order. main.load_users, main.load_status_updates and
+the main.load_*_dir functions are the entry points.
+'''
+import os
+import csv
+import glob
+import time
+import logging
+import contextlib
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import peewee as pw
+import memory
+import readers
+import batching
+import bulkload
+import profiler
+import validation
+import socialnetwork_model as sm
+import sharding
+
+# Rows read and validated together; a chunk ends early when the memory
+# budget is reached
+CHUNK_SIZE = 10000
+
+
+class LoadOptions:
+    '''
+    How load_collection and load_directory run
+
+    rejects is where rejected rows go: the rejects file of a tolerant file
+    load, or the directory a directory load writes its rejects files to
+    (by default they go beside each source file). memory_budget (bytes,
+    default memory.DEFAULT_BUDGET) caps the rows buffered, bulk=True loads
+    in bulk_mode and workers is how many processes parse a directory
+    (default: one per CPU, 0 parses in this process).
+    '''
+    def __init__(self, rejects=None, memory_budget=None, bulk=False, workers=None):
+        self.rejects = rejects
+        self.memory_budget = memory.DEFAULT_BUDGET if memory_budget is None else memory_budget
+        self.bulk = bulk
+        self.workers = workers
+
+    def tracker(self):
+        '''
+        Returns a MemoryTracker for one load under memory_budget
+        '''
+        return memory.MemoryTracker(self.memory_budget)
+
+    def rejects_file(self, filename, directory=False):
+        '''
+        Returns the rejects file for filename, in the rejects directory
+        if directory is True
+        '''
+        if self.rejects is None:
+            return default_rejects_file(filename)
+        if directory:
+            return default_rejects_file(os.path.join(self.rejects, os.path.basename(filename)))
+        return self.rejects
+
+
+class LoadResult:
+    '''
+    Summary of a tolerant load_collection run
+
+    Counts the rows read, inserted and rejected, and records how long was
+    spent parsing/validating versus inserting and how much memory the
+    buffered rows took (memory, see memory.MemoryTracker.report). A file
+    level problem (missing file, unknown header) is stored in error.
+    '''
+    # pylint: disable=R0902,R0903
+    def __init__(self, filename, rejects_file=None):
+        self.filename = filename
+        self.rejects_file = rejects_file
+        self.rows_read = 0
+        self.rows_inserted = 0
+        self.rows_rejected = 0
+        self.chunks = 0
+        self.error = None
+        self.timings = {'parse': 0.0, 'insert': 0.0, 'total': 0.0}
+        self.memory = {}
+
+    def __bool__(self):
+        return self.error is None
+
+    def __repr__(self):
+        return (f'LoadResult({self.filename!r}, read={self.rows_read}, '
+                f'inserted={self.rows_inserted}, rejected={self.rows_rejected})')
+
+
+class RejectsWriter:
+    '''
+    Streams rejected rows to a CSV file, opening it on the first reject
+
+    Each rejected row is written with its line number and the reason it was
+    rejected, followed by the original values.
+    '''
+    def __init__(self, filename, fieldnames):
+        self.filename = filename
+        self.fieldnames = list(fieldnames or [])
+        self.count = 0
+        self._file = None
+        self._writer = None
+
+    def write(self, line_num, reason, row):
+        '''
+        Writes one rejected row
+        '''
+        if self._writer is None:
+            # pylint: disable=R1732
+            self._file = open(self.filename, 'w', encoding='utf-8', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(['LINE', 'REASON'] + self.fieldnames)
+        values = [row.get(key, '') for key in self.fieldnames] if row else []
+        self._writer.writerow([line_num, reason] + values)
+        self.count += 1
+
+    def close(self):
+        '''
+        Closes the rejects file if one was opened
+        '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._writer = None
+
+
+class RejectsBuffer:
+    '''
+    Collects rejected rows in memory where no rejects file is open yet
+
+    Has the write() interface of RejectsWriter so it can be passed to
+    read_chunks in a worker process.
+    '''
+    # pylint: disable=R0903
+    def __init__(self):
+        self.rows = []
+
+    def write(self, line_num, reason, row):
+        '''
+        Stores one rejected row
+        '''
+        self.rows.append((line_num, reason, row))
+
+
+def user_keys():
+    '''
+    Returns the csv columns of a user file and how each is validated and
+    stored
+    '''
+    return {'USER_ID':  {'validate': validation.valid_user_id, 'key': 'user_id',
+                         'unique': True},
+            'EMAIL':    {'validate': validation.valid_email,   'key': 'user_email'},
+            'NAME':     {'validate': validation.valid_name,    'key': 'user_name'},
+            'LASTNAME': {'validate': validation.valid_name,    'key': 'user_last_name'}}
+
+
+def status_keys():
+    '''
+    Returns the csv columns of a status file and how each is validated and
+    stored
+
+    CREATED_AT may be left out, or empty in a row, to stamp statuses with
+    the load time.
+    '''
+    return {'STATUS_ID':   {'validate': validation.valid_status_id,   'key': 'status_id',
+                            'unique': True},
+            'USER_ID':     {'validate': validation.valid_user_id,     'key': 'user_id',
+                            'references': 'user'},
+            'STATUS_TEXT': {'validate': validation.valid_status_text, 'key': 'status_text'},
+            'CREATED_AT':  {'validate': validation.valid_timestamp,   'key': 'created_at',
+                            'optional': True, 'convert': validation.parse_timestamp}}
+
+
+def model_database(collection):
+    '''
+    Returns the peewee database an unsharded collection writes to
+    '''
+    return collection.db or sm.model_database(collection.database)
+
+
+def check_row(row, keys):
+    '''
+    Validates a csv row and renames its keys to model field names
+
+    Returns (new_row, None) on success or (None, reason) on failure.
+    '''
+    return check_rows([row], keys)[0]
+
+
+def check_rows(rows, keys):
+    '''
+    Validates a chunk of csv rows with the batch validation engine
+
+    Returns a (new_row, reason) pair for each row as check_row does.
+    '''
+    masks = validation.validate_columns(
+        rows, {key: spec['validate'] for key, spec in keys.items()})
+    checked = []
+    for i, row in enumerate(rows):
+        new_row, reason = {}, None
+        for key, value in row.items():
+            if key is None:
+                reason = value if isinstance(value, readers.RowError) else 'Too many values'
+            elif key not in keys:
+                reason = f'Unknown column {key}'
+            elif value is None or value.replace(' ', '') == '':
+                if keys[key].get('optional'):
+                    continue
+                reason = f'Empty value for {key}'
+            elif not masks[key][i]:
+                reason = f'Invalid {key}: {value}'
+            else:
+                convert = keys[key].get('convert')
+                new_row[keys[key]['key']] = convert(value) if convert else value
+                continue
+            break
+        checked.append((None, reason) if reason else (new_row, None))
+    return checked
+
+
+def default_rejects_file(filename):
+    '''
+    Returns the default rejects file name for a source file
+    '''
+    return f'{readers.base_name(filename)}_rejects.csv'
+
+
+def load_collection(filename, keys, collection, tolerant=False, options=None):
+    '''
+    Method which loads status or user collection from CSV file
+
+    The file may be compressed (.gz, .bz2, .xz) or newline-delimited JSON
+    (.ndjson); see readers.open_rows.
+
+    By default the load is all-or-nothing and returns True or False. With
+    tolerant=True valid rows are committed in chunks, bad rows are written
+    to rejects_file with their line number and reason, and a LoadResult is
+    returned instead. Afterwards sm.maintain refreshes planner statistics
+    and vacuums free pages as needed.
+
+    options is a LoadOptions. Its memory_budget caps the rows buffered:
+    once they reach it they are written early instead of reading on. The
+    buffered peak is logged, and kept in the LoadResult. bulk=True is for
+    very large loads into empty or mostly empty tables: see bulk_mode.
+
+    Author: Marcus Bakke
+    '''
+    options = options or LoadOptions()
+    tracker = options.tracker()
+    with profiler.maybe(f'load_{os.path.basename(filename)}'), \
+            bulk_mode(collection, options.bulk):
+        if tolerant:
+            result = load_collection_tolerant(filename, keys, collection,
+                                              options.rejects_file(filename), tracker)
+        else:
+            result = load_collection_strict(filename, keys, collection, tracker)
+        collection.maintain()
+    logging.info('Buffered at most %s rows (%s bytes) loading %s.',
+                 tracker.peak_rows, tracker.peak_bytes, filename)
+    return result
+
+
+def load_collection_strict(filename, keys, collection, tracker=None):
+    '''
+    All-or-nothing load used by load_collection
+
+    Returns False on the first bad row, unknown column or IntegrityError.
+    The whole file is checked before anything is written unless tracker
+    has a budget; then the rows are written whenever the budget is
+    reached, and deleted again (keeping only their keys meanwhile) if the
+    load fails later.
+    '''
+    tracker = tracker or memory.MemoryTracker()
+    seen, written = {}, collections.defaultdict(list)
+
+    def flush(data):
+        flushed, committed = insert_strict(filename, keys, collection, data, seen)
+        for database, rows in committed.items():
+            written[database].extend(rows)
+        tracker.drain()
+        return flushed
+
+    loaded = False
+    try:
+        loaded = read_strict(filename, keys, tracker, flush)
+    finally:
+        if not loaded:
+            unload_written(collection, written)
+    return loaded
+
+
+def read_strict(filename, keys, tracker, flush):
+    '''
+    Reads and checks the rows of a strict load, passing them to flush
+    when tracker is full and at the end of the file
+
+    Returns False on the first bad row or file error, otherwise what the
+    last flush returned.
+    '''
+    # Loop through each row in csv file
+    try:
+        with readers.open_rows(filename) as reader:
+            data = []
+            for chunk in read_rows(reader, tracker):
+                # Check for errors in the chunk's rows
+                for (line_num, row), (new_row, reason) in zip(
+                        chunk, check_rows([row for _, row in chunk], keys)):
+                    if reason:
+                        print(f'{reason} on line {line_num} of {filename}.')
+                        return False
+                    data.append((line_num, new_row, row))
+                if tracker.full():
+                    if not flush(data):
+                        return False
+                    data = []
+    except FileNotFoundError:
+        logging.error('File does not exist: %s', filename)
+        return False
+    except readers.UnsupportedInput as err:
+        logging.error(err)
+        return False
+    return flush(data)
+
+
+def insert_strict(filename, keys, collection, data, seen):
+    '''
+    Screens and inserts rows of a strict load
+
+    Returns (inserted, committed): inserted is False if a row is rejected
+    or an insert fails, and committed is a dict of database -> the keys of
+    the rows committed, for unload_written.
+    '''
+    # Find duplicates and missing references before writing anything
+    data, rejected = screen_rows(data, keys, collection, seen)
+    if rejected:
+        # The first reject stops the load; the rest are only detail
+        line_num, reason, _ = rejected[0]
+        logging.error('Line %s of %s: %s (%s rows rejected)', line_num, filename, reason,
+                      len(rejected))
+        for line_num, reason, _ in rejected[1:]:
+            logging.debug('Line %s of %s: %s', line_num, filename, reason)
+        return False, {}
+    parts = partition_rows(collection, data)
+    if collection.shards is None:
+        outcomes = [insert_all(collection, [new_row for _, new_row, _ in data])]
+    else:
+        outcomes = collection.shards.map(
+            lambda database, part: insert_shard(collection, database, part), parts)
+    committed = {}
+    for (database, part), inserted in zip(parts.items(), outcomes):
+        if inserted:
+            committed[database or model_database(collection)] = [
+                {key: row[key] for key in ('user_id', 'status_id') if key in row}
+                for _, row, _ in part]
+    if any(outcomes) and not all(outcomes):
+        logging.error('%s failed on %s of %s shards; the rows the others committed '
+                      'will be removed.', filename, outcomes.count(False), len(outcomes))
+    return all(outcomes), committed
+
+
+def insert_shard(collection, database, part):
+    '''
+    Inserts one shard's part of a strict load
+
+    Shards commit separately, so a database error on one (a locked or
+    full file) is reported as a failed insert instead of raised; the
+    caller can then remove what the other shards committed.
+    '''
+    try:
+        return insert_all(collection, [row for _, row, _ in part], database)
+    except pw.PeeweeException as err:
+        logging.error('Load into %s failed: %s', database.database, err)
+        return False
+
+
+def unload_written(collection, written):
+    '''
+    Deletes the rows a failed strict load committed (see insert_strict)
+    '''
+    for database, rows in written.items():
+        logging.info('-> Removing %s entries of a failed load.', len(rows))
+        turn = collection.scheduler.bulk() if collection.scheduler else contextlib.nullcontext()
+        with turn:
+            collection.unload(rows, database)
+        sm.note_changes(database, len(rows))
+
+
+@contextlib.contextmanager
+def bulk_mode(collection, enabled=True):
+    '''
+    Runs a load in bulkload.bulk_load mode on each of collection's databases
+
+    Secondary indexes are dropped for the load and rebuilt afterwards,
+    each insert's rows are sorted by key and foreign keys are checked at
+    each commit and once more at the end. Databases whose table already
+    holds many rows are loaded normally. Yields the bulkload.bulk_load reports.
+    '''
+    with contextlib.ExitStack() as stack:
+        reports = []
+        if enabled:
+            reports = [stack.enter_context(bulkload.bulk_load([collection.database], database))
+                       for database in collection.databases()]
+        yield reports
+
+
+def insert_all(collection, data, database=None):
+    '''
+    Inserts a list of rows inside a single transaction
+
+    Rows are written in adaptively sized batches (see batching). With a
+    scheduler the rows are committed in short slices instead, and the
+    slices already committed are deleted again if a later one fails.
+    '''
+    database = database or model_database(collection)
+    model = collection.database
+    data = bulkload.in_key_order(model, data, database)
+    logging.info('-> Loading %s entries.', len(data))
+    if collection.scheduler is not None:
+        return insert_scheduled(collection, data, database)
+    # Execute bulk data insertion; an error rolls back the whole load
+    try:
+        with database.atomic():
+            bulkload.defer_foreign_keys(database)
+            batching.insert_rows(model, model.prepare_rows(data, database), database)
+            collection.bulk_inserted(data, database)
+    except pw.IntegrityError as err:
+        logging.error('peewee IntegrityError encountered: %s', err.args[0])
+        return False
+    sm.note_changes(database, len(data))
+    return True
+
+
+def insert_scheduled(collection, data, database):
+    '''
+    All-or-nothing insert of data in scheduler-sized transactions
+    '''
+    model = collection.database
+    committed = []
+    try:
+        for part in collection.scheduler.bulk_slices(data):
+            with database.atomic():
+                bulkload.defer_foreign_keys(database)
+                batching.insert_rows(model, model.prepare_rows(part, database), database)
+                collection.bulk_inserted(part, database)
+            committed.extend(part)
+    except pw.IntegrityError as err:
+        logging.error('peewee IntegrityError encountered: %s', err.args[0])
+        with collection.scheduler.bulk():
+            collection.unload(committed, database)
+        return False
+    sm.note_changes(database, len(data))
+    return True
+
+
+def load_collection_tolerant(filename, keys, collection, rejects_file=None,
+                             tracker=None):
+    '''
+    Loads a CSV file, committing valid rows chunk by chunk
+
+    Rows that are empty, fail validation or violate a constraint are
+    streamed to the rejects file and do not stop the load. A chunk ends
+    early when tracker's budget is reached.
+    '''
+    tracker = tracker or memory.MemoryTracker()
+    start = time.perf_counter()
+    rejects_file = rejects_file or default_rejects_file(filename)
+    result = LoadResult(filename, rejects_file)
+    try:
+        with readers.open_rows(filename) as reader:
+            result.error = header_error(reader.fieldnames, keys)
+            if result.error:
+                logging.error('%s in %s', result.error, filename)
+                return result
+            rejects = RejectsWriter(rejects_file, reader.fieldnames)
+            seen = {}
+            try:
+                for chunk in read_chunks(reader, keys, rejects, result, tracker):
+                    chunk = screen_chunk(chunk, keys, collection, seen, rejects)
+                    insert_chunk(collection, chunk, rejects, result)
+                    tracker.drain()
+            finally:
+                rejects.close()
+            result.rows_rejected = rejects.count
+    except FileNotFoundError:
+        result.error = f'File does not exist: {filename}'
+        logging.error(result.error)
+    except readers.UnsupportedInput as err:
+        result.error = str(err)
+        logging.error(result.error)
+    result.memory = tracker.report()
+    result.timings['total'] = time.perf_counter() - start
+    logging.info('Loaded %s: %s rows read, %s inserted, %s rejected.',
+                 filename, result.rows_read, result.rows_inserted,
+                 result.rows_rejected)
+    return result
+
+
+def load_directory(path, keys, collection, options=None):
+    '''
+    Loads the CSV files under path whose header matches keys
+
+    Worker processes parse and validate the files; this process screens
+    and inserts their chunks one file at a time, in file name order, so
+    duplicates across files are caught the same way on every run. Returns
+    a list of LoadResults.
+
+    options is a LoadOptions. Each file is parsed whole, so its
+    memory_budget bounds how many parsed files may wait to be written
+    rather than the rows of one file.
+
+    Files whose header does not match keys are not parsed; their
+    LoadResult carries the header error.
+    '''
+    options = options or LoadOptions()
+    files, skipped = [], {}
+    for filename in directory_files(path):
+        error = header_error(file_header(filename), keys)
+        if error is None:
+            files.append(filename)
+        else:
+            logging.info('Skipping %s: not a %s file.', filename, '/'.join(keys))
+            skipped[filename] = LoadResult(filename)
+            skipped[filename].error = error
+    logging.info('Loading %s files from %s.', len(files), path)
+    seen = {}
+    with profiler.maybe(f'load_dir_{os.path.basename(os.path.normpath(path))}'), \
+            bulk_mode(collection, options.bulk):
+        results = [write_parsed(parsed, keys, collection, seen)
+                   for parsed in parse_files(files, keys, options)]
+        collection.maintain()
+    return sorted(results + list(skipped.values()), key=lambda result: result.filename)
+
+
+def directory_files(path):
+    '''
+    Returns the sorted input files in a directory (any format or codec
+    readers supports), or matching a glob pattern, leaving out rejects
+    files written by earlier loads
+    '''
+    if os.path.isdir(path):
+        files = [filename for filename in glob.glob(os.path.join(path, '*'))
+                 if readers.is_supported(filename)]
+    else:
+        files = glob.glob(path)
+    return sorted(filename for filename in files
+                  if os.path.isfile(filename) and not filename.endswith('_rejects.csv'))
+
+
+def file_header(filename):
+    '''
+    Returns the column names of an input file
+    '''
+    try:
+        with readers.open_rows(filename, readahead=False) as reader:
+            return reader.fieldnames or []
+    except readers.UnsupportedInput:
+        return []
+
+
+def parse_files(files, keys, options):
+    '''
+    Yields parse_file results for files in order
+
+    Up to twice as many files as there are options.workers are parsed
+    ahead of the one being written, which bounds how much parsed data
+    waits in memory. Fewer are when files the size of the last one would
+    not fit in options.memory_budget.
+    '''
+    if options.workers == 0:
+        for filename in files:
+            yield parse_file(filename, keys, options.rejects_file(filename, directory=True))
+        return
+    workers = options.workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        window = 2 * workers
+        pending = collections.deque()
+        for filename in files:
+            pending.append(pool.submit(parse_file, filename, keys,
+                                       options.rejects_file(filename, directory=True)))
+            while len(pending) >= window:
+                parsed = pending.popleft().result()
+                yield parsed
+                window = read_ahead(parsed, workers, options.memory_budget)
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_ahead(parsed, workers, memory_budget):
+    '''
+    Returns how many files parse_files may parse ahead after parsed
+
+    Twice the workers, or as many files of parsed's size as fit in
+    memory_budget (at least one).
+    '''
+    if memory_budget is None:
+        return 2 * workers
+    size = max(1, parsed[0].memory.get('peak_bytes', 0))
+    return max(1, min(2 * workers, memory_budget // size))
+
+
+def parse_file(filename, keys, rejects_file):
+    '''
+    Reads and validates one CSV file; runs in a worker process
+
+    Returns (result, fieldnames, chunks, rejected) where result is the
+    file's LoadResult so far, chunks are lists of (line_num, new_row,
+    raw_row) tuples and rejected holds (line_num, reason, raw_row).
+    '''
+    result = LoadResult(filename, rejects_file)
+    rejects = RejectsBuffer()
+    tracker = memory.MemoryTracker()
+    try:
+        with readers.open_rows(filename) as reader:
+            result.error = header_error(reader.fieldnames, keys)
+            if result.error:
+                return result, reader.fieldnames, [], []
+            chunks = list(read_chunks(reader, keys, rejects, result, tracker))
+            result.memory = tracker.report()
+            return result, reader.fieldnames, chunks, rejects.rows
+    except FileNotFoundError:
+        result.error = f'File does not exist: {filename}'
+    except readers.UnsupportedInput as err:
+        result.error = str(err)
+    return result, None, [], []
+
+
+def write_parsed(parsed, keys, collection, seen):
+    '''
+    Screens and inserts the chunks of one parse_file result
+
+    Returns the file's completed LoadResult.
+    '''
+    result, fieldnames, chunks, rejected = parsed
+    if result.error:
+        logging.error('%s in %s', result.error, result.filename)
+        return result
+    start = time.perf_counter()
+    screened = RejectsBuffer()
+    for chunk in chunks:
+        chunk = screen_chunk(chunk, keys, collection, seen, screened)
+        insert_chunk(collection, chunk, screened, result)
+    # Rows rejected while parsing and while writing go out in line order
+    rejects = RejectsWriter(result.rejects_file, fieldnames)
+    try:
+        for line_num, reason, raw in sorted(rejected + screened.rows,
+                                            key=lambda reject: reject[0]):
+            rejects.write(line_num, reason, raw)
+    finally:
+        rejects.close()
+    result.rows_rejected = rejects.count
+    result.memory['max_rss'] = memory.max_rss()
+    result.timings['total'] = result.timings['parse'] + time.perf_counter() - start
+    logging.info('Loaded %s: %s rows read, %s inserted, %s rejected.',
+                 result.filename, result.rows_read, result.rows_inserted,
+                 result.rows_rejected)
+    return result
+
+
+def header_error(fieldnames, keys):
+    '''
+    Describes unknown or missing columns in a csv header, or returns None
+    '''
+    fieldnames = fieldnames or []
+    unknown = [key for key in fieldnames if key not in keys]
+    missing = [key for key, spec in keys.items()
+               if key not in fieldnames and not spec.get('optional')]
+    if unknown or missing:
+        return f'Bad header: unknown {unknown}, missing {missing}'
+    return None
+
+
+def read_chunks(reader, keys, rejects, result, tracker):
+    '''
+    Yields lists of (line_num, new_row, raw_row) tuples from a DictReader
+
+    Each CHUNK_SIZE rows (fewer when tracker is full) are validated
+    together by check_rows; rows that fail are written to rejects instead.
+    The caller drains tracker once it has written a chunk.
+    '''
+    parse_start = time.perf_counter()
+    for rows in read_rows(reader, tracker):
+        result.rows_read += len(rows)
+        chunk = []
+        for (line_num, row), (new_row, reason) in zip(
+                rows, check_rows([row for _, row in rows], keys)):
+            if reason:
+                rejects.write(line_num, reason, row)
+            else:
+                chunk.append((line_num, new_row, row))
+        result.timings['parse'] += time.perf_counter() - parse_start
+        if chunk:
+            yield chunk
+        else:
+            tracker.drain()
+        parse_start = time.perf_counter()
+    result.timings['parse'] += time.perf_counter() - parse_start
+
+
+def read_rows(reader, tracker):
+    '''
+    Yields lists of up to CHUNK_SIZE (line_num, row) pairs from a reader
+
+    Rows are counted in tracker, and a list ends early when it is full.
+    '''
+    rows = []
+    for row in reader:
+        rows.append((reader.line_num, row))
+        tracker.add(row)
+        if len(rows) >= CHUNK_SIZE or tracker.full():
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+
+def existing_values(field, values, database=None):
+    '''
+    Returns the subset of values already stored in field
+
+    Uses indexed IN (...) lookups so the cost follows the number of values
+    checked rather than the size of the table.
+    '''
+    found = set()
+    values = list(values)
+    for i in range(0, len(values), sm.IN_BATCH):
+        query = (field.model
+                 .select(field)
+                 .where(field.in_(values[i:i+sm.IN_BATCH]))
+                 .tuples())
+        found.update(value for value, in query.execute(database))
+    return found
+
+
+def row_user_id(item):
+    '''
+    Returns the user_id a (line_num, new_row, raw_row) tuple is routed by
+    '''
+    return item[1]['user_id']
+
+
+def partition_rows(collection, rows):
+    '''
+    Groups (line_num, new_row, raw_row) tuples by the database they belong
+    in; the key is collection.db when the collection is not sharded
+    '''
+    if collection.shards is None:
+        return {collection.db: rows}
+    return collection.shards.partition(rows, row_user_id)
+
+
+def screen_rows(rows, keys, collection, seen):
+    '''
+    Screens (line_num, new_row, raw_row) tuples before they are inserted
+
+    Keys flagged 'unique' are checked against the table and against the
+    values already accepted from the file (kept in seen), and keys with a
+    'references' foreign key name must exist in the referenced table. Returns
+    (clean_rows, rejected) where rejected holds (line_num, reason, raw_row).
+    '''
+    clean, rejected = [], []
+    for database, part in partition_rows(collection, rows).items():
+        checks = screen_checks(part, keys, collection, database)
+        for line_num, new_row, raw in part:
+            reason = screen_reason(new_row, checks, seen)
+            if not reason and collection.shards is not None:
+                reason = shard_reason(new_row)
+            if reason:
+                rejected.append((line_num, reason, raw))
+                continue
+            for _, key, unique, _ in checks:
+                if unique:
+                    seen[key].add(new_row[key])
+            clean.append((line_num, new_row, raw))
+    if collection.shards is not None:
+        clean.sort(key=lambda item: item[0])
+        rejected.sort(key=lambda item: item[0])
+    return clean, rejected
+
+
+def shard_reason(new_row):
+    '''
+    Returns why a row cannot be stored in a sharded collection, or None
+
+    Statuses are found by the user_id prefix of their status_id, so it
+    must match the USER_ID they are stored under.
+    '''
+    if 'status_id' in new_row and \
+            sharding.status_owner(new_row['status_id']) != new_row['user_id']:
+        return f'STATUS_ID {new_row["status_id"]} does not belong to {new_row["user_id"]}'
+    return None
+
+
+def screen_chunk(chunk, keys, collection, seen, rejects):
+    '''
+    Screens a chunk with screen_rows and writes the rejected rows out
+    '''
+    chunk, rejected = screen_rows(chunk, keys, collection, seen)
+    for line_num, reason, raw in rejected:
+        rejects.write(line_num, reason, raw)
+    return chunk
+
+
+def screen_checks(rows, keys, collection, database=None):
+    '''
+    Looks up the stored values screen_rows needs for the given rows
+
+    Returns a list of (column, key, unique, found_values) tuples.
+    '''
+    checks = []
+    for column, spec in keys.items():
+        values = {new_row.get(spec['key']) for _, new_row, _ in rows}
+        if spec.get('unique'):
+            field = getattr(collection.database, spec['key'])
+            checks.append((column, spec['key'], True,
+                           existing_values(field, values, database)))
+        if spec.get('references'):
+            model = getattr(collection.database, spec['references']).rel_model
+            field = getattr(model, spec['key'])
+            checks.append((column, spec['key'], False,
+                           existing_values(field, values, database)))
+    return checks
+
+
+def screen_reason(new_row, checks, seen):
+    '''
+    Returns why screen_rows rejects new_row, or None if it passes
+    '''
+    for column, key, unique, found in checks:
+        value = new_row[key]
+        if unique and value in found:
+            return f'{column} {value} already exists'
+        if unique and value in seen.setdefault(key, set()):
+            return f'Duplicate {column} {value} in file'
+        if not unique and value not in found:
+            return f'Unknown {column} {value}'
+    return None
+
+
+def insert_chunk(collection, chunk, rejects, result):
+    '''
+    Inserts one chunk of (line_num, new_row, raw_row) tuples
+
+    Each database (or shard) gets its own transaction; shards are written
+    in parallel. Rows that still fail are written to rejects.
+    '''
+    if not chunk:
+        return
+    start = time.perf_counter()
+    result.chunks += 1
+    logging.info('-> Loading chunk %s (%s rows).', result.chunks, len(chunk))
+    parts = partition_rows(collection, chunk)
+    if collection.shards is None:
+        outcomes = [write_chunk(collection, collection.db, chunk)]
+    else:
+        outcomes = collection.shards.map(
+            lambda database, part: write_chunk(collection, database, part), parts)
+    for inserted, rejected in outcomes:
+        result.rows_inserted += inserted
+        for line_num, reason, raw in rejected:
+            rejects.write(line_num, reason, raw)
+    result.timings['insert'] += time.perf_counter() - start
+
+
+def write_chunk(collection, database, chunk):
+    '''
+    Writes (line_num, new_row, raw_row) tuples to one database in a single
+    transaction, or one per scheduler slice when the collection has a
+    scheduler
+
+    If the bulk insert fails the chunk is retried row by row so only the
+    offending rows are rejected. Returns (rows inserted, rejected) where
+    rejected holds (line_num, reason, raw_row).
+    '''
+    if collection.scheduler is None:
+        return write_rows(collection, database, chunk)
+    inserted, rejected = 0, []
+    for part in collection.scheduler.bulk_slices(chunk):
+        part_inserted, part_rejected = write_rows(collection, database, part)
+        inserted += part_inserted
+        rejected.extend(part_rejected)
+    return inserted, rejected
+
+
+def write_rows(collection, database, chunk):
+    '''
+    Writes (line_num, new_row, raw_row) tuples in one transaction; see
+    write_chunk
+    '''
+    model = collection.database
+    database = database or model_database(collection)
+    rows = [row for _, row, _ in chunk]
+    try:
+        with database.atomic():
+            bulkload.defer_foreign_keys(database)
+            ordered = bulkload.in_key_order(model, rows, database)
+            batching.insert_rows(model, model.prepare_rows(ordered, database), database)
+            collection.bulk_inserted(rows, database)
+        sm.note_changes(database, len(rows))
+        return len(chunk), []
+    except pw.IntegrityError:
+        rows, rejected = [], []
+        with database.atomic():
+            for line_num, row, raw in chunk:
+                try:
+                    with database.atomic():
+                        model.insert(model.prepare_rows([row], database)[0]).execute(database)
+                    rows.append(row)
+                except pw.IntegrityError as err:
+                    rejected.append((line_num, str(err), raw))
+            collection.bulk_inserted(rows, database)
+    sm.note_changes(database, len(rows))
+    return len(rows), rejected
@@ -0,0 +1,226 @@
+'''
+Load generator for the HTTP/JSON service
+
+Usage:
+    python loadgen.py [--url http://HOST:PORT] [--clients N] [--requests N]
+                      [--users N] [--batch N] [--mix add,search,status]
+    python loadgen.py --serve [--group-commit] ...
+
+Each client thread keeps one HTTP/1.1 connection open and sends its share
+of the requests, cycling through the operations in --mix:
+
+    add      POST /users with a new user
+    search   GET /users/<user_id> of a user added in the warm-up
+    status   POST /statuses with an allocated status_id
+    batch    POST /users/batch with --batch new users
+    find     POST /users/search with --batch user_ids
+
+--users users are added (in batches) before timing starts so lookups hit.
+With --serve a service is started in this process on a temporary database
+instead of connecting to --url. Prints requests per second and latency
+percentiles per operation and overall.
+'''
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import http.client
+from urllib.parse import urlsplit
+import service
+
+OPERATIONS = ('add', 'search', 'status', 'batch', 'find')
+PERCENTILES = (50, 90, 99)
+
+
+class Client:
+    '''
+    One keep-alive connection to the service
+    '''
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+
+    def request(self, method, path, body=None):
+        '''
+        Sends a request and returns (status, decoded JSON answer)
+        '''
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        headers = {'Content-Type': 'application/json'} if data else {}
+        self.connection.request(method, path, data, headers)
+        response = self.connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def close(self):
+        '''
+        Closes the connection
+        '''
+        self.connection.close()
+
+
+def user(name):
+    '''
+    Returns a synthetic user record
+    '''
+    return {'user_id': name, 'user_email': f'{name}@goodmail.com',
+            'user_name': 'Load', 'user_last_name': 'Generator'}
+
+
+class Worker(threading.Thread):
+    '''
+    Client thread sending its share of the requests and timing each one
+    '''
+    def __init__(self, number, args, known):
+        super().__init__(name=f'loadgen-{number}')
+        self.number = number
+        self.args = args
+        self.known = known
+        self.latencies = {operation: [] for operation in args.mix}
+        self.errors = 0
+
+    def operation(self, operation, i):
+        '''
+        Returns (method, path, body) of request i of an operation
+        '''
+        name = f'load{self.number}_{i}'
+        known = self.known[i % len(self.known)]
+        batch = range(self.args.batch)
+        requests = {
+            'add': ('POST', '/users', user(name)),
+            'search': ('GET', f'/users/{known}', None),
+            'status': ('POST', '/statuses', {'user_id': known, 'status_text': f'Load {i}'}),
+            'batch': ('POST', '/users/batch', {'users': [user(f'{name}_{j}') for j in batch]}),
+            'find': ('POST', '/users/search',
+                     {'user_ids': [self.known[(i + j) % len(self.known)] for j in batch]}),
+        }
+        return requests[operation]
+
+    def run(self):
+        client = Client(self.args.url)
+        try:
+            for i in range(self.number, self.args.requests, self.args.clients):
+                operation = self.args.mix[i % len(self.args.mix)]
+                method, path, body = self.operation(operation, i)
+                start = time.perf_counter()
+                status, _ = client.request(method, path, body)
+                self.latencies[operation].append(time.perf_counter() - start)
+                if status >= 300:
+                    self.errors += 1
+        finally:
+            client.close()
+
+
+def percentile(values, percent):
+    '''
+    Returns the nearest-rank percentile of sorted values
+    '''
+    index = max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summary(name, latencies, seconds):
+    '''
+    Returns one report line for a list of latencies
+    '''
+    latencies = sorted(latencies)
+    line = f'{name:<8}{len(latencies):>9}{len(latencies) / seconds:>10.0f}'
+    for percent in PERCENTILES:
+        line += f'{percentile(latencies, percent) * 1e3:>10.2f}'
+    return line + f'{latencies[-1] * 1e3:>10.2f}'
+
+
+def warm_up(url, count, size=500):
+    '''
+    Adds count users for the lookups to find; returns their user_ids
+    '''
+    known = [f'known{i}' for i in range(count)]
+    client = Client(url)
+    try:
+        for i in range(0, count, size):
+            client.request('POST', '/users/batch',
+                           {'users': [user(name) for name in known[i:i + size]]})
+    finally:
+        client.close()
+    return known
+
+
+def run(args):
+    '''
+    Runs the load and returns (seconds, workers)
+    '''
+    known = warm_up(args.url, args.users)
+    workers = [Worker(number, args, known) for number in range(args.clients)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start, workers
+
+
+def report(seconds, workers):
+    '''
+    Prints throughput and latency percentiles (ms) per operation
+    '''
+    header = ''.join(f'{"p" + str(percent):>10}' for percent in PERCENTILES)
+    print(f'{"op":<8}{"requests":>9}{"req/s":>10}{header}{"max":>10}')
+    everything = []
+    for operation in workers[0].latencies:
+        latencies = [value for worker in workers for value in worker.latencies[operation]]
+        everything += latencies
+        if latencies:
+            print(summary(operation, latencies, seconds))
+    print(summary('all', everything, seconds))
+    print(f'{sum(worker.errors for worker in workers)} errors in {seconds:.2f}s')
+
+
+def parse_args(argv=None):
+    '''
+    Parses the command line
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=50)
+    parser.add_argument('--mix', type=lambda value: value.split(','),
+                        default=['add', 'search', 'search', 'status'])
+    parser.add_argument('--serve', action='store_true',
+                        help='start a service on a temporary database')
+    parser.add_argument('--group-commit', action='store_true',
+                        help='with --serve, turn on group commit')
+    args = parser.parse_args(argv)
+    unknown = set(args.mix) - set(OPERATIONS)
+    if unknown:
+        parser.error(f'unknown operations: {", ".join(sorted(unknown))}')
+    return args
+
+
+def main(argv=None):
+    '''
+    Runs the load generator
+    '''
+    args = parse_args(argv)
+    if not args.serve:
+        report(*run(args))
+        return
+    tmp = tempfile.mkdtemp()
+    server = service.make_server(('127.0.0.1', 0), os.path.join(tmp, 'load.db'),
+                                 group_commit=args.group_commit)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    args.url = f'http://{host}:{port}'
+    try:
+        report(*run(args))
+    finally:
+        server.shutdown()
+        service.close_server(server)
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
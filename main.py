@@ -3,32 +3,104 @@ main driver for a simple social network project
 
 Authors: Kathleen Wong and Marcus Bakke
 '''
-import csv
-import re
+import time
 import logging
-import peewee as pw
 import users
+import loader
+import profiler
+import slowlog
+import scheduler
+import validation
 import user_status
 import socialnetwork_model as sm
 
 
-def init_user_collection():
+def init_user_collection(soft_delete=False, shards=None, db=None):
     '''
     Creates and returns a new instance of UserCollection
+
+    With soft_delete=True deleted users are tombstoned and purged later.
+    Pass a sharding.ShardSet as shards to spread users across files, or a
+    database (e.g. snapshots.snapshot().database) as db to read from a copy.
     '''
-    return users.UserCollection()
+    return users.UserCollection(soft_delete=soft_delete, shards=shards, db=db)
 
 
-def init_status_collection():
+def init_status_collection(shards=None, db=None):
     '''
     Creates and returns a new instance of UserStatusCollection
 
     Author: Marcus Bakke
     '''
-    return user_status.UserStatusCollection()
+    return user_status.UserStatusCollection(shards=shards, db=db)
+
+
+def start_group_commit(collection, max_ops=256, max_delay=0.005):
+    '''
+    Turns on group commit for collection's single-record writes
+
+    Requirements:
+    - Writes are queued and committed together every max_ops writes or
+      max_delay seconds.
+    - add/update/delete functions then return a Future instead of True or
+      False (input validation errors still return False at once); its
+      result() is the usual True/False, available once the write is
+      durable.
+    '''
+    return collection.start_group_commit(max_ops, max_delay)
+
+
+def stop_group_commit(collection):
+    '''
+    Commits any queued writes and turns group commit off
+    '''
+    collection.stop_group_commit()
 
 
-def load_users(filename, user_collection):
+def profile(name, directory=None):
+    '''
+    Context manager profiling the operations run inside it
+
+    Requirements:
+    - Runs the block under cProfile and tracemalloc.
+    - Writes profile_<date>_<time>_<name>.pstats and a .txt summary (time
+      per component, peak memory, hottest functions) next to the log file,
+      or to directory.
+    - Yields a profiler.ProfileResult, filled in when the block exits.
+    - Loads are profiled on their own when SOCIALNETWORK_PROFILE=1.
+    '''
+    return profiler.profile(name, directory)
+
+
+def start_scheduler(user_collection, status_collection, interactive_target=0.05,
+                    bulk_target=0.05, max_bulk_delay=1.0):
+    '''
+    Gives single-record operations priority over loads on collections
+
+    Requirements:
+    - Loads commit in slices of about bulk_target seconds; add, update,
+      delete and search calls run between slices.
+    - Interactive calls should wait at most interactive_target seconds;
+      a load waiting longer than max_bulk_delay gets the next turn.
+    - Both collections share the scheduler since they share the database.
+    - Returns the scheduler; its metrics() reports queue wait times.
+    '''
+    write_scheduler = scheduler.WriteScheduler(interactive_target, bulk_target,
+                                               max_bulk_delay)
+    user_collection.use_scheduler(write_scheduler)
+    status_collection.use_scheduler(write_scheduler)
+    return write_scheduler
+
+
+def stop_scheduler(user_collection, status_collection):
+    '''
+    Detaches the scheduler; loads go back to one transaction per chunk
+    '''
+    user_collection.use_scheduler(None)
+    status_collection.use_scheduler(None)
+
+
+def load_users(filename, user_collection, tolerant=False, options=None):
     '''
     Opens a CSV file with user data and
     adds it to an existing instance of
@@ -41,16 +113,16 @@ def load_users(filename, user_collection):
     - Returns False if there are any errors
     (such as empty fields in the source CSV file)
     - Otherwise, it returns True.
+    - With tolerant=True, valid rows are committed and bad rows are
+      written to a rejects file. Returns a LoadResult.
+    - options is a loader.LoadOptions: the rejects file, a memory budget for the
+      rows buffered and bulk mode (see loader.load_collection).
     '''
-    # Loop through each row in csv file
-    keys = {'USER_ID':  {'validate': validate_user_id,  'key': 'user_id'},
-            'EMAIL':    {'validate': validate_email,    'key': 'user_email'},
-            'NAME':     {'validate': validate_name,     'key': 'user_name'},
-            'LASTNAME': {'validate': validate_name,     'key': 'user_last_name'}}
-    return load_collection(filename, keys, user_collection)
+    return loader.load_collection(filename, loader.user_keys(), user_collection,
+                                  tolerant, options)
 
 
-def load_status_updates(filename, status_collection):
+def load_status_updates(filename, status_collection, tolerant=False, options=None):
     '''
     Opens a CSV file with status data and adds it to an existing
     instance of UserStatusCollection
@@ -61,13 +133,66 @@ def load_status_updates(filename, status_collection):
     - Returns False if there are any errors(such as empty fields in the
       source CSV file)
     - Otherwise, it returns True.
+    - With tolerant=True, valid rows are committed and bad rows are
+      written to a rejects file. Returns a LoadResult.
+    - options is a loader.LoadOptions: the rejects file, a memory budget for the
+      rows buffered and bulk mode (see loader.load_collection).
 
     Author: Marcus Bakke
     '''
-    keys = {'STATUS_ID':   {'validate': validate_status_id,   'key': 'status_id'},
-            'USER_ID':     {'validate': validate_user_id,     'key': 'user_id'},
-            'STATUS_TEXT': {'validate': validate_status_text, 'key': 'status_text'}}
-    return load_collection(filename, keys, status_collection)
+    return loader.load_collection(filename, loader.status_keys(), status_collection,
+                                  tolerant, options)
+
+
+def load_users_dir(path, user_collection, options=None):
+    '''
+    Loads every user CSV file in a directory (or matching a glob pattern)
+
+    Requirements:
+    - Files are parsed and validated in parallel by options.workers
+      processes (default: one per CPU, 0 parses in this process) and
+      written by this process in file name order.
+    - Files whose header is not a user header are skipped, as are
+      *_rejects.csv files; the LoadResult of a skipped file has error set.
+    - Bad rows are written to a rejects file per source file (in the
+      options.rejects directory if given) and do not stop the load.
+    - Returns a list with one LoadResult per file, in file name order.
+    - options.memory_budget limits how many parsed files wait to be
+      written, and options.bulk drops and rebuilds secondary indexes
+      around the whole directory (see loader.load_directory).
+    '''
+    return loader.load_directory(path, loader.user_keys(), user_collection, options)
+
+
+def load_status_dir(path, status_collection, options=None):
+    '''
+    Loads every status CSV file in a directory (or matching a glob pattern)
+
+    Works like load_users_dir; statuses whose user is not loaded yet are
+    rejected, so load the user files first (see load_dir).
+    '''
+    return loader.load_directory(path, loader.status_keys(), status_collection, options)
+
+
+def load_dir(path, user_collection, status_collection, options=None):
+    '''
+    Loads a directory holding both user and status CSV files
+
+    All user files are loaded before any status file so every status can
+    find its user. Returns the LoadResults of the user files followed by
+    those of the status files, then one for each file that is neither
+    (with error set).
+    '''
+    users_results = load_users_dir(path, user_collection, options)
+    status_results = load_status_dir(path, status_collection, options)
+    # Each loader skips the other's files; only report files neither took
+    loaded = [result for result in users_results + status_results if result]
+    taken = {result.filename for result in loaded}
+    skipped = {}
+    for result in users_results + status_results:
+        if not result and result.filename not in taken:
+            skipped.setdefault(result.filename, result)
+    return loaded + list(skipped.values())
 
 
 def add_user(user_id, email, user_name, user_last_name, user_collection):
@@ -126,6 +251,127 @@ def search_user(user_id, user_collection):
     return None
 
 
+def search_users_many(user_ids, user_collection):
+    '''
+    Searches for many users in user_collection at once
+
+    Requirements:
+    - Returns (found, missing): a dict of user_id -> User instance for the
+      users found, and the set of user_ids that were not.
+    - Uses one query per few hundred user_ids rather than one per user.
+    '''
+    return user_collection.search_users_many(user_ids)
+
+
+def find_users(user_collection, page=1, page_size=20, **criteria):
+    '''
+    Finds users in user_collection by last name prefix, first name prefix
+    and/or email (the last_name_prefix, name_prefix and email keywords),
+    ignoring case.
+
+    Requirements:
+    - Returns a list holding one page (numbered from 1) of matching users.
+    - Returns an empty list if nothing matches.
+    '''
+    return user_collection.find_users(page=page, page_size=page_size, **criteria)
+
+
+def status_count(user_id, status_collection):
+    '''
+    Returns how many statuses user_id has posted, read from the
+    incrementally maintained UserStats table.
+    '''
+    return status_collection.status_count(user_id)
+
+
+def top_posters(count, status_collection):
+    '''
+    Returns the count users with the most statuses as a list of
+    (user_id, status_count) pairs, most first.
+    '''
+    return status_collection.top_posters(count)
+
+
+def recent_statuses(user_id, status_collection, count=10):
+    '''
+    Returns up to count of user_id's newest statuses, newest first.
+    '''
+    return status_collection.recent_statuses(user_id, count)
+
+
+def statuses_between(status_collection, start=None, end=None, count=None):
+    '''
+    Returns the statuses created in a time range, oldest first.
+
+    Requirements:
+    - start and end are epoch seconds; start is inclusive, end exclusive
+      and None leaves that side open.
+    - At most count statuses are returned (None for all).
+    '''
+    return status_collection.statuses_between(start, end, count)
+
+
+def prune_statuses(max_age, status_collection, batch_size=500, pause=0.0):
+    '''
+    Deletes statuses older than max_age seconds in throttled batches and
+    returns how many were deleted.
+    '''
+    return status_collection.prune_statuses(time.time() - max_age, batch_size, pause)
+
+
+def changes_since(collection, seq=0, limit=1000, shard=0):
+    '''
+    Returns an iterator over up to limit change log entries after seq.
+
+    Requirements:
+    - Entries are dicts with seq, table, op ('insert', 'update' or
+      'delete'), key, data and changed_at, in increasing seq order.
+    - Users, statuses, bulk loads and cascaded deletes are all included.
+    - Sharded collections keep one log per shard, selected by shard.
+    '''
+    return collection.changes_since(seq, limit, shard)
+
+
+def maintain(collection, force=False):
+    '''
+    Runs database maintenance (ANALYZE or PRAGMA optimize, incremental
+    vacuum) for every database of collection and returns a report per
+    database; loads and purges already do this when needed.
+    '''
+    return collection.maintain(force)
+
+
+def storage_stats(collection):
+    '''
+    Returns file size and freelist statistics for every database of
+    collection, as a list of dicts (see sm.storage_stats).
+    '''
+    return [sm.storage_stats(database) for database in collection.databases()]
+
+
+def slow_queries(limit=50, problems_only=False):
+    '''
+    Returns the latest statements that took longer than the slow-query
+    threshold, newest first.
+
+    Requirements:
+    - Entries are dicts with time, database, duration_ms, sql, params
+      (text redacted), plan (EXPLAIN QUERY PLAN lines) and problems (plan
+      lines that scan a table or sort without an index).
+    - problems_only keeps the entries with problems.
+    - The same entries are written to slowlog.LOG_FILE.
+    '''
+    return slowlog.SLOW_LOG.recent(limit, problems_only)
+
+
+def slow_query_summary():
+    '''
+    Returns the slow statements grouped by SQL (count, total_ms, max_ms,
+    problems), slowest total first.
+    '''
+    return slowlog.SLOW_LOG.summary()
+
+
 def add_status(user_id, status_id, status_text, status_collection):
     '''
     Creates a new instance of UserStatus and stores it in
@@ -136,15 +382,35 @@ def add_status(user_id, status_id, status_text, status_collection):
     - Returns False if there are any errors (for example, if
       user_collection.add_status() returns False).
     - Otherwise, it returns True.
+    - With status_id None the next free id for user_id is allocated and
+      returned instead of True.
 
     Author: Marcus Bakke
     '''
     # Validate inputs
-    if not validate_status_inputs(status_id, user_id, status_text):
+    if status_id is None:
+        if not validate_inputs({'user_id': user_id, 'status_text': status_text},
+                               {'user_id': validation.valid_user_id,
+                                'status_text': validation.valid_status_text}):
+            return False
+    elif not validate_status_inputs(status_id, user_id, status_text):
         return False
     return status_collection.add_status(status_id, user_id, status_text)
 
 
+def reserve_status_ids(user_id, count, status_collection):
+    '''
+    Reserves count new status_ids for user_id and returns them as a list
+
+    The ids come from a per-user sequence, so they never collide with
+    each other or with ids loaded or added before.
+    '''
+    if not validate_user_id(user_id) or count < 1:
+        logging.error('Unable to reserve %s ids for %s.', count, user_id)
+        return []
+    return status_collection.reserve_status_ids(user_id, count)
+
+
 def update_status(status_id, user_id, status_text, status_collection):
     '''
     Updates the values of an existing status_id
@@ -190,153 +456,79 @@ def search_status(status_id, status_collection):
         return result
     return None
 
-# New functions
 
-def load_collection(filename, keys, collection):
+def search_statuses_many(status_ids, status_collection):
     '''
-    Method which loads status or user collection from CSV file
+    Searches for many statuses in status_collection at once
 
-    Author: Marcus Bakke
+    Requirements:
+    - Returns (found, missing): a dict of status_id -> UserStatus instance
+      for the statuses found, and the set of status_ids that were not.
+    - Uses one query per few hundred status_ids rather than one per status.
     '''
-    # Loop through each row in csv file
-    try:
-        with open(filename, 'r', encoding="utf-8") as file:
-            reader = csv.DictReader(file)
-            data = []
-            for row in reader:
-                new_row = row.copy()
-                # Check for errors in current row
-                for key, value in row.items():
-                    if value.replace(' ', '') == '':
-                        print(f'Empty value found for {key} on ' \
-                            f'line {reader.line_num} of {filename}.')
-                        return False
-                    # Validate input
-                    try:
-                        if not keys[key]['validate'](value):
-                            return False
-                    except KeyError:
-                        return False
-                    # Replace keys
-                    new_row[keys[key]['key']] = new_row.pop(key)
-                # Append data
-                data.append(new_row)
-        # Execute bulk data insertion
-        with sm.db.atomic():
-            # This specifies how large the chunks to load with insert_many should be
-            # It seems this number is dependent on the specs of the computer...
-            # You may need to adjust this if it doesn't run on your computer.
-            # Source: https://stackoverflow.com/a/36788489
-            num = 10000
-            for i in range(0, len(data), num):
-                subset = data[i:i+num]
-                logging.info('-> Loading entries %s through %s.',
-                             i+1,
-                             i+num if i+num < len(data) else len(data))
-                try:
-                    collection.database.insert_many(subset).execute()
-                except pw.IntegrityError as err:
-                    logging.error('peewee IntegrityError encountered: %s', err.args[0])
-                    return False
-        return True
-    except FileNotFoundError:
-        logging.error('File does not exist: %s', filename)
-        return False
+    return status_collection.search_statuses_many(status_ids)
+
+# New functions
 
 def validate_user_id(user_id):
     '''
     Validates user_id
     '''
-    # Checks if space in user_id
-    if ' ' in user_id:
-        return False
-    # Checks if user_id be converted to integer
-    try:
-        int(user_id)
-        return False
-    except ValueError:
-        return True
+    return validation.valid_user_id(user_id)
 
 def validate_email(email):
     '''
     Validates email
     '''
-    # Validates email address via regex
-    # Source: https://stackoverflow.com/a/8022584
-    regex = r"^[^\s@]+@([^\s@.,]+\.)+[^\s@.,]{2,}$"
-    if not re.match(regex, email):
-        return False
-    return True
+    return validation.valid_email(email)
 
 def validate_name(name):
     '''
     Validates user_name
     '''
-    # Check if name contains only letters
-    for chars in ['-', "'"]:
-        name = name.replace(chars, '')
-    if not name.isalpha():
-        return False
-    return True
+    return validation.valid_name(name)
 
 def validate_status_id(status_id):
     '''
     Validates status_id
     '''
-    # Check if first half is valid user_id
-    status_id = status_id.split('_')
-    # Check if more than _
-    if len(status_id) > 2 or len(status_id) == 1:
-        return False
-    # Check if first half is valid user_id
-    if not validate_user_id(status_id[0]):
-        return False
-    # Check if second half of string can be converted to int
-    try:
-        int(status_id[1])
-        return True
-    except ValueError:
-        return False
+    return validation.valid_status_id(status_id)
 
 def validate_status_text(status_text):
     '''
     Accept any text input
     '''
-    if isinstance(status_text, str):
-        return True
-    return False
+    return validation.valid_status_text(status_text)
 
-def validate_user_inputs(user_id, email, user_name, user_last_name):
+def validate_inputs(values, rules):
     '''
-    Validates all user inputs
+    Validates one set of inputs with the batch engine, logging the first
+    invalid one
     '''
-    # Validate inputs
-    if not validate_user_id(user_id):
-        logging.error('Invalid user_id: %s', user_id)
-        return False
-    if not validate_email(email):
-        logging.error('Invalid email: %s', email)
-        return False
-    if not validate_name(user_name):
-        logging.error('Invalid user_name: %s', user_name)
-        return False
-    if not validate_name(user_last_name):
-        logging.error('Invalid user_last_name: %s', user_last_name)
+    result = validation.validate_rows([values], rules)
+    if result.errors:
+        _, column = result.errors[0]
+        logging.error('Invalid %s: %s', column, values[column])
         return False
     return True
 
+def validate_user_inputs(user_id, email, user_name, user_last_name):
+    '''
+    Validates all user inputs
+    '''
+    return validate_inputs({'user_id': user_id, 'email': email,
+                            'user_name': user_name, 'user_last_name': user_last_name},
+                           {'user_id': validation.valid_user_id,
+                            'email': validation.valid_email,
+                            'user_name': validation.valid_name,
+                            'user_last_name': validation.valid_name})
+
 def validate_status_inputs(status_id, user_id, status_text):
     '''
     Validates all status inputs
     '''
-    # Validate inputs
-    if not validate_status_id(status_id):
-        logging.error('Invalid status_id: %s', status_id)
-        return False
-    if not validate_user_id(user_id):
-        logging.error('Invalid user_id: %s', user_id)
-        return False
-    if not validate_status_text(status_text):
-        logging.error('Invalid status_text: %s', status_text)
-        return False
-    return True
+    return validate_inputs({'status_id': status_id, 'user_id': user_id,
+                            'status_text': status_text},
+                           {'status_id': validation.valid_status_id,
+                            'user_id': validation.valid_user_id,
+                            'status_text': validation.valid_status_text})
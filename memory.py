@@ -0,0 +1,117 @@
+'''
+Memory accounting for bulk loads
+
+The loaders buffer parsed rows before screening and inserting them. A
+MemoryTracker counts the rows and estimated bytes a load has buffered,
+remembers the peak and, given a budget in bytes, tells the loader when
+to flush early instead of reading on.
+
+Sizes are estimates: sys.getsizeof of each row dict and its values, with
+the parsed copy of a row counted as a second dict sharing the values.
+They follow the data rather than the allocator exactly; max_rss() gives
+the process high-water mark to compare against.
+
+SOCIALNETWORK_MEMORY_BUDGET sets the default budget for loads, in bytes
+or with a K, M or G suffix (e.g. 256M); unset means no budget.
+'''
+import os
+import sys
+try:
+    import resource
+except ImportError:  # pragma: no cover (Windows)
+    resource = None
+
+UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+def parse_size(value):
+    '''
+    Parses a size such as 65536, 64K, 256M or 1GB into bytes
+
+    An empty value gives None (no budget). Raises ValueError for anything
+    else that is not a positive size.
+    '''
+    value = (value or '').strip().upper().removesuffix('B')
+    if not value:
+        return None
+    unit = UNITS.get(value[-1], 1)
+    number = float(value[:-1] if value[-1] in UNITS else value)
+    if number <= 0:
+        raise ValueError(f'Memory budget must be positive: {value}')
+    return int(number * unit)
+
+
+DEFAULT_BUDGET = parse_size(os.environ.get('SOCIALNETWORK_MEMORY_BUDGET'))
+
+
+def row_size(row):
+    '''
+    Returns the estimated bytes one buffered csv row holds
+    '''
+    return 2 * sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values())
+
+
+def max_rss():
+    '''
+    Returns the peak resident set size of this process in bytes, or None
+    where the resource module is not available (Windows)
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MemoryTracker:
+    '''
+    Counts the rows and bytes a load holds in memory
+
+    budget is the most bytes to buffer before the loader flushes, or None
+    for no limit.
+    '''
+    # pylint: disable=R0902
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.rows = 0
+        self.bytes = 0
+        self.peak_rows = 0
+        self.peak_bytes = 0
+        self.flushes = 0
+        self.early_flushes = 0
+
+    def add(self, row):
+        '''
+        Counts one more buffered row
+        '''
+        self.rows += 1
+        self.bytes += row_size(row)
+        self.peak_rows = max(self.peak_rows, self.rows)
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+
+    def full(self):
+        '''
+        Whether the buffered rows have reached the budget
+        '''
+        return self.budget is not None and self.bytes >= self.budget
+
+    def drain(self):
+        '''
+        Records that the buffered rows were written and released
+        '''
+        if self.rows:
+            self.flushes += 1
+            self.early_flushes += self.full()
+        self.rows = 0
+        self.bytes = 0
+
+    def report(self):
+        '''
+        Returns the budget, peaks and flush counts as a dict (bytes)
+        '''
+        return {'budget': self.budget,
+                'peak_rows': self.peak_rows,
+                'peak_bytes': self.peak_bytes,
+                'flushes': self.flushes,
+                'early_flushes': self.early_flushes,
+                'max_rss': max_rss()}
@@ -8,6 +8,7 @@ import sys
 import logging
 from datetime import datetime
 import main
+import profiler
 
 # Build logger
 FILE_FORMAT = "%(asctime)s %(filename)s:%(lineno)-4d %(levelname)s %(message)s"
@@ -157,6 +158,9 @@ def quit_program():
 
 
 if __name__ == '__main__':
+    # --profile writes a profile of each menu operation next to the log
+    if '--profile' in sys.argv[1:]:
+        profiler.ENABLED = True
     user_collection = main.init_user_collection()
     status_collection = main.init_status_collection()
     menu_options = {
@@ -193,7 +197,8 @@ if __name__ == '__main__':
                          '-> executing %s.',
                          user_selection,
                          menu_options[user_selection].__name__)
-            menu_options[user_selection]()
+            with profiler.maybe(menu_options[user_selection].__name__):
+                menu_options[user_selection]()
         else:
             logging.info('%s is an invalid option.', user_selection)
             logging.info("Invalid option")
@@ -0,0 +1,163 @@
+'''
+Profiling mode for the menu and the loaders
+
+profile(name) runs a block under cProfile and tracemalloc and writes two
+files next to the log file (the directory of the first logging
+FileHandler, else the working directory):
+
+    profile_<date>_<time>_<name>.pstats   for pstats / snakeviz
+    profile_<date>_<time>_<name>.txt      a short summary: wall time, peak
+                                          traced memory, time per component
+                                          and the hottest functions
+
+Components split the time between CSV/NDJSON parsing, the validators,
+peewee query building and SQLite itself, which is usually the question
+when a load is slow.
+
+Setting SOCIALNETWORK_PROFILE=1 (or menu.py --profile) turns on maybe(),
+which main wraps around each load. Profiles do not nest: a block started
+while another one is running is not profiled separately.
+'''
+import io
+import os
+import time
+import pstats
+import logging
+import cProfile
+import tracemalloc
+import contextlib
+from datetime import datetime
+
+ENABLED = os.environ.get('SOCIALNETWORK_PROFILE') == '1'
+# Functions listed in the summary
+TOP = 25
+# (component, test on a pstats (filename, line, function) key), first match wins
+COMPONENTS = [
+    ('sqlite', lambda filename, function: 'sqlite3.' in function),
+    ('peewee', lambda filename, function: (os.path.basename(filename) == 'peewee.py'
+                                           or 'playhouse' in filename)),
+    ('validation', lambda filename, function: os.path.basename(filename) == 'validation.py'),
+    ('parsing', lambda filename, function: (
+        os.path.basename(filename) in ('csv.py', 'readers.py', 'gzip.py', 'bz2.py', 'lzma.py')
+        or 'json' in filename or '_csv.' in function or '_json.' in function)),
+]
+_active = []
+
+
+class ProfileResult:  # pylint: disable=R0903
+    '''
+    What a profile() block measured; filled in when the block exits
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.seconds = None
+        self.peak_memory = None
+        self.components = {}
+        self.stats_file = None
+        self.summary_file = None
+
+
+def log_directory():
+    '''
+    Returns the directory of the log file, or the working directory
+    '''
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler):
+            return os.path.dirname(handler.baseFilename)
+    return os.getcwd()
+
+
+def component(key):
+    '''
+    Returns the component a pstats function key belongs to
+    '''
+    filename, _, function = key
+    for name, test in COMPONENTS:
+        if test(filename, function):
+            return name
+    return 'other'
+
+
+def component_times(stats):
+    '''
+    Returns {component: seconds spent in its own code} from pstats.Stats
+    '''
+    times = dict.fromkeys([name for name, _ in COMPONENTS] + ['other'], 0.0)
+    for key, (_, _, own_time, _, _) in stats.stats.items():
+        times[component(key)] += own_time
+    return times
+
+
+def write_summary(file, result, stats, top):
+    '''
+    Writes the text summary of a profile to file
+    '''
+    file.write(f'{result.name}: {result.seconds:.3f}s wall, '
+               f'peak traced memory {result.peak_memory / 2**20:.1f} MiB\n\n')
+    total = sum(result.components.values()) or 1
+    file.write('Time by component (own time):\n')
+    for name, seconds in sorted(result.components.items(), key=lambda item: -item[1]):
+        file.write(f'  {name:<12}{seconds:>9.3f}s {seconds / total:>6.1%}\n')
+    file.write(f'\nTop {top} functions by own time:\n')
+    stats.stream = file
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+    file.write(f'Top {top} functions by cumulative time:\n')
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+
+
+@contextlib.contextmanager
+def profile(name, directory=None, top=TOP):
+    '''
+    Profiles the block; yields a ProfileResult filled in on exit
+
+    directory defaults to log_directory().
+    '''
+    result = ProfileResult(name)
+    if _active:
+        yield result
+        return
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    _active.append(profiler)
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield result
+    finally:
+        profiler.disable()
+        result.seconds = time.perf_counter() - start
+        result.peak_memory = tracemalloc.get_traced_memory()[1]
+        if not tracing:
+            tracemalloc.stop()
+        _active.pop()
+        save(result, profiler, directory or log_directory(), top)
+
+
+def save(result, profiler, directory, top):
+    '''
+    Writes the pstats and summary files of a finished profile
+    '''
+    stem = os.path.join(directory, f'profile_{datetime.today():%d-%m-%Y_%H%M%S}_'
+                                   f'{"".join(c if c.isalnum() else "_" for c in result.name)}')
+    result.stats_file = stem + '.pstats'
+    result.summary_file = stem + '.txt'
+    profiler.dump_stats(result.stats_file)
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    result.components = component_times(stats)
+    stats.strip_dirs()
+    with open(result.summary_file, 'w', encoding='utf-8') as file:
+        write_summary(file, result, stats, top)
+    logging.info('Profiled %s: %.3fs, peak memory %.1f MiB, written to %s.',
+                 result.name, result.seconds, result.peak_memory / 2**20, result.summary_file)
+
+
+def maybe(name):
+    '''
+    Returns profile(name) when profiling is enabled, else a no-op context
+    '''
+    if ENABLED:
+        return profile(name)
+    return contextlib.nullcontext(None)
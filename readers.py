@@ -0,0 +1,239 @@
+'''
+Input formats and compression codecs for the loaders
+
+open_rows(filename) returns a csv.DictReader-like object (fieldnames,
+line_num, iteration over dict rows) for any supported file. The codec is
+chosen by the last extension (.gz, .bz2, .xz/.lzma and .zst when the
+zstandard package is installed) and the format by the one before it
+(.csv, or .ndjson/.jsonl for one JSON object per line); anything else is
+read as CSV.
+
+Compressed files are decompressed by a background thread a few blocks
+ahead of the parser. zlib, bz2 and lzma release the GIL while they work,
+so decompression overlaps with parsing and nothing is written to disk.
+
+New codecs and formats are added with register_codec / register_format.
+'''
+import io
+import os
+import csv
+import bz2
+import gzip
+import lzma
+import json
+import queue
+import threading
+import contextlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = {}
+FORMATS = {}
+# Bytes per decompressed block and blocks buffered by the readahead thread
+BLOCK_SIZE = 1 << 20
+READAHEAD = 4
+
+
+class UnsupportedInput(ValueError):
+    '''
+    Raised for a file whose codec cannot be read here
+    '''
+
+
+def register_codec(extension, opener):
+    '''
+    Registers opener(filename) -> binary file object for extension
+    '''
+    CODECS[extension] = opener
+
+
+def register_format(extension, reader):
+    '''
+    Registers reader(text_file) -> DictReader-like object for extension
+    '''
+    FORMATS[extension] = reader
+
+
+def open_zstd(filename):
+    '''
+    Opens a zstandard compressed file for reading
+    '''
+    if zstandard is None:
+        raise UnsupportedInput(f'{filename}: install zstandard to read .zst files')
+    return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'),  # pylint: disable=R1732
+                                                      closefd=True)
+
+
+class RowError(str):
+    '''
+    Why a reader could not turn a line into a row
+
+    Stored under the None key of the row, where csv.DictReader keeps
+    surplus values, so the loaders reject the row with this reason.
+    '''
+
+
+class JsonLinesReader:
+    '''
+    Reads newline-delimited JSON objects like csv.DictReader reads rows
+
+    fieldnames are the keys of the first object. Values are passed on as
+    strings (None for null or a missing key) so the csv validators apply
+    unchanged. Blank lines are skipped; a line that is not a JSON object
+    gives a row holding only a RowError, which the loaders reject.
+    '''
+    def __init__(self, file):
+        self.file = file
+        self.line_num = 0
+        self.fieldnames = None
+        self._first = self._next_object()
+        if self._first is not None:
+            self.fieldnames = list(self._first)
+
+    def _next_object(self):
+        for line in self.file:
+            self.line_num += 1
+            if not line.strip():
+                continue
+            try:
+                value = json.loads(line)
+            except ValueError:
+                return {None: RowError('Invalid JSON')}
+            return value if isinstance(value, dict) else {None: RowError('Not a JSON object')}
+        return None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._first is not None:
+            row, self._first = self._first, None
+        else:
+            row = self._next_object()
+        if row is None:
+            raise StopIteration
+        if None in row:
+            return row
+        new_row = {key: None for key in self.fieldnames}
+        for key, value in row.items():
+            new_row[key] = value if value is None or isinstance(value, str) else str(value)
+        return new_row
+
+
+class ReadaheadStream(io.RawIOBase):
+    '''
+    Reads a binary stream in a background thread, blocks ahead of the
+    consumer
+
+    Exceptions raised while reading are re-raised to the consumer.
+    '''
+    def __init__(self, raw, block_size=BLOCK_SIZE, depth=READAHEAD):
+        super().__init__()
+        self.raw = raw
+        self.block_size = block_size
+        self._blocks = queue.Queue(maxsize=depth)
+        self._stopped = threading.Event()
+        self._block = memoryview(b'')
+        self._thread = threading.Thread(target=self._fill, name='readahead', daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        while not self._stopped.is_set():
+            try:
+                block = self.raw.read(self.block_size)
+            except Exception as err:  # pylint: disable=W0718
+                block = err
+            while not self._stopped.is_set():
+                try:
+                    self._blocks.put(block, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if not block or isinstance(block, Exception):
+                return
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._block:
+            block = self._blocks.get()
+            if not block or isinstance(block, Exception):
+                # Leave the end marker for any later read
+                self._blocks.put(block)
+                if block:
+                    raise block
+                return 0
+            self._block = memoryview(block)
+        size = min(len(buffer), len(self._block))
+        buffer[:size] = self._block[:size]
+        self._block = self._block[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stopped.set()
+            self._thread.join()
+            self.raw.close()
+        super().close()
+
+
+def split_extensions(filename):
+    '''
+    Returns (codec, format) extensions of filename; either may be ''
+    '''
+    root, extension = os.path.splitext(filename.lower())
+    codec = ''
+    if extension in CODECS:
+        codec = extension
+        root, extension = os.path.splitext(root)
+    return codec, extension if extension in FORMATS else ''
+
+
+def base_name(filename):
+    '''
+    Returns filename without its codec extension and the extension
+    before it
+    '''
+    codec, _ = split_extensions(filename)
+    return os.path.splitext(filename[:len(filename) - len(codec)])[0]
+
+
+def is_supported(filename):
+    '''
+    Returns True if filename has a known format or codec extension
+    '''
+    return any(split_extensions(filename))
+
+
+@contextlib.contextmanager
+def open_rows(filename, readahead=True):
+    '''
+    Opens filename and yields a DictReader-like reader over its rows
+
+    Raises FileNotFoundError for a missing file and UnsupportedInput for a
+    codec that is not available.
+    '''
+    codec, extension = split_extensions(filename)
+    if codec:
+        binary = CODECS[codec](filename)
+        if readahead:
+            binary = ReadaheadStream(binary)
+        file = io.TextIOWrapper(io.BufferedReader(binary, BLOCK_SIZE),
+                                encoding='utf-8', newline='')
+    else:
+        file = open(filename, 'r', encoding='utf-8', newline='')  # pylint: disable=R1732
+    with file:
+        yield FORMATS.get(extension, csv.DictReader)(file)
+
+
+register_codec('.gz', gzip.open)
+register_codec('.bz2', bz2.open)
+register_codec('.xz', lzma.open)
+register_codec('.lzma', lzma.open)
+register_codec('.zst', open_zstd)
+register_format('.csv', csv.DictReader)
+register_format('.ndjson', JsonLinesReader)
+register_format('.jsonl', JsonLinesReader)
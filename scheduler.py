@@ -0,0 +1,224 @@
+'''
+Priority write scheduling between bulk loads and interactive operations
+
+SQLite allows one writer at a time, and a long load transaction makes
+every other connection wait for its lock. With a WriteScheduler attached
+to the collections (see RoutedCollection.use_scheduler), loads write in
+short slices, each its own transaction taken as a "bulk turn", and
+single-record operations (marked with @prioritized) take "priority turns":
+
+- a priority turn starts as soon as no bulk slice is running, and bulk
+  slices do not start while priority operations run or wait, so an
+  interactive call waits for at most one slice;
+- slices are sized from the measured insert rate so each takes about
+  bulk_target seconds;
+- a bulk writer that has waited max_bulk_delay seconds holds back new
+  priority operations until it gets its turn, so loads still progress
+  under constant interactive traffic.
+
+Several bulk slices may run at once (one per shard). Queue waits are
+recorded per class and reported by metrics(). The scheduler orders
+writers within one process only.
+'''
+import time
+import functools
+import threading
+import contextlib
+import collections
+
+INTERACTIVE_TARGET = 0.05
+BULK_TARGET = 0.05
+MAX_BULK_DELAY = 1.0
+INITIAL_ROWS = 500
+MINIMUM_ROWS = 16
+# Waits kept per class for the percentiles in metrics()
+WINDOW = 1000
+
+
+class WaitStats:
+    '''
+    Queue wait times of one class of operations
+    '''
+    def __init__(self, target):
+        self.target = target
+        self.count = 0
+        self.total = 0.0
+        self.longest = 0.0
+        self.missed = 0
+        self.recent = collections.deque(maxlen=WINDOW)
+
+    def record(self, seconds):
+        '''
+        Adds one wait
+        '''
+        self.count += 1
+        self.total += seconds
+        self.longest = max(self.longest, seconds)
+        self.missed += seconds > self.target
+        self.recent.append(seconds)
+
+    def report(self):
+        '''
+        Returns the stats as a dict (seconds)
+        '''
+        recent = sorted(self.recent)
+
+        def percentile(percent):
+            if not recent:
+                return 0.0
+            return recent[min(len(recent) - 1, int(percent / 100 * len(recent)))]
+        return {'count': self.count,
+                'mean_wait': self.total / self.count if self.count else 0.0,
+                'p50_wait': percentile(50),
+                'p99_wait': percentile(99),
+                'max_wait': self.longest,
+                'target': self.target,
+                'missed_target': self.missed}
+
+
+class WriteScheduler:  # pylint: disable=R0902
+    '''
+    Gives single-record operations priority over bulk load slices
+
+    interactive_target is the queue wait priority operations should stay
+    under (waits above it are counted as misses) and bulk_target the
+    duration of one bulk slice.
+    '''
+    def __init__(self, interactive_target=INTERACTIVE_TARGET, bulk_target=BULK_TARGET,
+                 max_bulk_delay=MAX_BULK_DELAY):
+        self.bulk_target = bulk_target
+        self.max_bulk_delay = max_bulk_delay
+        self.waits = {'interactive': WaitStats(interactive_target),
+                      'bulk': WaitStats(max_bulk_delay)}
+        self.rows_per_second = None
+        self.slices = 0
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self._priority_running = 0
+        self._priority_waiting = 0
+        self._bulk_running = 0
+        self._bulk_starving = 0
+
+    def priority(self):
+        '''
+        Context manager for one interactive operation
+        '''
+        return self._turn(self._enter_priority, self._exit_priority)
+
+    def bulk(self):
+        '''
+        Context manager for one bulk slice
+        '''
+        return self._turn(self._enter_bulk, self._exit_bulk)
+
+    @contextlib.contextmanager
+    def _turn(self, enter, leave):
+        # Turns nest: a thread already holding one (say a group commit
+        # flush running several operations) keeps it
+        outermost = not getattr(self._local, 'depth', 0)
+        if outermost:
+            enter()
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        try:
+            yield
+        finally:
+            self._local.depth -= 1
+            if outermost:
+                leave()
+
+    def _enter_priority(self):
+        start = time.perf_counter()
+        with self._condition:
+            self._priority_waiting += 1
+            while self._bulk_running or self._bulk_starving:
+                self._condition.wait()
+            self._priority_waiting -= 1
+            self._priority_running += 1
+            self.waits['interactive'].record(time.perf_counter() - start)
+
+    def _exit_priority(self):
+        with self._condition:
+            self._priority_running -= 1
+            self._condition.notify_all()
+
+    def _enter_bulk(self):
+        start = time.perf_counter()
+        deadline = start + self.max_bulk_delay
+        starving = False
+        with self._condition:
+            while self._priority_running or (self._priority_waiting and not starving):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 and not starving:
+                    starving = True
+                    self._bulk_starving += 1
+                    continue
+                self._condition.wait(None if starving else remaining)
+            if starving:
+                self._bulk_starving -= 1
+            self._bulk_running += 1
+            self.waits['bulk'].record(time.perf_counter() - start)
+
+    def _exit_bulk(self):
+        with self._condition:
+            self._bulk_running -= 1
+            self._condition.notify_all()
+
+    def slice_rows(self, limit=None):
+        '''
+        Rows a bulk slice should write to take about bulk_target seconds
+        '''
+        if self.rows_per_second is None:
+            rows = INITIAL_ROWS
+        else:
+            rows = max(MINIMUM_ROWS, int(self.rows_per_second * self.bulk_target))
+        return rows if limit is None else min(rows, limit)
+
+    def record_slice(self, rows, seconds):
+        '''
+        Updates the insert rate estimate from one slice
+        '''
+        self.slices += 1
+        rate = rows / max(seconds, 1e-6)
+        if self.rows_per_second is None:
+            self.rows_per_second = rate
+        else:
+            self.rows_per_second = 0.7 * self.rows_per_second + 0.3 * rate
+
+    def bulk_slices(self, items):
+        '''
+        Yields consecutive slices of items, each inside its own bulk turn
+
+        The caller writes (and commits) each slice before asking for the
+        next; slice sizes follow the measured rate.
+        '''
+        position = 0
+        while position < len(items):
+            part = items[position:position + self.slice_rows()]
+            with self.bulk():
+                start = time.perf_counter()
+                yield part
+                self.record_slice(len(part), time.perf_counter() - start)
+            position += len(part)
+
+    def metrics(self):
+        '''
+        Returns queue wait stats per class plus the bulk slice size
+        '''
+        with self._condition:
+            report = {name: stats.report() for name, stats in self.waits.items()}
+        report['bulk'].update(slices=self.slices, slice_rows=self.slice_rows())
+        return report
+
+
+def prioritized(method):
+    '''
+    Marks a collection method as an interactive operation that takes a
+    priority turn from the collection's scheduler, when it has one
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.scheduler is None:
+            return method(self, *args, **kwargs)
+        with self.scheduler.priority():
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,539 @@
+'''
+HTTP/JSON front end for the social network
+
+Usage:
+    python service.py [--host HOST] [--port PORT] [--database FILE]
+                      [--shards FILE ...] [--group-commit]
+
+Serves the main operations to other processes:
+
+    GET    /users/<user_id>                 user record
+    POST   /users                           add a user (JSON record)
+    PUT    /users/<user_id>                 update a user
+    DELETE /users/<user_id>                 delete a user
+    POST   /users/batch                     {"users": [record, ...]}
+    POST   /users/search                    {"user_ids": [user_id, ...]}
+    GET    /users/<user_id>/status_count
+    GET    /statuses/<status_id>            status record
+    POST   /statuses                        add a status; status_id may be
+                                            left out to have one allocated
+    PUT    /statuses/<status_id>            update a status
+    DELETE /statuses/<status_id>            delete a status
+    POST   /statuses/batch                  {"statuses": [record, ...]}
+    POST   /statuses/search                 {"status_ids": [status_id, ...]}
+    GET    /top_posters?count=N
+    GET    /changes?seq=N&limit=N&shard=N
+    GET    /storage
+
+Records use the field names of the models (user_id, user_email,
+user_name, user_last_name; status_id, user_id, status_text). Writes answer
+{"ok": true} (200) or {"ok": false} (409); lookups answer the record or 404.
+
+Each connection is served by its own thread, which opens its own database
+connection (peewee keeps one per thread) and closes it when the client
+disconnects. Connections are kept alive between requests (HTTP/1.1). Batch
+writes run in one transaction per database unless group commit is on, in
+which case the group committer batches writes from all connections.
+'''
+import re
+import json
+import socket
+import logging
+import argparse
+import contextlib
+from concurrent.futures import Future
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import peewee as pw
+import main
+import sharding
+import slowlog
+import socialnetwork_model as sm
+
+# Largest request body accepted, in bytes
+MAX_BODY = 16 << 20
+USER_FIELDS = ('user_id', 'user_email', 'user_name', 'user_last_name')
+STATUS_FIELDS = ('status_id', 'user_id', 'status_text')
+
+
+class RequestError(Exception):
+    '''
+    Raised for a request that cannot be served; carries the HTTP status
+    '''
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def user_record(user):
+    '''
+    Returns the JSON record of a user model instance
+    '''
+    return {field: getattr(user, field) for field in USER_FIELDS}
+
+
+def status_record(status):
+    '''
+    Returns the JSON record of a status model instance
+    '''
+    return {'status_id': status.status_id,
+            'user_id': status.user_id,
+            'status_text': status.status_text}
+
+
+def resolve(result):
+    '''
+    Waits for a write queued by group commit; other results pass through
+    '''
+    return result.result() if isinstance(result, Future) else result
+
+
+class SocialNetworkServer(ThreadingHTTPServer):
+    '''
+    Threaded HTTP server over a user and a status collection
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, user_collection, status_collection):
+        self.user_collection = user_collection
+        self.status_collection = status_collection
+        super().__init__(address, RequestHandler)
+
+    def databases(self):
+        '''
+        Returns every database the collections use
+        '''
+        return list(dict.fromkeys(self.user_collection.databases() +
+                                  self.status_collection.databases()))
+
+    @contextlib.contextmanager
+    def batch(self, collection):
+        '''
+        Runs a batch of writes in one transaction per database
+
+        With group commit on, the committer does the batching instead.
+        '''
+        if collection.committer is not None:
+            yield
+            return
+        with contextlib.ExitStack() as transaction:
+            for database in collection.databases():
+                transaction.enter_context(collection.write_db(database).atomic())
+            yield
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''
+    Routes requests to the main functions
+    '''
+    protocol_version = 'HTTP/1.1'
+    routes = []
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out in separate writes; without this Nagle's
+        # algorithm holds the body back until the client's delayed ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):  # pylint: disable=C0103
+        '''
+        Serves a GET request
+        '''
+        self.dispatch('GET')
+
+    def do_POST(self):  # pylint: disable=C0103
+        '''
+        Serves a POST request
+        '''
+        self.dispatch('POST')
+
+    def do_PUT(self):  # pylint: disable=C0103
+        '''
+        Serves a PUT request
+        '''
+        self.dispatch('PUT')
+
+    def do_DELETE(self):  # pylint: disable=C0103
+        '''
+        Serves a DELETE request
+        '''
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        '''
+        Finds the route for the request, runs it and sends its JSON answer
+        '''
+        url = urlsplit(self.path)
+        try:
+            body = self.read_body()
+            for route_method, pattern, handler in self.routes:
+                match = pattern.fullmatch(url.path)
+                if match and route_method == method:
+                    query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                    status, answer = handler(self, body, query, *match.groups())
+                    break
+            else:
+                raise RequestError(HTTPStatus.NOT_FOUND, f'No route for {method} {url.path}')
+        except RequestError as err:
+            status, answer = err.status, {'error': str(err)}
+        except pw.PeeweeException as err:
+            logging.error('Request %s %s failed: %s', method, self.path, err)
+            status, answer = HTTPStatus.SERVICE_UNAVAILABLE, {'error': str(err)}
+        except Exception as err:  # pylint: disable=W0718
+            # Anything else is a bug, but the client still gets an answer
+            # and the connection stays usable
+            logging.exception('Request %s %s failed', method, self.path)
+            status, answer = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(err)}
+        self.send_json(status, answer)
+
+    def read_body(self):
+        '''
+        Returns the decoded JSON body of the request, or None without one
+        '''
+        header = self.headers.get('Content-Length') or '0'
+        try:
+            length = int(header)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # Without a usable length the rest of the stream can't be framed
+            self.close_connection = True
+            raise RequestError(HTTPStatus.BAD_REQUEST, f'Invalid Content-Length: {header}')
+        if length > MAX_BODY:
+            self.close_connection = True
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'Request body too large')
+        if not length:
+            return None
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError as err:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f'Invalid JSON: {err}') from err
+
+    def send_json(self, status, answer):
+        '''
+        Sends answer as a JSON response
+        '''
+        data = json.dumps(answer).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def finish(self):
+        '''
+        Closes this thread's database connections once the client is done
+        '''
+        super().finish()
+        for database in self.server.databases():
+            database.close()
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        logging.debug('%s %s', self.address_string(), format % args)
+
+
+def route(method, path):
+    '''
+    Registers the decorated function for method and the path pattern
+    '''
+    def register(handler):
+        RequestHandler.routes.append((method, re.compile(path), handler))
+        return handler
+    return register
+
+
+def fields(record, names):
+    '''
+    Returns the values of names from a JSON record
+    '''
+    if not isinstance(record, dict):
+        raise RequestError(HTTPStatus.BAD_REQUEST, 'Expected a JSON object')
+    return [record.get(name) for name in names]
+
+
+def id_list(body, key):
+    '''
+    Returns the list body[key] of a batch request
+    '''
+    if not isinstance(body, dict) or not isinstance(body.get(key), list):
+        raise RequestError(HTTPStatus.BAD_REQUEST, f'Expected {{"{key}": [...]}}')
+    return body[key]
+
+
+def key_list(body, key):
+    '''
+    Returns the list of string keys body[key] of a search request
+    '''
+    keys = id_list(body, key)
+    if not all(isinstance(value, str) for value in keys):
+        raise RequestError(HTTPStatus.BAD_REQUEST, f'Expected strings in "{key}"')
+    return keys
+
+
+def write_answer(result):
+    '''
+    Returns the (status, answer) of a write's result
+    '''
+    result = resolve(result)
+    if isinstance(result, str):
+        return HTTPStatus.OK, {'ok': True, 'status_id': result}
+    return (HTTPStatus.OK if result else HTTPStatus.CONFLICT), {'ok': bool(result)}
+
+
+def found(record):
+    '''
+    Returns the (status, answer) of a lookup
+    '''
+    if record is None:
+        raise RequestError(HTTPStatus.NOT_FOUND, 'Not found')
+    return HTTPStatus.OK, record
+
+
+def add_user(server, record):
+    '''
+    Adds a user from its JSON record
+    '''
+    user_id, email, user_name, user_last_name = fields(record, USER_FIELDS)
+    return main.add_user(user_id, email, user_name, user_last_name, server.user_collection)
+
+
+def add_status(server, record):
+    '''
+    Adds a status from its JSON record
+    '''
+    status_id, user_id, status_text = fields(record, STATUS_FIELDS)
+    return main.add_status(user_id, status_id, status_text, server.status_collection)
+
+
+@route('GET', r'/users/([^/]+)')
+def get_user(handler, _body, _query, user_id):
+    '''
+    Looks up a user
+    '''
+    user = main.search_user(user_id, handler.server.user_collection)
+    return found(user and user_record(user))
+
+
+@route('POST', r'/users')
+def post_user(handler, body, _query):
+    '''
+    Adds a user
+    '''
+    return write_answer(add_user(handler.server, body))
+
+
+@route('PUT', r'/users/([^/]+)')
+def put_user(handler, body, _query, user_id):
+    '''
+    Updates a user
+    '''
+    _, email, user_name, user_last_name = fields(body, USER_FIELDS)
+    return write_answer(main.update_user(user_id, email, user_name, user_last_name,
+                                         handler.server.user_collection))
+
+
+@route('DELETE', r'/users/([^/]+)')
+def delete_user(handler, _body, _query, user_id):
+    '''
+    Deletes a user
+    '''
+    return write_answer(main.delete_user(user_id, handler.server.user_collection))
+
+
+@route('POST', r'/users/batch')
+def post_users(handler, body, _query):
+    '''
+    Adds several users; answers one result per record
+    '''
+    records = id_list(body, 'users')
+    with handler.server.batch(handler.server.user_collection):
+        results = [add_user(handler.server, record) for record in records]
+    return HTTPStatus.OK, {'ok': [bool(resolve(result)) for result in results]}
+
+
+@route('POST', r'/users/search')
+def search_users(handler, body, _query):
+    '''
+    Looks up several users; unknown ones map to null
+    '''
+    user_ids = key_list(body, 'user_ids')
+    users, _ = main.search_users_many(user_ids, handler.server.user_collection)
+    answer = {user_id: user_record(users[user_id]) if user_id in users else None
+              for user_id in user_ids}
+    return HTTPStatus.OK, {'users': answer}
+
+
+@route('GET', r'/users/([^/]+)/status_count')
+def get_status_count(handler, _body, _query, user_id):
+    '''
+    Counts a user's statuses
+    '''
+    return HTTPStatus.OK, {'user_id': user_id,
+                           'count': main.status_count(user_id,
+                                                      handler.server.status_collection)}
+
+
+@route('GET', r'/statuses/([^/]+)')
+def get_status(handler, _body, _query, status_id):
+    '''
+    Looks up a status
+    '''
+    status = main.search_status(status_id, handler.server.status_collection)
+    return found(status and status_record(status))
+
+
+@route('POST', r'/statuses')
+def post_status(handler, body, _query):
+    '''
+    Adds a status
+    '''
+    return write_answer(add_status(handler.server, body))
+
+
+@route('PUT', r'/statuses/([^/]+)')
+def put_status(handler, body, _query, status_id):
+    '''
+    Updates a status
+    '''
+    _, user_id, status_text = fields(body, STATUS_FIELDS)
+    return write_answer(main.update_status(status_id, user_id, status_text,
+                                           handler.server.status_collection))
+
+
+@route('DELETE', r'/statuses/([^/]+)')
+def delete_status(handler, _body, _query, status_id):
+    '''
+    Deletes a status
+    '''
+    return write_answer(main.delete_status(status_id, handler.server.status_collection))
+
+
+@route('POST', r'/statuses/batch')
+def post_statuses(handler, body, _query):
+    '''
+    Adds several statuses; answers one result per record
+    '''
+    records = id_list(body, 'statuses')
+    with handler.server.batch(handler.server.status_collection):
+        results = [add_status(handler.server, record) for record in records]
+    return HTTPStatus.OK, {'ok': [resolve(result) for result in results]}
+
+
+@route('POST', r'/statuses/search')
+def search_statuses(handler, body, _query):
+    '''
+    Looks up several statuses; unknown ones map to null
+    '''
+    status_ids = key_list(body, 'status_ids')
+    statuses, _ = main.search_statuses_many(status_ids, handler.server.status_collection)
+    answer = {status_id: status_record(statuses[status_id]) if status_id in statuses else None
+              for status_id in status_ids}
+    return HTTPStatus.OK, {'statuses': answer}
+
+
+def int_param(query, name, default):
+    '''
+    Returns an integer query parameter
+    '''
+    try:
+        return int(query.get(name, default))
+    except ValueError as err:
+        raise RequestError(HTTPStatus.BAD_REQUEST, f'{name} must be an integer') from err
+
+
+@route('GET', r'/top_posters')
+def get_top_posters(handler, _body, query):
+    '''
+    Lists the users with the most statuses
+    '''
+    posters = main.top_posters(int_param(query, 'count', 10), handler.server.status_collection)
+    return HTTPStatus.OK, {'top_posters': [list(poster) for poster in posters]}
+
+
+@route('GET', r'/changes')
+def get_changes(handler, _body, query):
+    '''
+    Pages through the change log of one database
+    '''
+    shard = int_param(query, 'shard', 0)
+    if not 0 <= shard < len(handler.server.user_collection.databases()):
+        raise RequestError(HTTPStatus.BAD_REQUEST, f'No shard {shard}')
+    changes = main.changes_since(handler.server.user_collection,
+                                 int_param(query, 'seq', 0),
+                                 int_param(query, 'limit', 1000),
+                                 shard)
+    return HTTPStatus.OK, {'changes': list(changes)}
+
+
+@route('GET', r'/storage')
+def get_storage(handler, _body, _query):
+    '''
+    Reports the storage statistics of every database
+    '''
+    return HTTPStatus.OK, {'storage': main.storage_stats(handler.server.user_collection)}
+
+
+def make_server(address, database=None, shards=None, group_commit=False):
+    '''
+    Creates a server over a database file or a list of shard files
+
+    database None (and no shards) uses the default database.
+    '''
+    shard_set = sharding.ShardSet(shards) if shards else None
+    db = None
+    if database is not None and shard_set is None:
+        db = slowlog.SlowQueryDatabase(database, pragmas=sm.PRAGMAS)
+        sm.create_tables(sm.MODELS, db)
+    user_collection = main.init_user_collection(shards=shard_set, db=db)
+    status_collection = main.init_status_collection(shards=shard_set, db=db)
+    if group_commit:
+        # One committer serves both collections so their writes share batches
+        status_collection.committer = main.start_group_commit(user_collection)
+    return SocialNetworkServer(address, user_collection, status_collection)
+
+
+def close_server(server):
+    '''
+    Stops group commit and closes the server's socket
+    '''
+    server.status_collection.committer = None
+    server.user_collection.stop_group_commit()
+    server.server_close()
+
+
+def parse_args(argv=None):
+    '''
+    Parses the command line
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--database', help='database file (default: the model default)')
+    parser.add_argument('--shards', nargs='+', help='shard database files')
+    parser.add_argument('--group-commit', action='store_true',
+                        help='commit single-record writes in groups')
+    return parser.parse_args(argv)
+
+
+def serve(argv=None):
+    '''
+    Runs the service until interrupted
+    '''
+    args = parse_args(argv)
+    server = make_server((args.host, args.port), args.database, args.shards,
+                         args.group_commit)
+    logging.info('Serving on %s:%s.', *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_server(server)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    serve()
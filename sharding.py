@@ -0,0 +1,94 @@
+'''
+Hash-sharded storage across several SQLite database files
+
+A ShardSet spreads users over N database files by a hash of user_id. A
+user's statuses live in the same file as the user (the owner is the part
+of status_id before the last underscore), so foreign keys and cascading
+deletes keep working inside each shard. Collections created with
+shards=ShardSet(...) route every operation to the right file (see
+collection.RoutedCollection), and bulk loads write each shard's rows in
+parallel.
+'''
+import zlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import socialnetwork_model as sm
+import slowlog
+
+
+def status_owner(status_id):
+    '''
+    Returns the user_id part of a status_id
+    '''
+    return status_id.rsplit('_', 1)[0]
+
+
+class ShardSet:
+    '''
+    Routes user_ids to one of several SQLite databases
+    '''
+
+    def __init__(self, paths, models=None):
+        self.paths = list(paths)
+        self.models = models or sm.MODELS
+        self.databases = [slowlog.SlowQueryDatabase(path, pragmas=sm.PRAGMAS)
+                          for path in self.paths]
+        for database in self.databases:
+            sm.create_tables(self.models, database)
+        self._executor = None
+        logging.info('Opened %s shards.', len(self.databases))
+
+    def __len__(self):
+        return len(self.databases)
+
+    def index_for(self, user_id):
+        '''
+        Returns the shard number holding user_id
+
+        Uses crc32 so the mapping is stable between processes.
+        '''
+        return zlib.crc32(user_id.encode('utf-8')) % len(self.databases)
+
+    def database_for(self, user_id):
+        '''
+        Returns the database holding user_id
+        '''
+        return self.databases[self.index_for(user_id)]
+
+    def partition(self, items, user_id_of):
+        '''
+        Groups items by shard
+
+        Returns a dict of database -> list of items, where user_id_of(item)
+        gives the user_id used for routing.
+        '''
+        parts = {}
+        for item in items:
+            parts.setdefault(self.database_for(user_id_of(item)), []).append(item)
+        return parts
+
+    def map(self, function, parts):
+        '''
+        Calls function(database, items) for each shard's part in parallel
+
+        Each shard is written by its own thread and connection, so bulk
+        writes scale with the number of shards. Returns the results in the
+        order of parts.
+        '''
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=len(self.databases),
+                                                thread_name_prefix='shard-writer')
+        futures = [self._executor.submit(function, database, items)
+                   for database, items in parts.items()]
+        return [future.result() for future in futures]
+
+    def close(self):
+        '''
+        Stops the writer threads and closes every shard
+        '''
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for database in self.databases:
+            database.execute_sql('PRAGMA optimize')
+            database.close()
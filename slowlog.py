@@ -0,0 +1,209 @@
+'''
+Slow-query log with captured query plans
+
+SlowQueryDatabase is the SqliteDatabase used for the social network
+files. Every statement taking at least the log's threshold is recorded
+with its SQL, redacted parameters, duration and EXPLAIN QUERY PLAN, in
+memory (recent() and summary()) and as JSON lines in a rotating file
+(read_log()). Plans that scan a whole table or sort in a temporary
+b-tree are flagged, so a query that lost its index stands out.
+
+SOCIALNETWORK_SLOW_QUERY_MS sets the threshold in milliseconds (default
+100, 0 records everything, "off" disables the log) and
+SOCIALNETWORK_SLOW_QUERY_LOG the file (default slow_queries.log). For a
+SELECT the duration covers executing up to the first row; later rows are
+fetched lazily as they are read.
+'''
+import os
+import json
+import time
+import sqlite3
+import logging
+import logging.handlers
+import threading
+import collections
+import peewee as pw
+
+THRESHOLD_MS = os.environ.get('SOCIALNETWORK_SLOW_QUERY_MS', '100')
+LOG_FILE = os.environ.get('SOCIALNETWORK_SLOW_QUERY_LOG', 'slow_queries.log')
+MAX_BYTES = 1 << 20
+BACKUPS = 3
+# Entries kept in memory for recent() and summary()
+RECENT = 1000
+# Statements worth explaining
+EXPLAINED = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+
+def redact(params):
+    '''
+    Returns params with text and blobs replaced by their type and length
+
+    Numbers and NULLs are kept; they are what plans depend on least and
+    help when reading the log.
+    '''
+    redacted = []
+    for value in params or ():
+        if isinstance(value, str):
+            redacted.append(f'<str:{len(value)}>')
+        elif isinstance(value, (bytes, memoryview)):
+            redacted.append(f'<blob:{len(value)}>')
+        else:
+            redacted.append(value)
+    return redacted
+
+
+def plan_problems(plan):
+    '''
+    Returns the plan steps that scan a whole table or sort in a temporary
+    b-tree
+    '''
+    return [detail for detail in plan
+            if (detail.startswith('SCAN ') and ' USING ' not in detail)
+            or detail.startswith('USE TEMP B-TREE')]
+
+
+class SlowQueryLog:
+    '''
+    Collects statements slower than threshold seconds (None disables)
+
+    path is the rotating JSON lines file, or None to keep entries in
+    memory only.
+    '''
+    def __init__(self, threshold=0.1, path=LOG_FILE, max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.threshold = threshold
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.entries = collections.deque(maxlen=RECENT)
+        self._lock = threading.Lock()
+        self._logger = None
+
+    def logger(self):
+        '''
+        Returns the logger writing to the rotating file, created on first
+        use so no file appears until something is slow
+        '''
+        if self._logger is None and self.path is not None:
+            logger = logging.getLogger(f'slowlog.{os.path.abspath(self.path)}')
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            if not logger.handlers:
+                handler = logging.handlers.RotatingFileHandler(
+                    self.path, maxBytes=self.max_bytes, backupCount=self.backups,
+                    encoding='utf-8')
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                logger.addHandler(handler)
+            self._logger = logger
+        return self._logger
+
+    def record(self, database, sql, params, seconds):
+        '''
+        Records one slow statement with its plan
+        '''
+        plan, error = [], None
+        if sql.lstrip().upper().startswith(EXPLAINED):
+            try:
+                plan = [row[-1] for row in database.connection().execute(
+                    'EXPLAIN QUERY PLAN ' + sql, params or ())]
+            except sqlite3.Error as err:
+                error = str(err)
+        entry = {'time': time.time(),
+                 'database': database.database,
+                 'duration_ms': round(seconds * 1000, 3),
+                 'sql': sql,
+                 'params': redact(params),
+                 'plan': plan,
+                 'problems': plan_problems(plan)}
+        if error:
+            entry['plan_error'] = error
+        with self._lock:
+            self.entries.append(entry)
+        logger = self.logger()
+        if logger is not None:
+            logger.info(json.dumps(entry, default=str))
+        if entry['problems']:
+            logging.warning('Slow query (%.1f ms) without index: %s', entry['duration_ms'], sql)
+
+    def recent(self, limit=50, problems_only=False):
+        '''
+        Returns up to limit of the latest entries, newest first
+        '''
+        with self._lock:
+            entries = list(self.entries)
+        if problems_only:
+            entries = [entry for entry in entries if entry['problems']]
+        return entries[::-1][:limit]
+
+    def summary(self):
+        '''
+        Groups the entries in memory by SQL text
+
+        Returns dicts with sql, count, total_ms, max_ms and problems,
+        slowest total first.
+        '''
+        groups = {}
+        with self._lock:
+            entries = list(self.entries)
+        for entry in entries:
+            group = groups.setdefault(entry['sql'], {'sql': entry['sql'], 'count': 0,
+                                                     'total_ms': 0.0, 'max_ms': 0.0,
+                                                     'problems': entry['problems']})
+            group['count'] += 1
+            group['total_ms'] += entry['duration_ms']
+            group['max_ms'] = max(group['max_ms'], entry['duration_ms'])
+        return sorted(groups.values(), key=lambda group: -group['total_ms'])
+
+    def clear(self):
+        '''
+        Forgets the entries in memory (the file is kept)
+        '''
+        with self._lock:
+            self.entries.clear()
+
+
+def read_log(path=LOG_FILE):
+    '''
+    Yields the entries of a slow-query log file, oldest first, including
+    rotated files
+    '''
+    for index in range(BACKUPS, -1, -1):
+        filename = f'{path}.{index}' if index else path
+        if not os.path.exists(filename):
+            continue
+        with open(filename, encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def threshold_seconds(value):
+    '''
+    Parses a SOCIALNETWORK_SLOW_QUERY_MS value; None means disabled
+    '''
+    if value.strip().lower() in ('off', ''):
+        return None
+    return float(value) / 1000
+
+
+SLOW_LOG = SlowQueryLog(threshold_seconds(THRESHOLD_MS))
+
+
+class SlowQueryDatabase(pw.SqliteDatabase):  # pylint: disable=W0223
+    '''
+    SqliteDatabase that times statements and reports slow ones to
+    slow_log (SLOW_LOG unless given)
+    '''
+    def __init__(self, database, *args, slow_log=None, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.slow_log = slow_log or SLOW_LOG
+
+    def execute_sql(self, sql, params=None):
+        threshold = self.slow_log.threshold
+        if threshold is None:
+            return super().execute_sql(sql, params)
+        start = time.perf_counter()
+        cursor = super().execute_sql(sql, params)
+        seconds = time.perf_counter() - start
+        if seconds >= threshold:
+            self.slow_log.record(self, sql, params, seconds)
+        return cursor
@@ -0,0 +1,171 @@
+'''
+Copies of database files taken with SQLite's online backup API
+
+snapshot() takes a consistent, read-only copy of a live database for
+reports, and migrate_to_compact_keys() converts a copy of a text key
+database to the compact key schema, so the original is never changed.
+'''
+import os
+import sqlite3
+import logging
+import pathlib
+import tempfile
+import peewee as pw
+import socialnetwork_model as sm
+
+
+class MigrationError(Exception):
+    '''
+    Raised when a converted database does not match its source
+    '''
+
+
+def migrate_to_compact_keys(source, target, dry_run=False):
+    '''
+    Copies a database using the text key schema into a new database file
+    using the compact integer key schema
+
+    source is only read: it is copied with the online backup API and the
+    copy is brought up to date and converted into a temporary file beside
+    target. The temporary file replaces target only once it holds as many
+    users and statuses as the copy; with dry_run it is discarded instead.
+    Raises MigrationError if the counts differ. Rows are copied in
+    user_id/status_id order so each user's statuses are stored together.
+    Returns the number of (users, statuses) copied.
+    '''
+    directory = os.path.dirname(os.path.abspath(target))
+    copy_path = temporary_file(directory, 'migrate_source_')
+    converted_path = temporary_file(directory, 'migrate_')
+    try:
+        source_db = pw.SqliteDatabase(source)
+        backup(source_db, copy_path)
+        source_db.close()
+        copy_db = pw.SqliteDatabase(copy_path)
+        with copy_db.bind_ctx(sm.TEXT_MODELS):
+            sm.add_missing_columns([sm.TextUsers, sm.TextStatus])
+            expected = (sm.TextUsers.select().count(copy_db),
+                        sm.TextStatus.select().count(copy_db))
+        copy_db.close()
+        copied = convert_to_compact_keys(copy_path, converted_path)
+        if copied != expected:
+            raise MigrationError(f'Copied {copied[0]} users and {copied[1]} statuses of '
+                                 f'{expected[0]} and {expected[1]} in {source}')
+        if dry_run:
+            logging.info('Dry run: %s would migrate %s users and %s statuses to %s',
+                         source, *copied, target)
+        else:
+            os.replace(converted_path, target)
+            logging.info('Migrated %s users and %s statuses to %s', *copied, target)
+        return copied
+    finally:
+        for path in (copy_path, converted_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def convert_to_compact_keys(source, target):
+    '''
+    Writes the rows of source, a text key database, into target, a new
+    compact key database; see migrate_to_compact_keys
+
+    Returns the number of (users, statuses) written.
+    '''
+    database = pw.SqliteDatabase(target, pragmas=sm.PRAGMAS)
+    with database.bind_ctx(sm.COMPACT_MODELS):
+        database.create_tables(sm.COMPACT_MODELS)
+    database.execute_sql('ATTACH DATABASE ? AS source', (source,))
+    source_tables = {row[0] for row in database.execute_sql(
+        "SELECT name FROM source.sqlite_master WHERE type = 'table'")}
+    with database.atomic():
+        if 'compression_dictionaries' in source_tables:
+            database.execute_sql('INSERT INTO main.compression_dictionaries '
+                                 'SELECT * FROM source.compression_dictionaries')
+        users = database.execute_sql(
+            'INSERT INTO main.users (user_id, user_name, user_last_name, user_email, deleted) '
+            'SELECT user_id, user_name, user_last_name, user_email, deleted '
+            'FROM source.users ORDER BY user_id').rowcount
+        statuses = database.execute_sql(
+            'INSERT INTO main.status (status_id, user_rowid, status_text, created_at) '
+            'SELECT s.status_id, u.id, s.status_text, s.created_at '
+            'FROM source.status AS s JOIN main.users AS u ON u.user_id = s.user_id '
+            'ORDER BY u.id, s.status_id').rowcount
+    database.execute_sql('DETACH DATABASE source')
+    with database.bind_ctx(sm.COMPACT_MODELS):
+        sm.UserStats.rebuild(sm.CompactStatus, database)
+        sm.StatusSequence.rebuild(sm.CompactStatus, database)
+    database.close()
+    return users, statuses
+
+
+def temporary_file(directory, prefix):
+    '''
+    Creates an empty temporary database file in directory and returns its
+    path
+    '''
+    handle, path = tempfile.mkstemp(suffix='.db', prefix=prefix, dir=directory)
+    os.close(handle)
+    return path
+
+
+def backup(database, path, pages=256, sleep=0.005):
+    '''
+    Copies database to the file path with SQLite's online backup API
+
+    The copy is made pages pages at a time, sleeping between steps so
+    writers are only locked out for short moments.
+    '''
+    target = sqlite3.connect(path)
+    try:
+        database.connection().backup(target, pages=pages, sleep=sleep)
+    finally:
+        target.close()
+
+
+class Snapshot:
+    '''
+    Read-only copy of a database taken with snapshot()
+
+    database is a peewee database opened read-only with memory-mapped I/O;
+    pass it as db= to UserCollection/UserStatusCollection to run reports
+    against the copy instead of the live file.
+    '''
+
+    def __init__(self, path, mmap_size, remove=False):
+        self.path = path
+        self.remove = remove
+        uri = pathlib.Path(path).resolve().as_uri() + '?mode=ro'
+        self.database = pw.SqliteDatabase(uri, uri=True,
+                                          pragmas={'mmap_size': mmap_size,
+                                                   'query_only': 1})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        '''
+        Closes the snapshot, deleting its file if it was a temporary one
+        '''
+        self.database.close()
+        if self.remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def snapshot(path=None, database=None, pages=256, sleep=0.005, mmap_size=2**28):
+    '''
+    Takes a consistent copy of a live database with SQLite's online backup
+    API and returns it as a read-only Snapshot
+
+    The copy is made pages pages at a time (see backup). Without a path
+    the copy goes to a temporary file that is deleted when the snapshot is
+    closed.
+    '''
+    database = database or sm.db
+    remove = path is None
+    if remove:
+        path = temporary_file(None, 'snapshot_')
+    backup(database, path, pages, sleep)
+    logging.info('Took snapshot of %s in %s', database.database, path)
+    return Snapshot(path, mmap_size, remove)
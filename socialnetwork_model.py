@@ -4,17 +4,48 @@ Authors: Kathleen Wong and Marcus Bakke
 '''
 # pylint: disable=R0903
 import os
+import json
+import time
+import zlib
+import sqlite3
 import logging
+import threading
+import collections
 import peewee as pw
+from playhouse.sqlite_ext import AutoIncrementField
+import batching
+import slowlog
 
-FILE = 'socialnetwork.db'
-if not os.path.exists(FILE):
+# Set SOCIALNETWORK_COMPACT_KEYS=1 to store users and statuses under
+# integer rowid keys (see CompactUsers and CompactStatus). The two schemas
+# cannot share a file, so each has its own default database; convert an
+# existing file with snapshots.migrate_to_compact_keys.
+COMPACT_KEYS = os.environ.get('SOCIALNETWORK_COMPACT_KEYS', '') == '1'
+FILE = 'socialnetwork_compact.db' if COMPACT_KEYS else 'socialnetwork.db'
+# Set SOCIALNETWORK_COMPRESS_STATUS=1 to store status_text zlib compressed
+# (see CompressedTextField); compressed and plain rows can be mixed.
+COMPRESS_STATUS = os.environ.get('SOCIALNETWORK_COMPRESS_STATUS', '') == '1'
+# Values per IN (...) lookup, below SQLite's default 999 parameter limit
+IN_BATCH = 500
+# UPDATE ... RETURNING needs SQLite 3.35
+RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+if not os.path.exists(FILE):  # pragma: no cover (depends on the checkout)
     logging.info('Creating database as %s', FILE)
 else:
     logging.info('Loading database: %s', FILE)
-db = pw.SqliteDatabase(FILE)
+# Rows written before maintain() runs ANALYZE, free pages before it runs
+# an incremental vacuum, and how many pages / seconds one vacuum may take
+ANALYZE_ROWS = 10000
+ANALYZE_LIMIT = 1000
+VACUUM_MIN_PAGES = 256
+VACUUM_PAGES = 128
+VACUUM_BUDGET = 0.1
+# foreign_keys is set on every connection so cascades work in all threads;
+# auto_vacuum only takes effect on new files (see enable_incremental_vacuum)
+PRAGMAS = {'auto_vacuum': 'incremental', 'foreign_keys': 1}
+# Statements slower than slowlog's threshold are logged with their plans
+db = slowlog.SlowQueryDatabase(FILE, pragmas=PRAGMAS)
 db.connect()
-db.execute_sql('PRAGMA foreign_keys = ON;')
 
 class BaseModel(pw.Model):
     '''
@@ -27,6 +58,103 @@ class BaseModel(pw.Model):
         '''
         database = db
 
+    @classmethod
+    def prepare_rows(cls, rows, database=None):
+        '''
+        Converts loader rows (keyed by field name) into insertable rows
+        '''
+        # pylint: disable=W0613
+        return rows
+
+    @classmethod
+    def user_ref(cls, user_id):
+        '''
+        Value stored in the user foreign key column for user_id
+        '''
+        return user_id
+
+class CompressedTextField(pw.CharField):
+    '''
+    Text field that stores values as zlib compressed blobs
+
+    Values are compressed on write when compress is set and the result is
+    smaller than the UTF-8 text; otherwise they are stored as plain text.
+    Reads accept both, so existing rows keep working. With a dictionary
+    (see train_dictionary) short texts compress much better; the zlib
+    header names the dictionary by its adler32, and every dictionary ever
+    used must be registered (load_dictionaries) before rows using it are
+    read.
+    '''
+    dictionaries = {}
+
+    def __init__(self, *args, compress=COMPRESS_STATUS, level=6, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compress = compress
+        self.level = level
+        self.dictionary = None
+
+    @classmethod
+    def register(cls, data):
+        '''
+        Makes a dictionary available for reading; returns its id
+        '''
+        dict_id = zlib.adler32(data)
+        cls.dictionaries[dict_id] = data
+        return dict_id
+
+    def use_dictionary(self, data):
+        '''
+        Compresses new values with data (None for no dictionary)
+        '''
+        if data is not None:
+            self.register(data)
+        self.dictionary = data
+
+    def encode(self, value):
+        '''
+        Returns value compressed, or unchanged when that would not help
+        '''
+        text = value.encode('utf-8')
+        if self.dictionary is None:
+            compressor = zlib.compressobj(self.level)
+        else:
+            compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+        data = compressor.compress(text) + compressor.flush()
+        return data if len(data) < len(text) else value
+
+    @classmethod
+    def decode(cls, data):
+        '''
+        Decompresses a stored blob back to text
+        '''
+        data = bytes(data)
+        if data[1] & 0x20:
+            dict_id = int.from_bytes(data[2:6], 'big')
+            if dict_id not in cls.dictionaries:
+                raise ValueError(f'Unknown compression dictionary {dict_id}')
+            decompressor = zlib.decompressobj(zdict=cls.dictionaries[dict_id])
+        else:
+            decompressor = zlib.decompressobj()
+        return (decompressor.decompress(data) + decompressor.flush()).decode('utf-8')
+
+    def db_value(self, value):
+        if value is None or not self.compress:
+            return super().db_value(value)
+        return self.encode(str(value))
+
+    def python_value(self, value):
+        if isinstance(value, (bytes, memoryview)):
+            return self.decode(value)
+        return super().python_value(value)
+
+    def json_sql(self, column):
+        '''
+        SQL giving the column as a JSON value; blobs become ["<hex>"]
+        '''
+        return (f"CASE WHEN typeof({column}) = 'blob' "
+                f'THEN json_array(hex({column})) ELSE {column} END')
+
+
 class Users(BaseModel):
     '''
     Defines the User
@@ -35,6 +163,7 @@ class Users(BaseModel):
     user_name = pw.CharField(max_length=30)
     user_last_name = pw.CharField(max_length=100)
     user_email = pw.CharField()
+    deleted = pw.BooleanField(default=False)
 
     class Meta:
         '''
@@ -47,10 +176,773 @@ class Users(BaseModel):
 class Status(BaseModel):
     '''
     Defines the Status
+
+    created_at is the creation time in epoch seconds (NULL for rows from
+    before the column existed). It is indexed alone for time ranges and
+    retention, and after the owner for a user's recent statuses.
     '''
     status_id = pw.CharField(primary_key=True, unique=True)
     user = pw.ForeignKeyField(Users, on_delete='CASCADE', to_field='user_id')
-    status_text = pw.CharField()
+    status_text = CompressedTextField()
+    created_at = pw.FloatField(null=True, default=time.time, index=True)
+
+    class Meta:
+        '''
+        Index a user's statuses by time
+        '''
+        indexes = ((('user', 'created_at'), False),)
+
+class CompactUsers(BaseModel):
+    '''
+    Defines the User with an integer rowid key
+
+    user_id stays the external identifier as a unique indexed column.
+    '''
+    id = pw.AutoField()
+    user_id = pw.CharField(unique=True, max_length=30)
+    user_name = pw.CharField(max_length=30)
+    user_last_name = pw.CharField(max_length=100)
+    user_email = pw.CharField()
+    deleted = pw.BooleanField(default=False)
+
+    class Meta:
+        '''
+        Implement constraints
+        '''
+        table_name = 'users'
+        constraints = [pw.Check('LENGTH(user_id) < 30'),
+                       pw.Check('LENGTH(user_name) < 30'),
+                       pw.Check('LENGTH(user_last_name) < 100')]
+
+class CompactStatus(BaseModel):
+    '''
+    Defines the Status with an integer rowid key and integer foreign key
+
+    The user_id property reads and writes the external user_id so callers
+    see the same interface as Status.
+    '''
+    id = pw.AutoField()
+    status_id = pw.CharField(unique=True)
+    user = pw.ForeignKeyField(CompactUsers, on_delete='CASCADE',
+                              column_name='user_rowid',
+                              object_id_name='user_rowid')
+    status_text = CompressedTextField()
+    created_at = pw.FloatField(null=True, default=time.time, index=True)
+
+    class Meta:
+        '''
+        Share the table name with Status and index a user's statuses by
+        time
+        '''
+        table_name = 'status'
+        indexes = ((('user', 'created_at'), False),)
+
+    @property
+    def user_id(self):
+        '''
+        External user_id of the status owner
+
+        Taken from the joined user, which the collections always select,
+        so it comes from the database the row was read from. A row read
+        without the join loads its user through the model's database.
+        '''
+        if self.user_rowid is None:
+            return None
+        return self.user.user_id
+
+    @user_id.setter
+    def user_id(self, value):
+        self.user_rowid = self.user_ref(value)
+
+    @classmethod
+    def user_ref(cls, user_id):
+        '''
+        Subquery resolving user_id to the user's rowid
+
+        Resolved by the database on insert; an unknown user gives NULL and
+        fails with IntegrityError just like the text foreign key.
+        '''
+        users = cls.user.rel_model
+        return users.select(users.id).where(users.user_id == user_id)
+
+    @classmethod
+    def prepare_rows(cls, rows, database=None):
+        '''
+        Replaces user_id in loader rows with the owning user's rowid
+        '''
+        users = cls.user.rel_model
+        user_ids = list({row['user_id'] for row in rows})
+        rowids = {}
+        for i in range(0, len(user_ids), IN_BATCH):
+            query = (users.select(users.user_id, users.id)
+                     .where(users.user_id.in_(user_ids[i:i+IN_BATCH]))
+                     .tuples())
+            rowids.update(query.execute(database))
+        prepared = []
+        for row in rows:
+            row = dict(row)
+            row['user'] = rowids.get(row.pop('user_id'))
+            prepared.append(row)
+        return prepared
+
+
+class UserStats(BaseModel):
+    '''
+    Per-user status counts, kept up to date as statuses are added and
+    deleted so counts and top posters never need COUNT(*) ... GROUP BY
+
+    Keyed by the external user_id so it serves both key schemas.
+    '''
+    user_id = pw.CharField(primary_key=True, max_length=30)
+    status_count = pw.IntegerField(default=0, index=True)
+
+    @classmethod
+    def bump(cls, counts, database=None):
+        '''
+        Adds counts (a dict of user_id -> change) to the stored totals
+        with as few upserts as the bound-parameter limit allows
+        '''
+        rows = [{'user_id': user_id, 'status_count': change}
+                for user_id, change in counts.items() if change]
+        if not rows:
+            return
+        size = batching.max_rows(database or model_database(cls), 2)
+        for i in range(0, len(rows), size):
+            (cls.insert_many(rows[i:i+size])
+             .on_conflict(conflict_target=[cls.user_id],
+                          update={cls.status_count: cls.status_count + pw.EXCLUDED.status_count})
+             .execute(database))
+
+    @classmethod
+    def rebuild(cls, status, database=None):
+        '''
+        Recomputes every count from the status table (used when the stats
+        table is first created for an existing database)
+        '''
+        users = status.user.rel_model
+        counts = (status.select(users.user_id, pw.fn.COUNT(pw.SQL('*')))
+                  .join(users)
+                  .group_by(users.user_id))
+        database = database or model_database(cls)
+        with database.atomic():
+            cls.delete().execute(database)  # pylint: disable=E1120
+            cls.insert_from(counts, [cls.user_id, cls.status_count]).execute(database)
+
+
+class StatusSequence(BaseModel):
+    '''
+    Next unused status number of each user, for allocating status_ids
+
+    Kept next to the user's statuses (and in the same shard). Numbers of
+    statuses added with explicit ids are folded in by observe(), so the
+    allocator never hands out an id that is already taken.
+    '''
+    user_id = pw.CharField(primary_key=True, max_length=30)
+    next_value = pw.IntegerField(default=1)
+
+    @classmethod
+    def reserve(cls, user_id, count=1, database=None):
+        '''
+        Reserves count consecutive numbers for user_id; returns the first
+
+        One indexed UPDATE ... RETURNING (or an INSERT for a user's first
+        status), so concurrent callers never get overlapping ranges.
+        '''
+        database = database or model_database(cls)
+        with database.atomic():
+            query = (cls.update(next_value=cls.next_value + count)
+                     .where(cls.user_id == user_id))
+            if RETURNING:
+                following = query.returning(cls.next_value).tuples().execute(database)
+                following = following[0][0] if following else None
+            elif query.execute(database):
+                following = (cls.select(cls.next_value)
+                             .where(cls.user_id == user_id)
+                             .scalar(database))
+            else:
+                following = None
+            if following is None:
+                cls.insert(user_id=user_id, next_value=1 + count).execute(database)
+                return 1
+            return following - count
+
+    @classmethod
+    def observe(cls, status_ids, database=None):
+        '''
+        Moves each user's sequence past the given (explicit) status_ids
+
+        Ids not shaped like <user_id>_<number> are ignored.
+        '''
+        highest = {}
+        for status_id in status_ids:
+            user_id, _, number = status_id.rpartition('_')
+            if user_id and number.isdigit():
+                highest[user_id] = max(highest.get(user_id, 0), int(number))
+        rows = [{'user_id': user_id, 'next_value': number + 1}
+                for user_id, number in highest.items()]
+        if not rows:
+            return
+        size = batching.max_rows(database or model_database(cls), 2)
+        for i in range(0, len(rows), size):
+            (cls.insert_many(rows[i:i+size])
+             .on_conflict(conflict_target=[cls.user_id],
+                          update={cls.next_value: pw.fn.MAX(cls.next_value,
+                                                            pw.EXCLUDED.next_value)})
+             .execute(database))
+
+    @classmethod
+    def rebuild(cls, status, database=None):
+        '''
+        Sets every sequence from the statuses already stored
+        '''
+        database = database or model_database(cls)
+        status_ids = (status.select(status.status_id).tuples().execute(database))
+        with database.atomic():
+            cls.delete().execute(database)  # pylint: disable=E1120
+            cls.observe([status_id for status_id, in status_ids], database)
+
+
+def format_status_id(user_id, number):
+    '''
+    Returns the status_id for a user's status number
+    '''
+    return f'{user_id}_{number:05d}'
+
+
+class ChangeLog(BaseModel):
+    '''
+    Append-only log of every insert, update and delete on users and status
+
+    Rows are written by triggers (see add_change_triggers), so collection
+    calls, bulk loads and cascading deletes are all captured. seq uses
+    AUTOINCREMENT and is never reused, even after old entries are pruned.
+    data holds the row as JSON after inserts and updates; deletes only
+    record the key.
+    '''
+    seq = AutoIncrementField()
+    table_name = pw.CharField(max_length=30)
+    op = pw.CharField(max_length=6)
+    key = pw.CharField()
+    data = pw.TextField(null=True)
+    changed_at = pw.FloatField()
+
+    class Meta:
+        '''
+        Index the key for compaction
+        '''
+        table_name = 'changes'
+        indexes = ((('table_name', 'key'), False),)
+
+
+class CompressionDictionary(BaseModel):
+    '''
+    Shared zlib dictionaries used by CompressedTextField
+
+    dict_id is the dictionary's adler32, as written in the zlib header of
+    every value compressed with it. The newest one is used for writes.
+    '''
+    dict_id = pw.BigIntegerField(primary_key=True)
+    data = pw.BlobField()
+    created = pw.FloatField()
+
+    class Meta:
+        '''
+        Name the table
+        '''
+        table_name = 'compression_dictionaries'
+
+
+def model_database(model):
+    '''
+    Returns the database a model is bound to
+    '''
+    return model._meta.database  # pylint: disable=W0212
+
+
+def status_model(users_model):
+    '''
+    Returns the status model whose user foreign key references users_model
+
+    Picked by the foreign key's name and the status table, so other
+    models referencing users_model are never mistaken for it.
+    '''
+    for field, model in users_model._meta.backrefs.items():  # pylint: disable=W0212
+        if field.name == 'user' and model._meta.table_name == 'status':  # pylint: disable=W0212
+            return model
+    raise ValueError(f'No status model references {users_model.__name__}')
+
+
+class SchemaError(Exception):
+    '''
+    Raised when a database file was created with the other key schema
+    '''
+
+
+def check_key_schema(models):
+    '''
+    Raises SchemaError if an existing users or status table does not have
+    the primary key its model expects
+
+    CompactUsers and CompactStatus share their table names with the text
+    key models, so opening a file with the wrong SOCIALNETWORK_COMPACT_KEYS
+    setting would otherwise go unnoticed until queries failed.
+    '''
+    for model in models[:2]:
+        meta = model._meta  # pylint: disable=W0212
+        if not model.table_exists():
+            continue
+        keys = meta.database.get_primary_keys(meta.table_name)
+        if keys != [meta.primary_key.column_name]:
+            raise SchemaError(f'Table {meta.table_name} of {meta.database.database} is keyed '
+                              f'by {", ".join(keys)}, not {meta.primary_key.column_name}; '
+                              'check SOCIALNETWORK_COMPACT_KEYS or migrate the file with '
+                              'snapshots.migrate_to_compact_keys')
+
+
+def add_missing_columns(models):
+    '''
+    Adds columns that a model defines but its existing table lacks
+
+    Lets a database file created by an older version pick up new columns
+    (such as Users.deleted) when it is opened.
+    '''
+    for model in models:
+        meta = model._meta  # pylint: disable=W0212
+        existing = {column.name for column in meta.database.get_columns(meta.table_name)}
+        missing = [field for field in meta.sorted_fields if field.column_name not in existing]
+        for field in missing:
+            logging.info('Adding column %s to %s', field.column_name, meta.table_name)
+            meta.database.execute_sql(f'ALTER TABLE "{meta.table_name}" '
+                                      f'ADD COLUMN {column_definition(model, field)}')
+
+
+def column_definition(model, field):
+    '''
+    Returns the ADD COLUMN definition of a field, with its default inlined
+
+    SQLite adds a NOT NULL column with a constant default in place. A
+    migrator would rebuild the table instead, and with foreign keys on
+    rebuilding users cascades into deleting every status.
+    '''
+    context = model._schema._create_context()  # pylint: disable=W0212
+    definition, _ = context.sql(field.ddl(context)).query()
+    if field.null:
+        return definition
+    default = field.db_value(field.default)
+    if callable(field.default) or default is None:
+        raise SchemaError(f'Cannot add {field.column_name} to an existing table: '
+                          'it is NOT NULL without a constant default')
+    if isinstance(default, bool):
+        default = int(default)
+    elif isinstance(default, str):
+        default = "'" + default.replace("'", "''") + "'"
+    return f'{definition} DEFAULT {default}'
+
+
+def add_nocase_indexes(model):
+    '''
+    Adds case-insensitive indexes used by prefix and email lookups
+
+    With the NOCASE collation SQLite can answer LIKE 'abc%' and
+    COLLATE NOCASE equality from the index instead of a table scan.
+    '''
+    table = model._meta.table_name  # pylint: disable=W0212
+    for column in ['user_name', 'user_last_name', 'user_email']:
+        model.add_index(pw.SQL(f'CREATE INDEX IF NOT EXISTS {table}_{column}_nocase '
+                               f'ON {table} ({column} COLLATE NOCASE)'))
+
+
+add_nocase_indexes(Users)
+add_nocase_indexes(CompactUsers)
+
+
+def change_triggers(model):
+    '''
+    Returns CREATE TRIGGER statements logging model's changes to ChangeLog
+
+    The key is status_id for statuses and user_id for users. A foreign
+    key to an integer rowid is logged as the owner's user_id.
+    '''
+    meta = model._meta  # pylint: disable=W0212
+    table = meta.table_name
+    key = meta.fields['status_id' if 'status_id' in meta.fields else 'user_id']
+    values = []
+    for field in meta.sorted_fields:
+        if field is key or isinstance(field, pw.AutoField):
+            continue
+        if isinstance(field, pw.ForeignKeyField):
+            rel = field.rel_model._meta  # pylint: disable=W0212
+            value = f'NEW.{field.column_name}'
+            if field.rel_field.name != 'user_id':
+                value = (f'(SELECT user_id FROM {rel.table_name} '
+                         f'WHERE {field.rel_field.column_name} = {value})')
+            values.append(f"'user_id', {value}")
+        elif isinstance(field, CompressedTextField):
+            values.append(f"'{field.column_name}', {field.json_sql('NEW.' + field.column_name)}")
+        else:
+            values.append(f"'{field.column_name}', NEW.{field.column_name}")
+    data = f"json_object({', '.join(values)})"
+    now = "(julianday('now') - 2440587.5) * 86400.0"
+    statements = []
+    for event, row, row_data in [('insert', 'NEW', data),
+                                 ('update', 'NEW', data),
+                                 ('delete', 'OLD', 'NULL')]:
+        statements.append(
+            f'CREATE TRIGGER IF NOT EXISTS {table}_log_{event} '
+            f'AFTER {event.upper()} ON {table} BEGIN '
+            f'INSERT INTO changes (table_name, op, key, data, changed_at) '
+            f"VALUES ('{table}', '{event}', {row}.{key.column_name}, {row_data}, {now}); "
+            f'END')
+    return statements
+
+
+def add_change_triggers(models, database=None):
+    '''
+    Creates the ChangeLog triggers for models in database
+    '''
+    for model in models:
+        database = database or model_database(model)
+        for statement in change_triggers(model):
+            database.execute_sql(statement)
+
+
+def changes_since(seq=0, limit=None, database=None, batch_size=IN_BATCH):
+    '''
+    Yields ChangeLog entries with a sequence number above seq, oldest first
+
+    Each entry is a dict of seq, table, op, key, data (the row as a dict,
+    or None for deletes; compressed text is decompressed) and changed_at
+    (unix time). Entries are read in
+    batches of batch_size, so a consumer can stream the whole log; limit
+    caps how many are yielded. Remember the last seq seen and pass it
+    back to continue.
+    '''
+    database = database or model_database(ChangeLog)
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        batch = list(ChangeLog.select()
+                     .where(ChangeLog.seq > seq)
+                     .order_by(ChangeLog.seq)
+                     .limit(size)
+                     .dicts()
+                     .execute(database))
+        for entry in batch:
+            yield {'seq': entry['seq'],
+                   'table': entry['table_name'],
+                   'op': entry['op'],
+                   'key': entry['key'],
+                   'data': change_data(entry['data']),
+                   'changed_at': entry['changed_at']}
+        if len(batch) < size:
+            return
+        seq = batch[-1]['seq']
+        if remaining is not None:
+            remaining -= len(batch)
+
+
+def change_data(data):
+    '''
+    Parses a ChangeLog data column, decompressing compressed text
+    '''
+    if not data:
+        return None
+    row = json.loads(data)
+    for column, value in row.items():
+        if isinstance(value, list):
+            row[column] = CompressedTextField.decode(bytes.fromhex(value[0]))
+    return row
+
+
+def compact_changes(upto_seq=None, database=None):
+    '''
+    Keeps only the newest entry for each key among entries up to upto_seq
+    (default: the whole log)
+
+    A consumer starting from before upto_seq still ends with every row in
+    its latest state, but sees inserts and updates merged, so it should
+    treat both as upserts. Returns the number of entries removed.
+    '''
+    database = database or model_database(ChangeLog)
+    if upto_seq is None:
+        upto_seq = ChangeLog.select(pw.fn.MAX(ChangeLog.seq)).scalar(database) or 0
+    newest = (ChangeLog.select(pw.fn.MAX(ChangeLog.seq))
+              .where(ChangeLog.seq <= upto_seq)
+              .group_by(ChangeLog.table_name, ChangeLog.key))
+    removed = (ChangeLog.delete()  # pylint: disable=E1120
+               .where((ChangeLog.seq <= upto_seq) & ChangeLog.seq.not_in(newest))
+               .execute(database))
+    logging.info('Compacted %s change log entries.', removed)
+    return removed
+
+
+def prune_changes(max_age=None, keep=None, database=None):
+    '''
+    Deletes change log entries older than max_age seconds and/or all but
+    the newest keep entries
+
+    Consumers further behind than what is kept must resync from a full
+    export. Returns the number of entries removed.
+    '''
+    database = database or model_database(ChangeLog)
+    condition = None
+    if max_age is not None:
+        condition = ChangeLog.changed_at < time.time() - max_age
+    if keep is not None:
+        newest = ChangeLog.select(pw.fn.MAX(ChangeLog.seq)).scalar(database) or 0
+        older = ChangeLog.seq <= newest - keep
+        condition = older if condition is None else condition | older
+    if condition is None:
+        return 0
+    removed = ChangeLog.delete().where(condition).execute(database)  # pylint: disable=E1120
+    logging.info('Pruned %s change log entries.', removed)
+    return removed
+
+
+def train_dictionary(texts, size=4096):
+    '''
+    Builds a zlib dictionary from sample texts
+
+    zlib has no trainer, so this keeps the words and word pairs that
+    occur most often, with the most frequent at the end where zlib finds
+    matches cheapest. size is capped by zlib's 32 KiB window.
+    '''
+    size = min(size, 32768)
+    counts = collections.Counter()
+    for text in texts:
+        words = text.split()
+        counts.update(words)
+        counts.update(' '.join(pair) for pair in zip(words, words[1:]))
+    pieces, used = [], 0
+    for piece, count in counts.most_common():
+        length = len(piece.encode('utf-8')) + 1
+        if count < 2 or used + length > size:
+            continue
+        pieces.append(piece)
+        used += length
+    return ' '.join(reversed(pieces)).encode('utf-8')
+
+
+def store_dictionary(data, database=None):
+    '''
+    Saves a dictionary in database and uses it for new status_text values
+    '''
+    database = database or model_database(CompressionDictionary)
+    dict_id = CompressedTextField.register(data)
+    (CompressionDictionary
+     .insert(dict_id=dict_id, data=data, created=time.time())
+     .on_conflict_replace()
+     .execute(database))
+    use_dictionary(data)
+    logging.info('Stored compression dictionary %s (%s bytes).', dict_id, len(data))
+    return dict_id
+
+
+def use_dictionary(data):
+    '''
+    Compresses new status_text values of every status model with data
+    '''
+    for model in [TextStatus, CompactStatus]:
+        model.status_text.use_dictionary(data)
+
+
+def load_dictionaries(database=None):
+    '''
+    Registers every dictionary stored in database and uses the newest
+    '''
+    database = database or model_database(CompressionDictionary)
+    rows = list(CompressionDictionary.select()
+                .order_by(CompressionDictionary.created)
+                .execute(database))
+    for row in rows:
+        CompressedTextField.register(bytes(row.data))
+    if rows:
+        use_dictionary(bytes(rows[-1].data))
+    return len(rows)
+
+
+def recompress_statuses(status=None, database=None, batch_size=IN_BATCH):
+    '''
+    Rewrites every status_text with the current compression settings
+
+    Run after enabling compression or storing a new dictionary so older
+    rows shrink too; VACUUM afterwards returns the space to the OS. Each
+    rewrite is logged as an update in the change log. Returns the number
+    of rows rewritten.
+    '''
+    status = status or Status
+    database = database or model_database(status)
+    key = status._meta.primary_key  # pylint: disable=W0212
+    last, rewritten = None, 0
+    while True:
+        query = status.select(key, status.status_text).order_by(key).limit(batch_size)
+        if last is not None:
+            query = query.where(key > last)
+        batch = list(query.tuples().execute(database))
+        if not batch:
+            return rewritten
+        with database.atomic():
+            for row_key, text in batch:
+                status.update(status_text=text).where(key == row_key).execute(database)
+        rewritten += len(batch)
+        last = batch[-1][0]
+
+
+_pending_changes = collections.Counter()
+_pending_lock = threading.Lock()
+
+
+def note_changes(database, rows):
+    '''
+    Records that a bulk operation wrote or deleted rows in database
+
+    maintain() uses the running total to decide when to ANALYZE.
+    '''
+    with _pending_lock:
+        _pending_changes[database] += rows
+
+
+def pragma_value(database, name):
+    '''
+    Returns the value of a single-valued PRAGMA
+    '''
+    return database.execute_sql(f'PRAGMA {name}').fetchone()[0]
+
+
+def storage_stats(database=None):
+    '''
+    Returns file size and free page figures for database as a dict
+
+    freelist_ratio is the share of pages that are free; auto_vacuum is
+    'none', 'full' or 'incremental'.
+    '''
+    database = database or db
+    page_size = pragma_value(database, 'page_size')
+    page_count = pragma_value(database, 'page_count')
+    freelist = pragma_value(database, 'freelist_count')
+    return {'path': database.database,
+            'page_size': page_size,
+            'page_count': page_count,
+            'file_size': page_size * page_count,
+            'freelist_count': freelist,
+            'freelist_ratio': freelist / page_count if page_count else 0.0,
+            'auto_vacuum': ['none', 'full', 'incremental'][pragma_value(database, 'auto_vacuum')],
+            'pending_changes': _pending_changes[database]}
+
+
+def analyze(database=None):
+    '''
+    Refreshes the query planner statistics of database
+
+    analysis_limit keeps ANALYZE to a sample of each index so it stays
+    quick on large tables.
+    '''
+    database = database or db
+    start = time.perf_counter()
+    database.execute_sql(f'PRAGMA analysis_limit = {ANALYZE_LIMIT}')
+    database.execute_sql('ANALYZE')
+    with _pending_lock:
+        _pending_changes.pop(database, None)
+    logging.info('Analyzed %s in %.3fs.', database.database, time.perf_counter() - start)
+
+
+def incremental_vacuum(database=None, budget=VACUUM_BUDGET, pages=VACUUM_PAGES):
+    '''
+    Returns free pages to the file system, pages at a time, until none are
+    left or budget seconds have passed
+
+    Only works on files with auto_vacuum=INCREMENTAL. Each step is short,
+    so writers are not held up for long. Returns the pages released.
+    '''
+    database = database or db
+    if pragma_value(database, 'auto_vacuum') != 2:
+        return 0
+    before = remaining = pragma_value(database, 'freelist_count')
+    deadline = time.perf_counter() + budget
+    while remaining and time.perf_counter() < deadline:
+        database.execute_sql(f'PRAGMA incremental_vacuum({pages})').fetchall()
+        remaining = pragma_value(database, 'freelist_count')
+    logging.info('Vacuumed %s pages of %s.', before - remaining, database.database)
+    return before - remaining
+
+
+def enable_incremental_vacuum(database=None):
+    '''
+    Switches an existing file to auto_vacuum=INCREMENTAL
+
+    This needs one full VACUUM, which rewrites the file; new files get
+    the mode from PRAGMAS. Returns True if the mode was changed.
+    '''
+    database = database or db
+    if pragma_value(database, 'auto_vacuum') == 2:
+        return False
+    database.execute_sql('PRAGMA auto_vacuum = INCREMENTAL')
+    database.execute_sql('VACUUM')
+    return True
+
+
+def maintain(database=None, force=False):
+    '''
+    Runs the maintenance a database needs after bulk operations
+
+    ANALYZE runs once ANALYZE_ROWS changes were noted (or with force);
+    otherwise PRAGMA optimize lets SQLite refresh what it thinks is stale.
+    An incremental vacuum runs when VACUUM_MIN_PAGES or more pages are
+    free. Returns what was done and the storage_stats afterwards.
+    '''
+    database = database or db
+    report = {'analyzed': False, 'vacuumed_pages': 0}
+    if force or _pending_changes[database] >= ANALYZE_ROWS:
+        analyze(database)
+        report['analyzed'] = True
+    else:
+        database.execute_sql('PRAGMA optimize')
+    if pragma_value(database, 'freelist_count') >= VACUUM_MIN_PAGES:
+        report['vacuumed_pages'] = incremental_vacuum(database)
+    report.update(storage_stats(database))
+    return report
+
+
+def key_field(model):
+    '''
+    Returns the field loads and change logs identify model's rows by:
+    status_id for statuses, user_id for users
+    '''
+    fields = model._meta.fields  # pylint: disable=W0212
+    return fields['status_id' if 'status_id' in fields else 'user_id']
+
+
+TextUsers, TextStatus = Users, Status
+DERIVED_MODELS = [UserStats, StatusSequence, ChangeLog, CompressionDictionary]
+TEXT_MODELS = [TextUsers, TextStatus] + DERIVED_MODELS
+COMPACT_MODELS = [CompactUsers, CompactStatus] + DERIVED_MODELS
+if COMPACT_KEYS:  # pragma: no cover (run by the compact keys test job)
+    Users, Status = CompactUsers, CompactStatus
+MODELS = [Users, Status] + DERIVED_MODELS
+
+
+def create_tables(models, database=None):
+    '''
+    Creates any missing tables, columns, indexes and change log triggers
+    for models, fills UserStats and StatusSequence from existing statuses
+    when they are new and loads stored compression dictionaries
+
+    Raises SchemaError if the database uses the other key schema.
+    '''
+    database = database or model_database(models[0])
+    with database.bind_ctx(models):
+        check_key_schema(models)
+        new = [model for model in [UserStats, StatusSequence]
+               if model in models and not model.table_exists()]
+        # Columns first, so indexes on new columns can be created
+        add_missing_columns([model for model in models if model.table_exists()])
+        database.create_tables(models)
+        for model in new:
+            model.rebuild(models[1], database)
+        if ChangeLog in models:
+            add_change_triggers(models[:2], database)
+        if CompressionDictionary in models:
+            load_dictionaries(database)
 
 
-db.create_tables([Users, Status])
+create_tables(MODELS, db)
@@ -0,0 +1,60 @@
+'''
+Unittests for batching.py.
+'''
+import unittest
+from unittest import mock
+import loader
+import batching
+import fixtures
+import socialnetwork_model as sm
+
+test_db = fixtures.test_db
+
+
+class TestBatching(fixtures.ModelTestCase):
+    '''
+    Test class for batching.py
+    '''
+    def test_converges(self):
+        '''
+        Test the batch size climbs towards the fastest size and turns back
+        '''
+        batcher = batching.AdaptiveBatcher(5000, size=100)
+
+        def seconds(rows):
+            # Fastest around 2000 rows per batch
+            return rows / (1e6 - abs(rows - 2000) * 300)
+
+        sizes = []
+        for _ in range(40):
+            batcher.record(batcher.size, seconds(batcher.size))
+            sizes.append(batcher.size)
+        self.assertTrue(all(900 < size < 4500 for size in sizes[-10:]))
+        self.assertLessEqual(max(sizes), 5000)
+        batcher.record(1, 1.0)
+        self.assertEqual(batcher.size, sizes[-1])
+
+    def test_parameter_limit(self):
+        '''
+        Test inserts stay under the connection's bound-parameter limit
+        '''
+        # Connection.setlimit needs Python 3.11, so the limit is patched
+        with mock.patch.object(batching, 'variable_limit', return_value=40):
+            self.assertEqual(batching.max_rows(test_db, 5), 8)
+            rows = [{'user_id': f'user{i}', 'user_email': 'a@uw.edu', 'user_name': 'Name',
+                     'user_last_name': 'Last'} for i in range(95)]
+            self.assertTrue(loader.insert_all(self.user_collection, rows))
+            self.assertEqual(sm.Users.select().count(), 95)
+            # Users has a fifth column, deleted, filled from its default
+            batcher = batching.batcher_for(test_db, 'users', 5)
+        self.assertLessEqual(batcher.size, 8)
+        self.assertEqual(batcher.run(list(range(25)), lambda batch: None),
+                         -(-25 // batcher.size))
+        # Before Python 3.11 connections have no getlimit
+        with mock.patch.object(test_db, 'connection', return_value=object()):
+            self.assertEqual(batching.variable_limit(test_db), batching.DEFAULT_LIMIT)
+        self.assertEqual(batching.insert_rows(sm.Users, [], test_db), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
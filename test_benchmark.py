@@ -0,0 +1,57 @@
+'''
+Smoke tests for benchmark.py under both key schemas.
+'''
+import os
+import sys
+import unittest
+import tempfile
+import subprocess
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark.py')
+
+
+class TestBenchmark(unittest.TestCase):
+    '''
+    Runs each benchmark on a tiny data set in a fresh process
+
+    Each run gets its own working directory, so the default database
+    file it creates at import is thrown away with it.
+    '''
+    def run_benchmark(self, *argv):
+        '''
+        Runs benchmark.py with text and then compact keys and returns the
+        outputs
+        '''
+        outputs = []
+        for compact_keys in ('0', '1'):
+            with self.subTest(compact_keys=compact_keys), \
+                    tempfile.TemporaryDirectory() as tmp:
+                env = dict(os.environ, SOCIALNETWORK_COMPACT_KEYS=compact_keys)
+                run = subprocess.run([sys.executable, BENCHMARK] + list(argv), cwd=tmp,
+                                     env=env, capture_output=True, text=True,
+                                     timeout=120, check=False)
+                self.assertEqual(run.returncode, 0, run.stderr)
+                outputs.append(run.stdout)
+        return outputs
+
+    def test_keys(self):
+        '''
+        Test the key schema benchmark builds, migrates and times both schemas
+        '''
+        for output in self.run_benchmark('keys', '--users', '5', '--statuses', '50',
+                                         '--lookups', '10'):
+            self.assertEqual([line.split()[0] for line in output.splitlines()[2:]],
+                             ['text', 'compact'])
+
+    def test_compression(self):
+        '''
+        Test the compression benchmark builds a database for each storage mode
+        '''
+        for output in self.run_benchmark('compression', '--users', '5', '--statuses', '50',
+                                         '--samples', '5'):
+            self.assertEqual([line.split()[0] for line in output.splitlines()[2:]],
+                             ['plain', 'zlib', 'zlib+dict'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+'''
+Unittests for bulkload.py.
+'''
+import os
+import unittest
+import main
+import loader
+import fixtures
+import bulkload
+import socialnetwork_model as sm
+
+test_db = fixtures.test_db
+
+
+class TestBulkLoad(fixtures.ModelTestCase):
+    '''
+    Test bulk load mode
+    '''
+    def test_bulk_load(self):
+        '''
+        Test secondary indexes are dropped for the load and rebuilt
+        '''
+        indexes = bulkload.secondary_indexes(sm.Status, test_db)
+        column = sm.Status.user.column_name
+        self.assertEqual([name.split('_', 1)[1] for name, _ in indexes],
+                         ['created_at', column, f'{column}_created_at'])
+        with bulkload.bulk_load([sm.Status], test_db) as report:
+            self.assertTrue(report['enabled'])
+            self.assertTrue(bulkload.bulk_loading(test_db))
+            self.assertEqual(bulkload.secondary_indexes(sm.Status, test_db), [])
+            self.assertEqual(len(bulkload.secondary_indexes(sm.Users, test_db)), 3)
+            rows = [{'user_id': 'b'}, {'user_id': 'a'}]
+            self.assertEqual(bulkload.in_key_order(sm.Users, rows, test_db), rows[::-1])
+        self.assertFalse(bulkload.bulk_loading(test_db))
+        self.assertEqual(bulkload.secondary_indexes(sm.Status, test_db), indexes)
+        self.assertEqual(report['indexes'], [name for name, _ in indexes])
+        self.assertEqual(report['foreign_key_errors'], 0)
+        # Tables holding more than max_rows rows keep their indexes
+        main.add_user('dave03', 'dave@uw.edu', 'Dave', 'Yuen', self.user_collection)
+        with bulkload.bulk_load([sm.Users], test_db, max_rows=0) as report:
+            self.assertFalse(report['enabled'])
+            self.assertEqual(len(bulkload.secondary_indexes(sm.Users, test_db)), 3)
+
+    def test_bulk_rows(self):
+        '''
+        Test deferred foreign keys still reject rows without a user
+        '''
+        self.assertTrue(main.load_users(os.path.join('test_files', 'test_good_accounts.csv'),
+                                        self.user_collection,
+                                        options=loader.LoadOptions(bulk=True)))
+        chunk = [(2, {'status_id': 'dave03_00002', 'user_id': 'dave03',
+                      'status_text': 'b'}, 'b'),
+                 (3, {'status_id': 'eve_00001', 'user_id': 'eve', 'status_text': 'e'}, 'e'),
+                 (4, {'status_id': 'dave03_00001', 'user_id': 'dave03',
+                      'status_text': 'a'}, 'a')]
+        with loader.bulk_mode(self.status_collection) as reports:
+            inserted, rejected = loader.write_rows(self.status_collection, test_db, chunk)
+        self.assertTrue(reports[0]['enabled'])
+        self.assertEqual((inserted, [line_num for line_num, _, _ in rejected]), (2, [3]))
+        self.assertEqual(main.status_count('dave03', self.status_collection), 2)
+        self.assertEqual(len(bulkload.secondary_indexes(sm.Users, test_db)), 3)
+        # Rows orphaned without foreign key checks are reported
+        test_db.execute_sql('PRAGMA foreign_keys = OFF;')
+        sm.Users.delete().where(  # pylint: disable=E1120
+            sm.Users.user_id == 'dave03').execute(test_db)
+        test_db.execute_sql('PRAGMA foreign_keys = ON;')
+        self.assertEqual(bulkload.check_foreign_keys([sm.Status], test_db), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+'''
+Unittests for groupcommit.py and group commit on the collections.
+'''
+import os
+import shutil
+import unittest
+import tempfile
+import threading
+from unittest import mock
+from concurrent.futures import Future
+import peewee as pw
+import main
+import groupcommit
+import socialnetwork_model as sm
+
+
+class TestGroupCommit(unittest.TestCase):
+    '''
+    Test class for groupcommit.py
+
+    The committer writes from its own thread, and every thread gets its own
+    connection, so the database is a file rather than :memory:.
+    '''
+    def setUp(self):
+        '''
+        Create a file database and collections with group commit on.
+        '''
+        self.tmp = tempfile.mkdtemp()
+        self.database = pw.SqliteDatabase(os.path.join(self.tmp, 'test.db'),
+                                          pragmas=sm.PRAGMAS)
+        sm.create_tables(sm.MODELS, self.database)
+        self.user_collection = main.init_user_collection(db=self.database)
+        self.status_collection = main.init_status_collection(db=self.database)
+        self.committer = main.start_group_commit(self.user_collection, max_ops=8,
+                                                 max_delay=0.05)
+
+    def test_batches(self):
+        '''
+        Test queued writes are acknowledged after committing in batches
+        '''
+        futures = [main.add_user(f'user{i}', 'a@uw.edu', 'Name', 'Last',
+                                 self.user_collection) for i in range(20)]
+        duplicate = main.add_user('user1', 'a@uw.edu', 'Name', 'Last', self.user_collection)
+        self.assertTrue(all(future.result(5) for future in futures))
+        self.assertFalse(duplicate.result(5))  # pylint: disable=E1101
+        self.assertEqual(sm.Users.select().count(self.database), 20)
+        self.assertLess(self.committer.batches, 21)
+        self.assertEqual(self.committer.writes, 21)
+        self.assertTrue(main.update_user(  # pylint: disable=E1101
+            'user3', 'b@uw.edu', 'New', 'Last', self.user_collection).result(5))
+        self.assertTrue(main.delete_user('user4',  # pylint: disable=E1101
+                                         self.user_collection).result(5))
+        main.stop_group_commit(self.user_collection)
+        self.assertEqual(main.search_user('user3', self.user_collection).user_name, 'New')
+        self.assertIsNone(main.search_user('user4', self.user_collection))
+        # Back to synchronous results
+        self.assertTrue(main.add_user('user4', 'a@uw.edu', 'Name', 'Last',
+                                      self.user_collection))
+
+    def test_failed_write(self):
+        '''
+        Test an exception fails only its own write
+        '''
+        def broken():
+            raise ValueError('broken')
+        ok = main.add_user('user1', 'a@uw.edu', 'Name', 'Last', self.user_collection)
+        failed = self.committer.submit(broken)
+        self.assertTrue(ok.result(5))  # pylint: disable=E1101
+        self.assertIsInstance(failed.exception(5), ValueError)
+        self.assertTrue(main.add_status('user1', 'user1_00001', 'hi',
+                                        self.status_collection))
+        # A batch whose transaction cannot start fails every write in it
+        with mock.patch.object(self.database, 'atomic',
+                               side_effect=pw.OperationalError('disk I/O error')), \
+                self.assertLogs(level='ERROR'):
+            cancelled = Future()
+            cancelled.cancel()
+            self.committer._queue.put((cancelled, print, (), {}))  # pylint: disable=W0212
+            failed = main.add_user('user2', 'a@uw.edu', 'Name', 'Last', self.user_collection)
+            self.assertIsInstance(failed.exception(5),  # pylint: disable=E1101
+                                  pw.OperationalError)
+        self.assertIsNone(main.search_user('user2', self.user_collection))
+
+    def test_scheduler(self):
+        '''
+        Test a committer started with a scheduler flushes in priority turns
+        '''
+        main.stop_group_commit(self.user_collection)
+        main.start_scheduler(self.user_collection, self.status_collection)
+        try:
+            committer = main.start_group_commit(self.user_collection)
+            self.assertIs(main.start_group_commit(self.user_collection), committer)
+            self.assertTrue(main.add_user('user1', 'a@uw.edu', 'Name', 'Last',  # pylint: disable=E1101
+                                          self.user_collection).result(5))
+            self.assertEqual(committer.batches, 1)
+        finally:
+            main.stop_group_commit(self.user_collection)
+            main.stop_scheduler(self.user_collection, self.status_collection)
+
+    def test_stopped(self):
+        '''
+        Test stop flushes queued writes and later submits are refused
+        '''
+        futures = [main.add_user(f'user{i}', 'a@uw.edu', 'Name', 'Last',
+                                 self.user_collection) for i in range(5)]
+        self.committer.stop()
+        self.assertTrue(all(future.done() for future in futures))
+        with self.assertRaises(RuntimeError):
+            self.committer.submit(print)
+        self.assertEqual(groupcommit.queued(lambda self: 1)(self.status_collection), 1)
+
+    def test_stopping(self):
+        '''
+        Test writes are refused as soon as stop is called and writes left
+        behind the stop are failed rather than left pending
+        '''
+        release = threading.Event()
+        blocked = self.committer.submit(release.wait, 5)
+        # A write cancelled while it waits is skipped
+        skipped = self.committer.submit(print)
+        self.assertTrue(skipped.cancel())
+        self.committer.stop(timeout=0)
+        self.assertTrue(self.committer.is_alive())
+        with self.assertRaises(RuntimeError):
+            self.committer.submit(print)
+        late, cancelled = Future(), Future()
+        cancelled.cancel()
+        for future in (late, cancelled):
+            self.committer._queue.put((future, print, (), {}))  # pylint: disable=W0212
+        release.set()
+        self.committer.stop(5)
+        self.assertTrue(blocked.result(5))
+        self.assertIsInstance(late.exception(5), RuntimeError)
+        self.assertTrue(cancelled.cancelled())
+
+    def tearDown(self):
+        '''
+        Stop group commit and delete the database.
+        '''
+        self.user_collection.stop_group_commit()
+        self.database.close()
+        shutil.rmtree(self.tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
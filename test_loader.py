@@ -0,0 +1,74 @@
+'''
+Unittests for loader.py.
+'''
+import os
+import unittest
+import tempfile
+import main
+import loader
+import fixtures
+
+
+class TestLoader(fixtures.ModelTestCase):
+    '''
+    Test the screening and insert steps of the loaders
+    '''
+    def test_screen_rows(self):
+        '''
+        Test screening of duplicate and unknown keys before insertion
+        '''
+        main.add_user('dave03', 'dave@gmail.com', 'dave', 'yuen', self.user_collection)
+        main.add_status('dave03', 'dave03_00001', 'Hello', self.status_collection)
+        keys = {'STATUS_ID': {'key': 'status_id', 'unique': True},
+                'USER_ID': {'key': 'user_id', 'references': 'user'}}
+        rows = [(2, {'status_id': 'dave03_00001', 'user_id': 'dave03'}, 'a'),
+                (3, {'status_id': 'dave03_00002', 'user_id': 'dave03'}, 'b'),
+                (4, {'status_id': 'dave03_00002', 'user_id': 'dave03'}, 'c'),
+                (5, {'status_id': 'eve_00001', 'user_id': 'eve'}, 'd')]
+        seen = {}
+        clean, rejected = loader.screen_rows(rows, keys, self.status_collection, seen)
+        self.assertEqual([row[0] for row in clean], [3])
+        self.assertEqual([row[0] for row in rejected], [2, 4, 5])
+        self.assertEqual(seen, {'status_id': {'dave03_00002'}})
+        # Values accepted from an earlier chunk are remembered
+        clean, rejected = loader.screen_rows(rows[2:3], keys, self.status_collection, seen)
+        self.assertEqual(clean, [])
+        # A strict load with a known user_id writes nothing
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'accounts.csv')
+            with open(filename, 'w', encoding='utf-8') as file:
+                file.write('USER_ID,EMAIL,NAME,LASTNAME\n'
+                           'evmiles97,eve.miles@uw.edu,Eve,Miles\n'
+                           'dave03,david.yuen@gmail.com,David,Yuen\n'
+                           'evmiles97,eve.miles@uw.edu,Eve,Miles\n')
+            with self.assertLogs(level='DEBUG') as logs:
+                self.assertFalse(main.load_users(filename, self.user_collection))
+        self.assertIsNone(main.search_user('evmiles97', self.user_collection))
+        # Only the first reject is an error; the rest are counted
+        rejects = [record for record in logs.records if record.getMessage().startswith('Line')]
+        self.assertEqual([record.levelname for record in rejects], ['ERROR', 'DEBUG'])
+        self.assertTrue(rejects[0].getMessage().endswith('(2 rows rejected)'))
+
+    def test_insert_back_out(self):
+        '''
+        Test rows the screening missed roll back a strict insert and are
+        rejected one by one in a tolerant chunk
+        '''
+        self.assertTrue(main.add_user('dave03', 'david.yuen@gmail.com', 'David', 'Yuen',
+                                      self.user_collection))
+        rows = [{'user_id': user_id, 'user_email': 'a@uw.edu', 'user_name': 'A',
+                 'user_last_name': 'B'} for user_id in ('amy1', 'dave03')]
+        self.assertFalse(loader.insert_all(self.user_collection, rows))
+        self.assertIsNone(main.search_user('amy1', self.user_collection))
+        result, rejects = loader.LoadResult('users.csv'), loader.RejectsBuffer()
+        loader.insert_chunk(self.user_collection,
+                            [(line_num, row, {}) for line_num, row in enumerate(rows, 2)],
+                            rejects, result)
+        self.assertEqual(result.rows_inserted, 1)
+        self.assertEqual([(line_num, 'UNIQUE' in reason) for line_num, reason, _ in rejects.rows],
+                         [(3, True)])
+        self.assertIsNotNone(main.search_user('amy1', self.user_collection))
+
+
+if __name__ == '__main__':
+    unittest.main()
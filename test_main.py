@@ -6,31 +6,25 @@ Authors: Kathleen Wong and Marcus Bakke
 # pylint: disable=R0904
 import unittest
 import os
+import csv
+import tempfile
+from unittest import mock
 import peewee as pw
 import users
 import user_status
 import main
+import loader
+import fixtures
 import socialnetwork_model as sm
 
-MODELS = [sm.Users, sm.Status]
-test_db = pw.SqliteDatabase(':memory:')
+COMPACT_MODELS = sm.COMPACT_MODELS
+test_db = fixtures.test_db
 
 
-class TestMain(unittest.TestCase):
+class TestMain(fixtures.ModelTestCase):
     '''
     Test class for main.py
     '''
-    def setUp(self):
-        '''
-        setUp method to disable logging.
-        '''
-        test_db.bind(MODELS, bind_refs=False, bind_backrefs=False)
-        test_db.connect()
-        test_db.create_tables(MODELS)
-        test_db.execute_sql('PRAGMA foreign_keys = ON;')
-        self.user_collection = users.UserCollection()
-        self.status_collection = user_status.UserStatusCollection()
-
     def test_init_user_collection(self):
         '''
         Test UserCollection initialization
@@ -73,6 +67,183 @@ class TestMain(unittest.TestCase):
         fake = main.load_users(filename, user_collection)
         self.assertFalse(fake)
 
+    def test_load_dir(self):
+        '''
+        Test loading a directory of user and status part files
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            parts = {'a_status.csv': 'STATUS_ID,USER_ID,STATUS_TEXT\n'
+                                     'zed1_00001,zed1,hi\n'
+                                     'amy1_00001,amy1,hi\n'
+                                     'nobody_00001,nobody,hi\n',
+                     'b_status.csv': 'STATUS_ID,USER_ID,STATUS_TEXT\n'
+                                     'amy1_00001,amy1,again\n'
+                                     'amy1_00002,amy1,\n',
+                     'm_users.csv': 'USER_ID,EMAIL,NAME,LASTNAME\n'
+                                    'amy1,amy@uw.edu,Amy,Adams\n',
+                     'z_users.csv': 'USER_ID,EMAIL,NAME,LASTNAME\n'
+                                    'zed1,zed@uw.edu,Zed,Zulu\n'
+                                    'amy1,amy@uw.edu,Amy,Adams\n',
+                     'other.csv': 'FOO,BAR\n1,2\n',
+                     'notes.txt': 'not csv'}
+            for name, text in parts.items():
+                with open(os.path.join(tmp, name), 'w', encoding='utf-8') as file:
+                    file.write(text)
+            results = main.load_dir(tmp, self.user_collection, self.status_collection,
+                                    loader.LoadOptions(workers=2))
+            self.assertEqual([(os.path.basename(result.filename), result.rows_inserted,
+                               result.rows_rejected) for result in results],
+                             [('m_users.csv', 1, 0), ('z_users.csv', 1, 1),
+                              ('a_status.csv', 2, 1), ('b_status.csv', 0, 2),
+                              ('other.csv', 0, 0)])
+            self.assertEqual([bool(result) for result in results], [True] * 4 + [False])
+            self.assertTrue(results[-1].error.startswith('Bad header'))
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'b_status_rejects.csv')))
+            with open(os.path.join(tmp, 'b_status_rejects.csv'), encoding='utf-8') as file:
+                rejects = [(row['LINE'], row['REASON']) for row in csv.DictReader(file)]
+            self.assertEqual(rejects, [('2', 'STATUS_ID amy1_00001 already exists'),
+                                       ('3', 'Empty value for STATUS_TEXT')])
+            results = main.load_users_dir(tmp, self.user_collection,
+                                          loader.LoadOptions(workers=0))
+            self.assertEqual([os.path.basename(result.filename) for result in results
+                              if not result],
+                             ['a_status.csv', 'b_status.csv', 'other.csv'])
+            # Rejects files are not picked up again; glob patterns work too
+            results = main.load_users_dir(os.path.join(tmp, 'z_*.csv'),
+                                          self.user_collection,
+                                          loader.LoadOptions(rejects=tmp, workers=0))
+            self.assertEqual([result.rows_rejected for result in results], [2])
+        self.assertEqual(main.status_count('amy1', self.status_collection), 1)
+
+    def test_load_dir_workers(self):
+        '''
+        Test a worker parses ahead of the writer and reports unreadable files
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            for i in range(4):
+                with open(os.path.join(tmp, f'users{i}.csv'), 'w', encoding='utf-8') as file:
+                    file.write(f'USER_ID,EMAIL,NAME,LASTNAME\nuser{i},a@uw.edu,Amy,Adams\n')
+            results = main.load_users_dir(tmp, self.user_collection,
+                                          loader.LoadOptions(workers=1))
+            self.assertEqual([result.rows_inserted for result in results], [1] * 4)
+            # Files can change between listing and parsing
+            with open(os.path.join(tmp, 'other.csv'), 'w', encoding='utf-8') as file:
+                file.write('FOO,BAR\n1,2\n')
+            with open(os.path.join(tmp, 'users.csv.zst'), 'wb') as file:
+                file.write(b'\x28\xb5\x2f\xfd')
+            errors = []
+            with mock.patch('readers.zstandard', None):
+                for name in ('other.csv', 'missing.csv', 'users.csv.zst'):
+                    parsed = loader.parse_file(os.path.join(tmp, name), loader.user_keys(),
+                                               None)
+                    result = loader.write_parsed(parsed, loader.user_keys(),
+                                                 self.user_collection, {})
+                    self.assertFalse(result)
+                    errors.append(result.error)
+        self.assertTrue(errors[0].startswith('Bad header'))
+        self.assertTrue(errors[1].startswith('File does not exist'))
+        self.assertIn('install zstandard', errors[2])
+
+    def test_load_status_updates_tolerant(self):
+        '''
+        Test tolerant load_status_updates with a rejects file
+        '''
+        main.load_users(os.path.join('test_files', 'test_good_accounts.csv'),
+                        self.user_collection)
+        with tempfile.TemporaryDirectory() as tmp:
+            rejects = os.path.join(tmp, 'rejects.csv')
+            result = main.load_status_updates(os.path.join('test_files',
+                                                           'test_mixed_status_updates.csv'),
+                                              self.status_collection,
+                                              tolerant=True,
+                                              options=loader.LoadOptions(rejects=rejects))
+            self.assertTrue(result)
+            self.assertEqual(result.rows_read, 6)
+            self.assertEqual(result.rows_inserted, 2)
+            self.assertEqual(result.rows_rejected, 4)
+            with open(rejects, 'r', encoding='utf-8') as file:
+                rows = list(csv.DictReader(file))
+            self.assertEqual([row['LINE'] for row in rows], ['3', '4', '5', '6'])
+            self.assertIn('Empty value', rows[0]['REASON'])
+            self.assertIn('Invalid STATUS_ID', rows[1]['REASON'])
+            self.assertEqual('Unknown USER_ID mbakke63', rows[2]['REASON'])
+            self.assertEqual('Duplicate STATUS_ID evmiles97_00001 in file',
+                             rows[3]['REASON'])
+            self.assertIn('Duplicate status', rows[3]['STATUS_TEXT'])
+        self.assertIsNotNone(main.search_status('dave03_00002', self.status_collection))
+        # Unknown header and missing file are file level errors
+        result = main.load_users(os.path.join('test_files', 'test_bad_accounts_3.csv'),
+                                 self.user_collection, tolerant=True)
+        self.assertFalse(result)
+        self.assertIn('SOMETHING_ELSE', result.error)
+        result = main.load_users(os.path.join('test_files', 'fake.csv'),
+                                 self.user_collection, tolerant=True)
+        self.assertFalse(result)
+        self.assertEqual(result.rows_read, 0)
+
+    def test_status_stats(self):
+        '''
+        Test status_count and top_posters follow loads, adds and deletes
+        '''
+        main.load_users(os.path.join('test_files', 'test_good_accounts.csv'),
+                        self.user_collection)
+        main.load_status_updates(os.path.join('test_files', 'test_good_status_updates.csv'),
+                                 self.status_collection)
+        self.assertEqual(main.status_count('evmiles97', self.status_collection), 2)
+        self.assertEqual(main.status_count('nobody', self.status_collection), 0)
+        self.assertEqual(main.top_posters(1, self.status_collection), [('evmiles97', 2)])
+        sm.UserStats.bump({'evmiles97': 0}, test_db)
+        self.assertEqual(main.status_count('evmiles97', self.status_collection), 2)
+        main.add_status('dave03', 'dave03_00002', 'again', self.status_collection)
+        main.add_status('dave03', 'dave03_00003', 'and again', self.status_collection)
+        main.delete_status('evmiles97_00001', self.status_collection)
+        self.assertEqual(main.top_posters(5, self.status_collection),
+                         [('dave03', 3), ('evmiles97', 1)])
+        main.delete_user('dave03', self.user_collection)
+        self.assertEqual(main.status_count('dave03', self.status_collection), 0)
+        self.assertEqual(main.top_posters(5, self.status_collection), [('evmiles97', 1)])
+
+    def test_status_timestamps(self):
+        '''
+        Test created_at from loads and adds, time queries and retention
+        '''
+        main.load_users(os.path.join('test_files', 'test_good_accounts.csv'),
+                        self.user_collection)
+        with tempfile.TemporaryDirectory() as tmp:
+            statuses = os.path.join(tmp, 'statuses.csv')
+            with open(statuses, 'w', encoding='utf-8') as file:
+                file.write('STATUS_ID,USER_ID,STATUS_TEXT,CREATED_AT\n'
+                           'dave03_00001,dave03,old,2020-01-01T00:00:00\n'
+                           'dave03_00002,dave03,older,1500000000\n'
+                           'dave03_00003,dave03,unstamped,\n'
+                           'dave03_00004,dave03,bad,yesterday\n'
+                           'x_00001,dave03,not by x,1400000000\n')
+            result = main.load_status_updates(statuses, self.status_collection, tolerant=True)
+        self.assertEqual((result.rows_inserted, result.rows_rejected), (4, 1))
+        self.assertTrue(main.add_status('dave03', 'dave03_00005', 'new', self.status_collection))
+        # An empty CREATED_AT is stamped with the load time
+        recent = main.recent_statuses('dave03', self.status_collection, 4)
+        self.assertEqual([status.status_id for status in recent][2:],
+                         ['dave03_00001', 'dave03_00002'])
+        self.assertEqual(recent[0].created_at, max(status.created_at for status in recent))
+        between = main.statuses_between(self.status_collection, 1500000000, 1550000000)
+        self.assertEqual([status.status_id for status in between], ['dave03_00002'])
+        self.assertEqual(len(main.statuses_between(self.status_collection, start=1500000000)), 4)
+        between = main.statuses_between(self.status_collection, end=1500000000)
+        self.assertEqual([status.status_id for status in between], ['x_00001'])
+        # Nothing is older than the cutoff, so nothing is pruned or maintained
+        with mock.patch.object(sm, 'maintain') as maintain:
+            self.assertEqual(main.prune_statuses(10 ** 10, self.status_collection), 0)
+        maintain.assert_not_called()
+        self.assertEqual(main.prune_statuses(86400, self.status_collection, batch_size=1), 3)
+        # Counts follow the stored owner, not the status_id prefix
+        self.assertEqual(main.status_count('dave03', self.status_collection), 2)
+        self.assertEqual(main.status_count('x', self.status_collection), 0)
+        self.assertIsNone(main.search_status('dave03_00001', self.status_collection))
+        retention = self.status_collection.start_retention(86400, interval=0.01)
+        retention.stop()
+        self.assertFalse(retention.is_alive())
+
     def test_add_user(self):
         '''
         Test add_user method
@@ -129,6 +300,10 @@ class TestMain(unittest.TestCase):
         self.assertTrue(result)
         fail = main.delete_user('fail', user_collection)
         self.assertFalse(fail)
+        user_collection = main.init_user_collection(soft_delete=True)
+        main.add_user('dave03', 'dave@gmail.com', 'dave', 'yuen', user_collection)
+        self.assertTrue(main.delete_user('dave03', user_collection))
+        self.assertIsNone(main.search_user('dave03', user_collection))
 
     def test_search_user(self):
         '''
@@ -142,6 +317,40 @@ class TestMain(unittest.TestCase):
         fail = main.search_user('fail', user_collection)
         self.assertIsNone(fail)
 
+    def test_search_many(self):
+        '''
+        Test bulk lookups take one query per IN batch and report misses
+        '''
+        user_collection = main.init_user_collection(soft_delete=True)
+        for user_id in ('dave03', 'evmiles97', 'gone'):
+            main.add_user(user_id, f'{user_id}@uw.edu', 'Name', 'Last', user_collection)
+            main.add_status(user_id, f'{user_id}_00001', 'hi', self.status_collection)
+        main.delete_user('gone', user_collection)
+        user_ids = ['dave03', 'evmiles97', 'gone'] + [f'nobody{i}' for i in range(1200)]
+        with mock.patch.object(test_db, 'execute_sql', wraps=test_db.execute_sql) as sql:
+            found, missing = main.search_users_many(user_ids, user_collection)
+        self.assertEqual(sql.call_count, 3)
+        self.assertEqual(sorted(found), ['dave03', 'evmiles97'])
+        self.assertEqual(found['dave03'].user_email, 'dave03@uw.edu')
+        self.assertEqual(missing, set(user_ids[2:]))
+        found, missing = main.search_statuses_many(
+            iter(['dave03_00001', 'gone_00001', 'dave03_00001', 'x_1']), self.status_collection)
+        self.assertEqual(list(found), ['dave03_00001'])
+        self.assertEqual(missing, {'gone_00001', 'x_1'})
+        self.assertEqual(main.search_users_many([], user_collection), ({}, set()))
+
+    def test_find_users(self):
+        '''
+        Test find_users method
+        '''
+        main.load_users(os.path.join('test_files', 'test_good_accounts.csv'),
+                        self.user_collection)
+        found = main.find_users(self.user_collection, last_name_prefix='mi')
+        self.assertEqual([user.user_id for user in found], ['evmiles97'])
+        found = main.find_users(self.user_collection, email='DAVID.YUEN@gmail.com')
+        self.assertEqual([user.user_id for user in found], ['dave03'])
+        self.assertEqual(main.find_users(self.user_collection, name_prefix='x'), [])
+
     def test_add_status(self):
         '''
         Test add_status method
@@ -181,6 +390,41 @@ class TestMain(unittest.TestCase):
         fail = main.add_status('fake', 'faketest', 'fake', self.status_collection)
         self.assertFalse(fail)
 
+    def test_allocated_status_ids(self):
+        '''
+        Test add_status and reserve_status_ids allocate unused status_ids
+        '''
+        main.load_users(os.path.join('test_files', 'test_good_accounts.csv'),
+                        self.user_collection)
+        main.load_status_updates(os.path.join('test_files', 'test_good_status_updates.csv'),
+                                 self.status_collection)
+        self.assertEqual(main.add_status('evmiles97', None, 'auto', self.status_collection),
+                         'evmiles97_00003')
+        self.assertEqual(main.reserve_status_ids('evmiles97', 3, self.status_collection),
+                         ['evmiles97_00004', 'evmiles97_00005', 'evmiles97_00006'])
+        self.assertTrue(main.add_status('evmiles97', 'evmiles97_00010', 'manual',
+                                        self.status_collection))
+        self.assertEqual(main.add_status('evmiles97', None, 'auto', self.status_collection),
+                         'evmiles97_00011')
+        self.assertEqual(main.add_status('dave03', None, 'auto', self.status_collection),
+                         'dave03_00002')
+        # A failed add does not use up a number
+        self.assertFalse(main.add_status('nobody', None, 'auto', self.status_collection))
+        self.assertFalse(main.add_status('1234', None, 'auto', self.status_collection))
+        self.assertEqual(main.reserve_status_ids('nobody', 1, self.status_collection),
+                         ['nobody_00001'])
+        self.assertEqual(main.reserve_status_ids('dave03', 0, self.status_collection), [])
+        # Ids not shaped like <user_id>_<number> leave the sequences alone
+        sm.StatusSequence.observe(['hello', 'dave03_latest'], test_db)
+        self.assertEqual(main.reserve_status_ids('dave03', 1, self.status_collection),
+                         ['dave03_00003'])
+        # SQLite before 3.35 has no UPDATE ... RETURNING
+        with mock.patch.object(sm, 'RETURNING', False):
+            self.assertEqual(main.reserve_status_ids('dave03', 1, self.status_collection),
+                             ['dave03_00004'])
+            self.assertEqual(main.reserve_status_ids('andy14', 2, self.status_collection),
+                             ['andy14_00001', 'andy14_00002'])
+
     def test_update_status(self):
         '''
         Test update_status method
@@ -339,13 +583,111 @@ class TestMain(unittest.TestCase):
                   ['asdf123_12345', 'asdf123', {}]]
         for inp in inputs:
             self.assertFalse(main.validate_status_inputs(*inp))
+        self.assertTrue(main.validate_status_id('dave03_00001'))
+        self.assertFalse(main.validate_status_id('dave03_hello'))
+        self.assertTrue(main.validate_status_text('test1'))
+        self.assertFalse(main.validate_status_text(1))
+        self.assertEqual(loader.check_row({'STATUS_ID': 'dave03_00001', 'USER_ID': 'dave03',
+                                           'STATUS_TEXT': 'test1'}, loader.status_keys()),
+                         ({'status_id': 'dave03_00001', 'user_id': 'dave03',
+                           'status_text': 'test1'}, None))
+        self.assertEqual(loader.check_row({'STATUS_ID': 'dave03_hello', 'USER_ID': 'dave03',
+                                           'STATUS_TEXT': 'test1'}, loader.status_keys())[0],
+                         None)
+
+
+class TestCompactKeys(fixtures.ModelTestCase):
+    '''
+    Test the integer rowid key schema through the main API
+    '''
+    models = COMPACT_MODELS
+
+    def test_crud(self):
+        '''
+        Test that the public API behaves the same on compact keys
+        '''
+        main.add_user('dave03', 'dave@gmail.com', 'dave', 'yuen', self.user_collection)
+        self.assertFalse(main.add_user('dave03', 'dave@gmail.com', 'dave', 'yuen',
+                                       self.user_collection))
+        self.assertTrue(main.add_status('dave03', 'dave03_00001', 'Hello',
+                                        self.status_collection))
+        self.assertFalse(main.add_status('eve', 'eve_00001', 'Hello',
+                                         self.status_collection))
+        status = main.search_status('dave03_00001', self.status_collection)
+        self.assertEqual(status.user_id, 'dave03')
+        self.assertIsInstance(status.user_rowid, int)
+        self.assertTrue(main.update_status('dave03_00001', 'dave03', 'Bye',
+                                           self.status_collection))
+        self.assertTrue(main.delete_user('dave03', self.user_collection))
+        self.assertIsNone(main.search_status('dave03_00001', self.status_collection))
+        self.assertIsNone(sm.CompactStatus().user_id)
+
+    def test_load(self):
+        '''
+        Test bulk loads translate user_id to the integer foreign key
+        '''
+        self.assertTrue(main.load_users(os.path.join('test_files', 'test_good_accounts.csv'),
+                                        self.user_collection))
+        self.assertTrue(main.load_status_updates(
+            os.path.join('test_files', 'test_good_status_updates.csv'),
+            self.status_collection))
+        status = main.search_status('dave03_00001', self.status_collection)
+        self.assertEqual(status.user_id, 'dave03')
+        found, _ = main.search_statuses_many(['dave03_00001', 'evmiles97_00001'],
+                                             self.status_collection)
+        with mock.patch.object(test_db, 'execute_sql', wraps=test_db.execute_sql) as sql:
+            self.assertEqual(sorted(status.user_id for status in found.values()),
+                             ['dave03', 'evmiles97'])
+        self.assertEqual(sql.call_count, 0)
+        with tempfile.TemporaryDirectory() as tmp:
+            result = main.load_status_updates(
+                os.path.join('test_files', 'test_mixed_status_updates.csv'),
+                self.status_collection, tolerant=True,
+                options=loader.LoadOptions(rejects=os.path.join(tmp, 'rejects.csv')))
+        self.assertEqual(result.rows_inserted, 1)
+        self.assertEqual(main.recent_statuses('dave03', self.status_collection)[0].user_id,
+                         'dave03')
+        self.assertEqual(main.prune_statuses(-60, self.status_collection), 4)
+        self.assertEqual(main.top_posters(5, self.status_collection), [])
+
+    def test_other_database(self):
+        '''
+        Test statuses read from an unbound database report their own owner
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            database = pw.SqliteDatabase(os.path.join(tmp, 'compact.db'), pragmas=sm.PRAGMAS)
+            sm.create_tables(COMPACT_MODELS, database)
+            user_collection = main.init_user_collection(db=database)
+            user_collection.database = sm.CompactUsers
+            status_collection = main.init_status_collection(db=database)
+            status_collection.database = sm.CompactStatus
+            main.add_user('dave03', 'dave@gmail.com', 'dave', 'yuen', user_collection)
+            main.add_status('dave03', 'dave03_00001', 'Hello', status_collection)
+            # test_db holds a different user under the same rowid
+            main.add_user('eve', 'eve@gmail.com', 'eve', 'smith', self.user_collection)
+            self.assertEqual(main.search_status('dave03_00001', status_collection).user_id,
+                             'dave03')
+            self.assertEqual(main.recent_statuses('dave03', status_collection)[0].user_id,
+                             'dave03')
+            database.close()
+
+    def test_schema_mismatch(self):
+        '''
+        Test a file is refused when it was created with the other key schema
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            text = pw.SqliteDatabase(os.path.join(tmp, 'text.db'))
+            sm.create_tables(sm.TEXT_MODELS, text)
+            with self.assertRaises(sm.SchemaError):
+                sm.create_tables(COMPACT_MODELS, text)
+            text.close()
+            compact = pw.SqliteDatabase(os.path.join(tmp, 'compact.db'))
+            sm.create_tables(COMPACT_MODELS, compact)
+            with self.assertRaises(sm.SchemaError):
+                sm.create_tables(sm.TEXT_MODELS, compact)
+            self.assertNotIn('user_id', [column.name for column in compact.get_columns('status')])
+            compact.close()
 
-    def tearDown(self):
-        '''
-        Remove all tables at end of each test and close db.
-        '''
-        test_db.drop_tables(MODELS)
-        test_db.close()
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,176 @@
+'''
+Unittests for memory.py and loads under a memory budget.
+'''
+import os
+import csv
+import unittest
+import tempfile
+from unittest import mock
+import main
+import memory
+import loader
+import fixtures
+
+
+class TestMemoryTracker(unittest.TestCase):
+    '''
+    Test class for MemoryTracker and size parsing
+    '''
+    def test_parse_size(self):
+        '''
+        Test budgets in bytes and with unit suffixes
+        '''
+        self.assertEqual(memory.parse_size('65536'), 65536)
+        self.assertEqual(memory.parse_size('64k'), 64 << 10)
+        self.assertEqual(memory.parse_size('1.5MB'), 3 << 19)
+        self.assertEqual(memory.parse_size('2G'), 2 << 30)
+        self.assertIsNone(memory.parse_size(''))
+        self.assertIsNone(memory.parse_size(None))
+        for value in ('0', '-1M', 'lots'):
+            with self.assertRaises(ValueError):
+                memory.parse_size(value)
+
+    def test_tracker(self):
+        '''
+        Test peaks are kept across drains and early flushes are counted
+        '''
+        row = {'USER_ID': 'dave03', 'EMAIL': 'dave@uw.edu'}
+        size = memory.row_size(row)
+        tracker = memory.MemoryTracker(budget=2 * size)
+        tracker.add(row)
+        self.assertFalse(tracker.full())
+        tracker.add(row)
+        self.assertTrue(tracker.full())
+        tracker.drain()
+        tracker.add(row)
+        tracker.drain()
+        tracker.drain()
+        report = tracker.report()
+        self.assertEqual((report['peak_rows'], report['peak_bytes']), (2, 2 * size))
+        self.assertEqual((report['flushes'], report['early_flushes']), (2, 1))
+        self.assertEqual((tracker.rows, tracker.bytes), (0, 0))
+        self.assertFalse(memory.MemoryTracker().full())
+
+    def test_max_rss(self):
+        '''
+        Test the peak RSS is reported in bytes, or None without resource
+        '''
+        self.assertGreater(memory.max_rss(), 1 << 20)
+        with mock.patch.object(memory, 'resource', None):
+            self.assertIsNone(memory.max_rss())
+
+
+class TestBudgetedLoads(fixtures.ModelTestCase):
+    '''
+    Test class for loads with a memory_budget
+    '''
+    def setUp(self):
+        '''
+        Bind the models to an in-memory database and write the test files.
+        '''
+        super().setUp()
+        main.load_users(os.path.join('test_files', 'test_good_accounts.csv'),
+                        self.user_collection)
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=R1732
+        self.budget = 3 * memory.row_size({'STATUS_ID': 'dave03_00000', 'USER_ID': 'dave03',
+                                           'STATUS_TEXT': 'Status 0'})
+        self.statuses = self.write('statuses.csv', [f'dave03_{i:05d},dave03,Status {i}'
+                                                    for i in range(10)])
+
+    def write(self, name, lines):
+        '''
+        Writes a status file and returns its path
+        '''
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(['STATUS_ID,USER_ID,STATUS_TEXT'] + lines) + '\n')
+        return path
+
+    def test_strict(self):
+        '''
+        Test a budgeted strict load flushes early and loads every row
+        '''
+        self.assertTrue(main.load_status_updates(self.statuses, self.status_collection,
+                                                 options=loader.LoadOptions(
+                                                     memory_budget=self.budget)))
+        self.assertEqual(main.status_count('dave03', self.status_collection), 10)
+        tracker = memory.MemoryTracker(self.budget)
+        self.assertFalse(loader.load_collection_strict(self.statuses, loader.status_keys(),
+                                                       self.status_collection, tracker=tracker))
+        self.assertEqual(tracker.peak_rows, 3)
+
+    def test_strict_rollback(self):
+        '''
+        Test rows flushed before a late failure are removed again
+        '''
+        lines = [f'dave03_{i:05d},dave03,Status {i}' for i in range(8)]
+        for bad in ('dave03_00099,dave03,', 'dave03_00001,dave03,Again',
+                    'nobody_00001,nobody,Hi'):
+            path = self.write('bad.csv', lines + [bad])
+            tracker = memory.MemoryTracker(self.budget)
+            self.assertFalse(loader.load_collection_strict(path, loader.status_keys(),
+                                                           self.status_collection,
+                                                           tracker=tracker))
+            self.assertEqual(tracker.early_flushes, 2)
+            self.assertIsNone(main.search_status('dave03_00000', self.status_collection))
+            self.assertEqual(main.status_count('dave03', self.status_collection), 0)
+
+    def test_tolerant(self):
+        '''
+        Test the LoadResult reports the buffered peak and early flushes
+        '''
+        rejects = os.path.join(self.tmp.name, 'r.csv')
+        result = main.load_status_updates(self.statuses, self.status_collection, tolerant=True,
+                                          options=loader.LoadOptions(rejects,
+                                                                     memory_budget=self.budget))
+        self.assertEqual((result.rows_inserted, result.chunks), (10, 4))
+        self.assertEqual(result.memory['peak_rows'], 3)
+        self.assertEqual(result.memory['early_flushes'], 3)
+        self.assertEqual(result.memory['budget'], self.budget)
+        result = main.load_status_updates(self.statuses, self.status_collection, tolerant=True,
+                                          options=loader.LoadOptions(rejects))
+        self.assertEqual(result.memory['peak_rows'], 10)
+        self.assertEqual(result.memory['early_flushes'], 0)
+        results = main.load_status_dir(self.tmp.name, self.status_collection,
+                                       loader.LoadOptions(memory_budget=self.budget,
+                                                          workers=0))
+        self.assertEqual([result.memory['peak_rows'] for result in results if result], [10])
+
+    def test_rejected_chunk(self):
+        '''
+        Test a chunk whose rows were all rejected is drained at once
+        '''
+        path = self.write('mixed.csv', ['bad,dave03,Status', 'bad,dave03,Status',
+                                        'dave03_00001,dave03,Status 1',
+                                        'dave03_00002,dave03,Status 2'])
+        tracker = memory.MemoryTracker()
+        result, rejects = loader.LoadResult(path), loader.RejectsBuffer()
+        with open(path, encoding='utf-8') as file, mock.patch.object(loader, 'CHUNK_SIZE', 2):
+            chunks = list(loader.read_chunks(csv.DictReader(file), loader.status_keys(),
+                                             rejects, result, tracker))
+        self.assertEqual([[line_num for line_num, _, _ in chunk] for chunk in chunks], [[4, 5]])
+        self.assertEqual([line_num for line_num, _, _ in rejects.rows], [2, 3])
+        self.assertEqual((result.rows_read, tracker.rows), (4, 2))
+
+    def test_read_ahead(self):
+        '''
+        Test fewer parsed files are held when they would not fit the budget
+        '''
+        result = loader.LoadResult('a.csv')
+        result.memory = {'peak_bytes': 1000}
+        parsed = (result, [], [], [])
+        self.assertEqual(loader.read_ahead(parsed, 4, None), 8)
+        self.assertEqual(loader.read_ahead(parsed, 4, 3500), 3)
+        self.assertEqual(loader.read_ahead(parsed, 4, 10), 1)
+        self.assertEqual(loader.read_ahead(parsed, 4, 10 ** 6), 8)
+
+    def tearDown(self):
+        '''
+        Drop the tables and remove the test files.
+        '''
+        self.tmp.cleanup()
+        super().tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
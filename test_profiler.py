@@ -0,0 +1,108 @@
+'''
+Unittests for profiler.py.
+'''
+import os
+import shutil
+import pstats
+import logging
+import tracemalloc
+import unittest
+import tempfile
+from unittest import mock
+import main
+import profiler
+import fixtures
+
+
+class TestProfiling(fixtures.ModelTestCase):
+    '''
+    Test class for profiler.py
+    '''
+    def setUp(self):
+        '''
+        Bind the models to an in-memory database and make a directory
+        for the profiles.
+        '''
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+
+    def test_profile(self):
+        '''
+        Test a profiled load writes pstats and a summary by component
+        '''
+        with main.profile('load users', self.tmp) as result:
+            self.assertTrue(main.load_users(os.path.join('test_files', 'test_good_accounts.csv'),
+                                            self.user_collection))
+        self.assertGreater(result.seconds, 0)
+        self.assertGreater(result.peak_memory, 0)
+        self.assertEqual(set(result.components),
+                         {'sqlite', 'peewee', 'validation', 'parsing', 'other'})
+        self.assertGreater(result.components['peewee'], 0)
+        self.assertTrue(os.path.basename(result.stats_file).endswith('_load_users.pstats'))
+        self.assertGreater(pstats.Stats(result.stats_file).total_calls, 0)
+        with open(result.summary_file, encoding='utf-8') as file:
+            summary = file.read()
+        self.assertIn('Time by component', summary)
+        self.assertIn('validation.py', summary)
+
+    def test_maybe(self):
+        '''
+        Test maybe() only profiles when enabled and profiles do not nest
+        '''
+        enabled = profiler.ENABLED
+        try:
+            profiler.ENABLED = False
+            with profiler.maybe('off') as result:
+                self.assertIsNone(result)
+            profiler.ENABLED = True
+            with main.profile('outer', self.tmp) as outer:
+                with profiler.maybe('inner') as inner:
+                    pass
+        finally:
+            profiler.ENABLED = enabled
+        self.assertIsNone(inner.stats_file)
+        self.assertEqual(sorted(os.listdir(self.tmp)),
+                         [os.path.basename(outer.stats_file),
+                          os.path.basename(outer.summary_file)])
+
+    def test_outputs(self):
+        '''
+        Test profiles go beside the log file and leave tracemalloc as found
+        '''
+        handler = logging.FileHandler(os.path.join(self.tmp, 'test.log'), delay=True)
+        tracemalloc.start()
+        try:
+            with mock.patch.object(logging.getLogger(), 'handlers',
+                                   [logging.NullHandler(), handler]):
+                with main.profile('traced') as result:
+                    pass
+            self.assertTrue(tracemalloc.is_tracing())
+        finally:
+            tracemalloc.stop()
+            handler.close()
+        self.assertEqual(os.path.dirname(result.stats_file), self.tmp)
+        with mock.patch.object(logging.getLogger(), 'handlers', [logging.NullHandler()]):
+            self.assertEqual(profiler.log_directory(), os.getcwd())
+
+    def test_components(self):
+        '''
+        Test functions are attributed to the expected component
+        '''
+        self.assertEqual(profiler.component(
+            ('~', 0, "<method 'execute' of 'sqlite3.Cursor' objects>")), 'sqlite')
+        self.assertEqual(profiler.component(('/lib/peewee.py', 1, 'sql')), 'peewee')
+        self.assertEqual(profiler.component(('/x/validation.py', 1, 'valid_name')),
+                         'validation')
+        self.assertEqual(profiler.component(('/lib/csv.py', 1, '__next__')), 'parsing')
+        self.assertEqual(profiler.component(('/x/main.py', 1, 'check_rows')), 'other')
+
+    def tearDown(self):
+        '''
+        Drop the tables and delete the profiles.
+        '''
+        super().tearDown()
+        shutil.rmtree(self.tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+'''
+Unittests for readers.py.
+'''
+import io
+import os
+import bz2
+import shutil
+import gzip
+import lzma
+import unittest
+import tempfile
+import time
+from unittest import mock
+import main
+import loader
+import readers
+import fixtures
+import socialnetwork_model as sm
+
+ACCOUNTS = ('USER_ID,EMAIL,NAME,LASTNAME\n'
+            'dave03,dave@uw.edu,Dave,Yuen\n'
+            'evmiles97,eve@uw.edu,Eve,Miles\n')
+
+
+class TestReaders(fixtures.ModelTestCase):
+    '''
+    Test class for readers.py
+    '''
+    def setUp(self):
+        '''
+        Bind model classes to test database and make a scratch directory.
+        '''
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+
+    def path(self, name):
+        '''
+        Returns the path of a scratch file
+        '''
+        return os.path.join(self.tmp, name)
+
+    def test_codecs(self):
+        '''
+        Test compressed CSV files load like plain ones
+        '''
+        for name, opener in [('a.csv.gz', gzip.open), ('b.csv.bz2', bz2.open),
+                             ('c.csv.xz', lzma.open)]:
+            with opener(self.path(name), 'wt', encoding='utf-8') as file:
+                file.write(ACCOUNTS.replace('dave03', name[0] + 'dave03')
+                           .replace('evmiles97', name[0] + 'evmiles97'))
+            self.assertTrue(main.load_users(self.path(name), self.user_collection))
+            with readers.open_rows(self.path(name), readahead=False) as reader:
+                self.assertEqual(reader.fieldnames, ['USER_ID', 'EMAIL', 'NAME', 'LASTNAME'])
+        self.assertEqual(sm.Users.select().count(), 6)
+        self.assertEqual(loader.default_rejects_file(self.path('a.csv.gz')),
+                         self.path('a_rejects.csv'))
+
+    def test_ndjson(self):
+        '''
+        Test newline-delimited JSON rows are validated like CSV rows
+        '''
+        with open(self.path('users.ndjson'), 'w', encoding='utf-8') as file:
+            file.write('{"USER_ID": "dave03", "EMAIL": "dave@uw.edu", '
+                       '"NAME": "Dave", "LASTNAME": "Yuen"}\n'
+                       '\n'
+                       '{"USER_ID": "evmiles97", "EMAIL": "eve@uw.edu", "NAME": "Eve"}\n'
+                       'not json\n'
+                       '{"USER_ID": 12345, "EMAIL": "x@uw.edu", "NAME": "X", '
+                       '"LASTNAME": "Y"}\n'
+                       '["dave03"]\n')
+        result = main.load_users(self.path('users.ndjson'), self.user_collection,
+                                 tolerant=True)
+        self.assertEqual((result.rows_read, result.rows_inserted, result.rows_rejected),
+                         (5, 1, 4))
+        with open(self.path('users_rejects.csv'), encoding='utf-8') as file:
+            lines = [line.split(',')[:2] for line in file.read().splitlines()[1:]]
+        self.assertEqual(lines, [['3', 'Empty value for LASTNAME'],
+                                 ['4', 'Invalid JSON'],
+                                 ['5', 'Invalid USER_ID: 12345'],
+                                 ['6', 'Not a JSON object']])
+        self.assertIsNone(readers.JsonLinesReader(io.StringIO('\n')).fieldnames)
+
+    def test_readahead(self):
+        '''
+        Test the readahead thread delivers every byte and stops early on close
+        '''
+        data = bytes(range(256)) * 1000
+        stream = readers.ReadaheadStream(io.BytesIO(data), block_size=1000, depth=2)
+        self.assertEqual(io.BufferedReader(stream, 333).read(), data)
+        self.assertEqual(stream.read(10), b'')
+        stream.close()
+        stream = readers.ReadaheadStream(io.BytesIO(data), block_size=10, depth=1)
+        self.assertEqual(stream.read(5), data[:5])
+        self.assertEqual(stream.read(5), data[5:10])
+        # Let the thread wait on the full queue before it is stopped
+        time.sleep(0.25)
+        stream.close()
+        self.assertFalse(stream._thread.is_alive())  # pylint: disable=W0212
+        # Read errors reach the consumer, on every later read too
+        broken = mock.Mock(read=mock.Mock(side_effect=OSError('bad block')))
+        stream = readers.ReadaheadStream(broken, block_size=10)
+        for _ in range(2):
+            with self.assertRaises(OSError):
+                stream.read(5)
+        stream.close()
+
+    def test_unsupported(self):
+        '''
+        Test extension handling and a codec that is not installed
+        '''
+        self.assertEqual(readers.split_extensions('x.ndjson.gz'), ('.gz', '.ndjson'))
+        self.assertFalse(readers.is_supported('notes.txt'))
+        with open(self.path('users.csv.zst'), 'wb') as file:
+            file.write(b'\x28\xb5\x2f\xfd')
+        with mock.patch.object(readers, 'zstandard') as zstandard:
+            stream = readers.open_zstd(self.path('users.csv.zst'))
+        decompressor = zstandard.ZstdDecompressor.return_value
+        self.assertIs(stream, decompressor.stream_reader.return_value)
+        file = decompressor.stream_reader.call_args[0][0]
+        file.close()
+        self.assertEqual(file.name, self.path('users.csv.zst'))
+        with mock.patch.object(readers, 'zstandard', None):
+            self.assertFalse(main.load_users(self.path('users.csv.zst'), self.user_collection))
+            result = main.load_users(self.path('users.csv.zst'), self.user_collection,
+                                     tolerant=True)
+            self.assertIn('zstandard', result.error)
+            results = main.load_users_dir(self.tmp, self.user_collection,
+                                          loader.LoadOptions(workers=0))
+            self.assertEqual([(os.path.basename(result.filename), bool(result))
+                              for result in results], [('users.csv.zst', False)])
+
+    def tearDown(self):
+        '''
+        Remove all tables, the scratch directory and close db.
+        '''
+        shutil.rmtree(self.tmp)
+        super().tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+'''
+Unittests for scheduler.py and scheduled loads.
+'''
+import os
+import time
+import unittest
+import tempfile
+import threading
+import main
+import loader
+import scheduler
+import fixtures
+import socialnetwork_model as sm
+
+
+class TestWriteScheduler(unittest.TestCase):
+    '''
+    Test class for WriteScheduler turn ordering
+    '''
+    def test_priority_first(self):
+        '''
+        Test waiting interactive operations go before the next bulk slice
+        '''
+        write_scheduler = scheduler.WriteScheduler(max_bulk_delay=10)
+        order = []
+        with write_scheduler.bulk():
+            interactive = threading.Thread(target=self.take, args=(
+                write_scheduler.priority, order, 'interactive'))
+            bulk = threading.Thread(target=self.take, args=(
+                write_scheduler.bulk, order, 'bulk'))
+            interactive.start()
+            self.wait_for(lambda: write_scheduler.waits['interactive'].count == 0
+                          and write_scheduler._priority_waiting)  # pylint: disable=W0212
+            bulk.start()
+            time.sleep(0.05)
+            self.assertEqual(order, [])
+        interactive.join()
+        bulk.join()
+        self.assertEqual(order, ['interactive', 'bulk'])
+        metrics = write_scheduler.metrics()
+        self.assertEqual(metrics['interactive']['count'], 1)
+        self.assertGreater(metrics['interactive']['max_wait'], 0.04)
+        self.assertEqual(metrics['bulk']['count'], 2)
+
+    def test_slice_rows(self):
+        '''
+        Test slices start at INITIAL_ROWS and follow the smoothed rate
+        '''
+        write_scheduler = scheduler.WriteScheduler(bulk_target=0.5)
+        self.assertEqual(write_scheduler.slice_rows(), scheduler.INITIAL_ROWS)
+        write_scheduler.record_slice(1000, 1.0)
+        self.assertEqual(write_scheduler.slice_rows(), 500)
+        write_scheduler.record_slice(2000, 1.0)
+        self.assertEqual(write_scheduler.slice_rows(limit=100), 100)
+        self.assertEqual(write_scheduler.slice_rows(), 650)
+
+    def test_bulk_not_starved(self):
+        '''
+        Test a bulk slice gets a turn under constant interactive traffic
+        '''
+        write_scheduler = scheduler.WriteScheduler(max_bulk_delay=0.05)
+        stop = threading.Event()
+
+        def interactive():
+            while not stop.is_set():
+                with write_scheduler.priority():
+                    time.sleep(0.001)
+        threads = [threading.Thread(target=interactive) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        try:
+            start = time.perf_counter()
+            with write_scheduler.bulk():
+                waited = time.perf_counter() - start
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        self.assertLess(waited, 1)
+
+    def test_nested_turns(self):
+        '''
+        Test a thread holding a turn can take another without waiting
+        '''
+        write_scheduler = scheduler.WriteScheduler()
+        with write_scheduler.bulk():
+            with write_scheduler.priority():
+                pass
+        self.assertEqual(write_scheduler.metrics()['interactive']['count'], 0)
+
+    @staticmethod
+    def take(turn, order, name):
+        '''
+        Takes one turn and notes it in order
+        '''
+        with turn():
+            order.append(name)
+
+    @staticmethod
+    def wait_for(condition):
+        '''
+        Polls condition for up to a second
+        '''
+        for _ in range(100):
+            if condition():
+                return
+            time.sleep(0.01)
+
+
+class TestScheduledLoads(fixtures.ModelTestCase):
+    '''
+    Test loads through a scheduler commit in slices
+    '''
+    def setUp(self):
+        '''
+        Bind the models to an in-memory database and attach a scheduler.
+        '''
+        super().setUp()
+        self.scheduler = main.start_scheduler(self.user_collection, self.status_collection)
+        # Make the first slices small
+        self.scheduler.rows_per_second = 100 / self.scheduler.bulk_target
+
+    def users(self, count):
+        '''
+        Returns count user rows
+        '''
+        return [{'user_id': f'user{i}', 'user_email': 'a@uw.edu', 'user_name': 'Name',
+                 'user_last_name': 'Last'} for i in range(count)]
+
+    def test_load(self):
+        '''
+        Test strict and tolerant loads are written in several slices
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'users.csv')
+            with open(filename, 'w', encoding='utf-8') as file:
+                file.write('USER_ID,EMAIL,NAME,LASTNAME\n')
+                file.writelines(f'user{i},a@uw.edu,Name,Last\n' for i in range(1000))
+            self.assertTrue(main.load_users(filename, self.user_collection))
+            self.assertEqual(sm.Users.select().count(fixtures.test_db), 1000)
+            slices = self.scheduler.slices
+            self.assertGreater(slices, 1)
+            result = main.load_users(filename, self.user_collection, tolerant=True)
+            self.assertEqual(result.rows_rejected, 1000)
+            with open(filename, 'a', encoding='utf-8') as file:
+                file.writelines(f'user{i},a@uw.edu,Name,Last\n' for i in range(1000, 1500))
+            result = main.load_users(filename, self.user_collection, tolerant=True)
+        self.assertEqual((result.rows_inserted, result.rows_rejected), (500, 1000))
+        self.assertGreater(self.scheduler.slices, slices)
+        self.assertTrue(main.add_status('user1', 'user1_00001', 'hi', self.status_collection))
+        self.assertEqual(self.scheduler.metrics()['interactive']['count'], 1)
+
+    def test_back_out(self):
+        '''
+        Test a failing slice deletes the slices committed before it
+        '''
+        self.assertTrue(loader.insert_all(self.user_collection, self.users(10)))
+        statuses = [{'status_id': f'user{i % 10}_{i:05d}', 'user_id': f'user{i % 10}',
+                     'status_text': 'hi'} for i in range(500)]
+        statuses.append(statuses[0])
+        self.assertFalse(loader.insert_all(self.status_collection, statuses))
+        self.assertEqual(sm.Status.select().count(), 0)
+        self.assertEqual(main.top_posters(5, self.status_collection), [])
+        self.assertFalse(loader.insert_all(self.user_collection, self.users(300) + self.users(1)))
+        self.assertEqual(sm.Users.select().count(fixtures.test_db), 10)
+
+    def tearDown(self):
+        '''
+        Detach the scheduler and drop the tables.
+        '''
+        main.stop_scheduler(self.user_collection, self.status_collection)
+        super().tearDown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+'''
+Unittests for service.py and loadgen.py.
+'''
+import os
+import io
+import shutil
+import unittest
+import tempfile
+import threading
+import contextlib
+from unittest import mock
+import peewee as pw
+import service
+import slowlog
+import loadgen
+
+
+class TestService(unittest.TestCase):
+    '''
+    Test class for service.py
+
+    Request threads open their own connections, so the database is a file.
+    '''
+    group_commit = False
+
+    def setUp(self):
+        '''
+        Start a service on a free port over a temporary database.
+        '''
+        self.tmp = tempfile.mkdtemp()
+        self.server = service.make_server(('127.0.0.1', 0), os.path.join(self.tmp, 'test.db'),
+                                          group_commit=self.group_commit)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address[:2]
+        self.url = f'http://{host}:{port}'
+        self.client = loadgen.Client(self.url)
+
+    def test_users(self):
+        '''
+        Test user operations over one kept-alive connection
+        '''
+        user = loadgen.user('dave03')
+        self.assertEqual(self.client.request('POST', '/users', user), (200, {'ok': True}))
+        self.assertEqual(self.client.request('POST', '/users', user), (409, {'ok': False}))
+        self.assertEqual(self.client.request('GET', '/users/dave03'), (200, user))
+        self.assertEqual(self.client.request('PUT', '/users/dave03',
+                                             dict(user, user_name='David'))[0], 200)
+        self.assertEqual(self.client.request('GET', '/users/dave03')[1]['user_name'], 'David')
+        status, answer = self.client.request('POST', '/users/batch', {'users': [
+            loadgen.user('evmiles97'), user, {'user_id': 'bad'}]})
+        self.assertEqual((status, answer), (200, {'ok': [True, False, False]}))
+        status, answer = self.client.request('POST', '/users/search',
+                                             {'user_ids': ['evmiles97', 'nobody']})
+        self.assertEqual(answer['users']['evmiles97']['user_id'], 'evmiles97')
+        self.assertIsNone(answer['users']['nobody'])
+        self.assertEqual(self.client.request('DELETE', '/users/dave03'), (200, {'ok': True}))
+        self.assertEqual(self.client.request('GET', '/users/dave03')[0], 404)
+
+    def test_statuses(self):
+        '''
+        Test status operations and reports
+        '''
+        self.client.request('POST', '/users', loadgen.user('dave03'))
+        status = {'status_id': 'dave03_00001', 'user_id': 'dave03', 'status_text': 'hi'}
+        self.assertEqual(self.client.request('POST', '/statuses', status)[0], 200)
+        self.assertEqual(self.client.request('POST', '/statuses',
+                                             {'user_id': 'dave03', 'status_text': 'auto'}),
+                         (200, {'ok': True, 'status_id': 'dave03_00002'}))
+        self.assertEqual(self.client.request('GET', '/statuses/dave03_00001'), (200, status))
+        self.assertEqual(self.client.request('PUT', '/statuses/dave03_00001',
+                                             dict(status, status_text='bye'))[0], 200)
+        status, answer = self.client.request('POST', '/statuses/batch', {'statuses': [
+            {'status_id': 'dave03_00003', 'user_id': 'dave03', 'status_text': 'a'},
+            {'status_id': 'nobody_00001', 'user_id': 'nobody', 'status_text': 'b'},
+            {'status_id': 'x_00001', 'user_id': 'dave03', 'status_text': 'c'}]})
+        self.assertEqual(answer, {'ok': [True, False, True]})
+        _, answer = self.client.request('POST', '/statuses/search',
+                                        {'status_ids': ['dave03_00001', 'dave03_00009',
+                                                        'x_00001']})
+        self.assertEqual(answer['statuses']['dave03_00001']['status_text'], 'bye')
+        self.assertIsNone(answer['statuses']['dave03_00009'])
+        self.assertEqual(answer['statuses']['x_00001']['user_id'], 'dave03')
+        self.assertEqual(self.client.request('GET', '/statuses/x_00001')[1]['user_id'], 'dave03')
+        self.assertEqual(self.client.request('GET', '/users/dave03/status_count')[1]['count'], 4)
+        self.assertEqual(self.client.request('GET', '/top_posters?count=1')[1],
+                         {'top_posters': [['dave03', 4]]})
+        self.assertEqual(self.client.request('DELETE', '/statuses/dave03_00001')[0], 200)
+        self.assertEqual(self.client.request('GET', '/statuses/dave03_00001')[0], 404)
+        changes = self.client.request('GET', '/changes?seq=0&limit=2')[1]['changes']
+        self.assertEqual([change['seq'] for change in changes], [1, 2])
+        self.assertEqual(len(self.client.request('GET', '/storage')[1]['storage']), 1)
+
+    def test_bad_requests(self):
+        '''
+        Test malformed requests are answered with an error
+        '''
+        self.assertEqual(self.client.request('GET', '/nowhere')[0], 404)
+        self.assertEqual(self.client.request('POST', '/users/search', {'ids': []})[0], 400)
+        self.assertEqual(self.client.request('POST', '/statuses/search',
+                                             {'status_ids': [1]})[0], 400)
+        self.assertEqual(self.client.request('POST', '/users', ['dave03'])[0], 400)
+        self.assertEqual(self.client.request('GET', '/top_posters?count=x')[0], 400)
+        self.assertEqual(self.client.request('GET', '/changes?shard=99')[0], 400)
+        self.assertEqual(self.client.request('GET', '/changes?shard=-1')[0], 400)
+        with mock.patch('main.top_posters', side_effect=RuntimeError('broken')):
+            self.assertEqual(self.client.request('GET', '/top_posters'),
+                             (500, {'error': 'broken'}))
+        self.assertEqual(self.client.request('GET', '/changes')[0], 200)
+        self.client.connection.request('POST', '/users', b'{', {'Content-Length': '1'})
+        response = self.client.connection.getresponse()
+        self.assertEqual(response.status, 400)
+        response.read()
+        # A body that can't be framed closes the connection
+        for length, status in (('x', 400), ('-1', 400), (str(service.MAX_BODY + 1), 413)):
+            self.client.connection.request('POST', '/users', b'', {'Content-Length': length})
+            response = self.client.connection.getresponse()
+            self.assertEqual((response.status, response.getheader('Connection')),
+                             (status, 'close'))
+            response.read()
+        self.assertEqual(self.client.request('GET', '/changes')[0], 200)
+
+    def test_slow_queries(self):
+        '''
+        Test statements run for the service are timed for the slow-query log
+        '''
+        database = self.server.user_collection.databases()[0]
+        self.assertIsInstance(database, slowlog.SlowQueryDatabase)
+        log = slowlog.SlowQueryLog(threshold=0, path=os.path.join(self.tmp, 'slow.log'))
+        with mock.patch.object(database, 'slow_log', log):
+            self.client.request('GET', '/users/dave03')
+        self.assertTrue(any('SELECT' in entry['sql'] for entry in log.recent()))
+
+    def test_database_error(self):
+        '''
+        Test a database error is answered with 503 and logged
+        '''
+        locked = pw.OperationalError('database is locked')
+        with mock.patch('main.search_user', side_effect=locked), self.assertLogs(level='ERROR'):
+            self.assertEqual(self.client.request('GET', '/users/dave03'),
+                             (503, {'error': 'database is locked'}))
+
+    def test_loadgen(self):
+        '''
+        Test the load generator reports every operation
+        '''
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            loadgen.main(['--url', self.url, '--clients', '2', '--requests', '20',
+                          '--users', '10', '--batch', '3',
+                          '--mix', 'add,search,status,batch,find'])
+        lines = output.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines[1:-1]],
+                         ['add', 'search', 'status', 'batch', 'find', 'all'])
+        self.assertTrue(lines[-1].startswith('0 errors'))
+        # A second run adds the same users again, which the service refuses
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            loadgen.main(['--url', self.url, '--clients', '1', '--requests', '1',
+                          '--users', '10', '--mix', 'add,search'])
+        lines = output.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines[1:-1]], ['add', 'all'])
+        self.assertTrue(lines[-1].startswith('1 errors'))
+
+    def tearDown(self):
+        '''
+        Stop the service and delete the database.
+        '''
+        self.client.close()
+        self.server.shutdown()
+        service.close_server(self.server)
+        shutil.rmtree(self.tmp)
+
+
+class TestServiceGroupCommit(TestService):
+    '''
+    Runs the service tests with group commit on
+    '''
+    group_commit = True
+
+
+class TestCommandLine(unittest.TestCase):
+    '''
+    Test the service and load generator command lines
+    '''
+    def test_serve(self):
+        '''
+        Test serve opens the shards and closes the server on Ctrl-C
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            shards = [os.path.join(tmp, f'shard{i}.db') for i in range(2)]
+            with mock.patch.object(service.SocialNetworkServer, 'serve_forever',
+                                   side_effect=KeyboardInterrupt), \
+                    mock.patch.object(service, 'close_server') as close:
+                service.serve(['--port', '0', '--shards'] + shards)
+            server = close.call_args[0][0]
+            self.assertEqual(len(server.user_collection.shards), 2)
+            service.close_server(server)
+            self.assertEqual(sorted(os.listdir(tmp)), ['shard0.db', 'shard1.db'])
+
+    def test_loadgen_serve(self):
+        '''
+        Test the load generator can start its own service
+        '''
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            loadgen.main(['--serve', '--group-commit', '--clients', '1', '--requests', '4',
+                          '--users', '2'])
+        self.assertTrue(output.getvalue().splitlines()[-1].startswith('0 errors'))
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            loadgen.parse_args(['--mix', 'add,delete'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+'''
+Unittests for sharding.py and sharded collections.
+'''
+import os
+import shutil
+import unittest
+import tempfile
+from unittest import mock
+import peewee as pw
+import main
+import loader
+import sharding
+import socialnetwork_model as sm
+
+
+class TestSharding(unittest.TestCase):
+    '''
+    Test class for sharding.py
+    '''
+    def setUp(self):
+        '''
+        Create three shard files in a temporary directory.
+        '''
+        self.tmp = tempfile.mkdtemp()
+        self.shards = sharding.ShardSet([os.path.join(self.tmp, f'shard{i}.db')
+                                         for i in range(3)])
+        self.user_collection = main.init_user_collection(shards=self.shards)
+        self.status_collection = main.init_status_collection(shards=self.shards)
+
+    def count(self, database, model):
+        '''
+        Counts the rows of model stored in one shard
+        '''
+        return model.select().count(database)
+
+    def test_routing(self):
+        '''
+        Test user_ids map to a stable shard
+        '''
+        self.assertEqual(sharding.status_owner('dave03_00001'), 'dave03')
+        self.assertEqual(self.shards.index_for('dave03'), self.shards.index_for('dave03'))
+        parts = self.shards.partition(['a', 'b', 'c', 'd'], lambda item: item)
+        self.assertEqual(sum(len(part) for part in parts.values()), 4)
+        self.assertEqual(len(self.shards), 3)
+
+    def test_crud(self):
+        '''
+        Test users and their statuses are stored in the user's shard
+        '''
+        user_ids = [f'user{i}' for i in range(12)]
+        for user_id in user_ids:
+            self.assertTrue(main.add_user(user_id, f'{user_id}@uw.edu', 'Name', 'Last',
+                                          self.user_collection))
+            self.assertTrue(main.add_status(user_id, f'{user_id}_00001', 'hi',
+                                            self.status_collection))
+        self.assertFalse(main.add_user('user1', 'a@uw.edu', 'Name', 'Last',
+                                       self.user_collection))
+        self.assertFalse(main.add_status('user1', 'user2_00002', 'hi',
+                                         self.status_collection))
+        for user_id in user_ids:
+            database = self.shards.database_for(user_id)
+            self.assertTrue(sm.Users.select().where(sm.Users.user_id == user_id)
+                            .exists(database))
+            self.assertEqual(main.search_user(user_id, self.user_collection).user_id, user_id)
+            self.assertEqual(main.search_status(f'{user_id}_00001',
+                                                self.status_collection).user_id, user_id)
+        self.assertTrue(all(self.count(database, sm.Users) for database in
+                            self.shards.databases))
+        found, missing = main.search_users_many(user_ids + ['nobody'], self.user_collection)
+        self.assertEqual((sorted(found), missing), (sorted(user_ids), {'nobody'}))
+        found, _ = main.search_statuses_many([f'{user_id}_00001' for user_id in user_ids],
+                                             self.status_collection)
+        self.assertEqual(len(found), 12)
+        self.assertTrue(main.update_user('user3', 'new@uw.edu', 'New', 'Last',
+                                         self.user_collection))
+        self.assertTrue(main.update_status('user3_00001', 'user3', 'bye',
+                                           self.status_collection))
+        self.assertTrue(main.delete_status('user3_00001', self.status_collection))
+        self.assertTrue(main.delete_user('user4', self.user_collection))
+        self.assertEqual(main.add_status('user5', None, 'auto', self.status_collection),
+                         'user5_00002')
+        self.assertIsNone(main.search_status('user4_00001', self.status_collection))
+        # Sorted by name then user_id across shards; user3 was renamed
+        found = main.find_users(self.user_collection, name_prefix='na', page=2, page_size=5)
+        self.assertEqual([user.user_id for user in found],
+                         ['user5', 'user6', 'user7', 'user8', 'user9'])
+
+    def test_load(self):
+        '''
+        Test strict and tolerant loads route rows to their shards
+        '''
+        for load, filename, collection in [
+                (main.load_users, 'test_good_accounts.csv', self.user_collection),
+                (main.load_status_updates, 'test_good_status_updates.csv',
+                 self.status_collection)]:
+            self.assertTrue(load(os.path.join('test_files', filename), collection))
+        for user_id in ['evmiles97', 'dave03']:
+            self.assertEqual(main.search_status(f'{user_id}_00001',
+                                                self.status_collection).user_id, user_id)
+        self.assertEqual(sum(self.count(database, sm.Status)
+                             for database in self.shards.databases), 3)
+        statuses = os.path.join(self.tmp, 'statuses.csv')
+        with open(statuses, 'w', encoding='utf-8') as file:
+            file.write('STATUS_ID,USER_ID,STATUS_TEXT\n'
+                       'dave03_00002,dave03,ok\n'
+                       'dave03_00003,evmiles97,wrong owner\n'
+                       'evmiles97_00003,evmiles97,ok\n')
+        result = main.load_status_updates(statuses, self.status_collection, tolerant=True)
+        self.assertEqual((result.rows_inserted, result.rows_rejected), (2, 1))
+
+    def test_strict_partial_failure(self):
+        '''
+        Test a strict load removes the rows of shards that committed when
+        another shard fails
+        '''
+        accounts = os.path.join(self.tmp, 'accounts.csv')
+        with open(accounts, 'w', encoding='utf-8') as file:
+            file.write('USER_ID,EMAIL,NAME,LASTNAME\n')
+            file.writelines(f'user{i},user{i}@uw.edu,Name,Last\n' for i in range(12))
+        failing = self.shards.database_for('user0')
+        insert_all = loader.insert_all
+
+        def insert_or_fail(collection, data, database=None):
+            if database is failing:
+                raise pw.OperationalError('database is locked')
+            return insert_all(collection, data, database)
+
+        with mock.patch('loader.insert_all', side_effect=insert_or_fail), \
+                self.assertLogs(level='ERROR') as logs:
+            self.assertFalse(main.load_users(accounts, self.user_collection))
+        self.assertTrue(any('failed on 1 of 3 shards' in line for line in logs.output))
+        self.assertEqual([self.count(database, sm.Users)
+                          for database in self.shards.databases], [0, 0, 0])
+        self.assertTrue(main.load_users(accounts, self.user_collection))
+
+    def test_purge(self):
+        '''
+        Test purge_deleted visits every shard
+        '''
+        collection = main.init_user_collection(soft_delete=True, shards=self.shards)
+        for i in range(6):
+            main.add_user(f'user{i}', 'a@uw.edu', 'Name', 'Last', collection)
+            main.add_status(f'user{i}', f'user{i}_00001', 'hi', self.status_collection)
+            main.delete_user(f'user{i}', collection)
+        self.assertEqual(collection.purge_deleted(), (6, 6))
+
+    def tearDown(self):
+        '''
+        Close and delete the shard files.
+        '''
+        self.shards.close()
+        shutil.rmtree(self.tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+'''
+Unittests for slowlog.py.
+'''
+import os
+import shutil
+import unittest
+import tempfile
+import main
+import slowlog
+import socialnetwork_model as sm
+
+MODELS = sm.MODELS
+
+
+class TestSlowLog(unittest.TestCase):
+    '''
+    Test class for slowlog.py
+    '''
+    def setUp(self):
+        '''
+        Create a database whose log records every statement.
+        '''
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'slow.log')
+        self.log = slowlog.SlowQueryLog(0, self.path, max_bytes=4096, backups=2)
+        self.database = slowlog.SlowQueryDatabase(os.path.join(self.tmp, 'test.db'),
+                                                  pragmas=sm.PRAGMAS, slow_log=self.log)
+        sm.create_tables(MODELS, self.database)
+        self.log.clear()
+
+    def test_record(self):
+        '''
+        Test statements are logged with redacted parameters and plans
+        '''
+        with self.database.bind_ctx(MODELS):
+            sm.Users.create(user_id='dave03', user_email='dave@uw.edu',
+                            user_name='Dave', user_last_name='Yuen')
+            sm.Users.get(sm.Users.user_id == 'dave03')
+            list(sm.Users.select().where(sm.Users.user_email == 'dave@uw.edu'))
+        entries = self.log.recent()
+        self.assertEqual(entries[0]['params'], ['<str:11>'])
+        self.assertEqual(entries[0]['problems'], ['SCAN t1'])
+        lookup = entries[1]
+        self.assertRegex(lookup['plan'][0], r'SEARCH t1 USING INDEX \w+ \(user_id=\?\)')
+        self.assertEqual(lookup['problems'], [])
+        self.assertEqual(lookup['database'], self.database.database)
+        self.assertEqual(len(self.log.recent(problems_only=True)), 1)
+        summary = self.log.summary()
+        self.assertEqual(sum(group['count'] for group in summary), len(self.log.entries))
+        self.assertEqual([entry['sql'] for entry in slowlog.read_log(self.path)][-1],
+                         entries[0]['sql'])
+
+    def test_threshold(self):
+        '''
+        Test fast statements and a disabled log record nothing
+        '''
+        self.log.threshold = 60
+        self.database.execute_sql('SELECT 1')
+        self.log.threshold = None
+        self.database.execute_sql('SELECT 1')
+        self.assertEqual(self.log.recent(), [])
+        self.assertEqual(slowlog.threshold_seconds('250'), 0.25)
+        self.assertIsNone(slowlog.threshold_seconds('off'))
+        self.assertEqual(slowlog.redact(['text', b'xy', 3, None]),
+                         ['<str:4>', '<blob:2>', 3, None])
+
+    def test_rotation(self):
+        '''
+        Test the file rotates and read_log reads the rotated files too
+        '''
+        for i in range(100):
+            self.database.execute_sql('SELECT ?', (i,))
+        self.assertTrue(os.path.exists(self.path + '.1'))
+        self.assertEqual([entry['params'] for entry in slowlog.read_log(self.path)][-1], [99])
+        self.assertEqual(main.slow_queries(1), slowlog.SLOW_LOG.recent(1))
+        self.assertEqual(main.slow_query_summary(), slowlog.SLOW_LOG.summary())
+
+    def test_plan_error(self):
+        '''
+        Test a statement whose plan fails keeps the error, and a log
+        without a file keeps its entries in memory only
+        '''
+        log = slowlog.SlowQueryLog(0, None)
+        log.record(self.database, 'SELECT * FROM missing', None, 1.0)
+        entry = log.recent()[0]
+        self.assertEqual(entry['plan'], [])
+        self.assertIn('no such table', entry['plan_error'])
+        self.assertIsNone(log.logger())
+        # Logs on the same file share its handler; blank lines are skipped
+        self.log.record(self.database, 'SELECT 1', None, 1.0)
+        again = slowlog.SlowQueryLog(0, self.path)
+        self.assertEqual(again.logger().handlers, self.log.logger().handlers)
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write('\n')
+        self.assertEqual([entry['sql'] for entry in slowlog.read_log(self.path)][-1],
+                         'SELECT 1')
+
+    def tearDown(self):
+        '''
+        Close the database and delete the files.
+        '''
+        self.database.close()
+        for handler in self.log.logger().handlers:
+            handler.close()
+        shutil.rmtree(self.tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+'''
+Unittests for snapshots.py.
+'''
+import os
+import unittest
+import tempfile
+import peewee as pw
+import main
+import fixtures
+import snapshots
+import socialnetwork_model as sm
+
+test_db = fixtures.test_db
+
+
+class TestSnapshot(fixtures.ModelTestCase):
+    '''
+    Test the online snapshot API
+    '''
+    def setUp(self):
+        '''
+        Bind model classes to test database and add some data.
+        '''
+        super().setUp()
+        for i in range(50):
+            main.add_user(f'user{i}', f'user{i}@uw.edu', 'Name', 'Last',
+                          self.user_collection)
+            main.add_status(f'user{i}', f'user{i}_00001', 'hi', self.status_collection)
+
+    def test_snapshot(self):
+        '''
+        Test a snapshot is a consistent, read-only copy
+        '''
+        with snapshots.snapshot(database=test_db, pages=1, sleep=0) as snap:
+            path = snap.path
+            main.add_user('later', 'later@uw.edu', 'Name', 'Last', self.user_collection)
+            user_collection = main.init_user_collection(db=snap.database)
+            status_collection = main.init_status_collection(db=snap.database)
+            self.assertEqual(main.search_user('user7', user_collection).user_id, 'user7')
+            self.assertIsNone(main.search_user('later', user_collection))
+            self.assertEqual(main.search_status('user7_00001', status_collection).user_id,
+                             'user7')
+            self.assertEqual(len(main.find_users(user_collection, name_prefix='na',
+                                                 page_size=100)), 50)
+            self.assertEqual(snap.database.execute_sql('PRAGMA query_only').fetchone()[0], 1)
+            with self.assertRaises(pw.OperationalError):
+                main.add_user('new', 'new@uw.edu', 'Name', 'Last', user_collection)
+        self.assertFalse(os.path.exists(path))
+        # A snapshot taken to a given path is kept
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'copy.db')
+            with snapshots.snapshot(path, database=test_db, sleep=0) as snap:
+                self.assertEqual(snap.path, path)
+            self.assertTrue(os.path.exists(path))
+
+
+class TestMigration(unittest.TestCase):
+    '''
+    Test the migration from text keys to compact keys
+    '''
+    def test_migrate_to_compact_keys(self):
+        '''
+        Test copying a text key database into the compact schema
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            source = pw.SqliteDatabase(os.path.join(tmp, 'text.db'))
+            with source.bind_ctx(sm.TEXT_MODELS):
+                source.create_tables(sm.TEXT_MODELS)
+                sm.TextUsers.create(user_id='dave03', user_email='dave@gmail.com',
+                                    user_name='dave', user_last_name='yuen')
+                sm.TextStatus.create(status_id='dave03_00001', user_id='dave03',
+                                     status_text='Hello')
+            source.close()
+            target = os.path.join(tmp, 'compact.db')
+            self.assertEqual(snapshots.migrate_to_compact_keys(source.database, target), (1, 1))
+            migrated = pw.SqliteDatabase(target)
+            with migrated.bind_ctx(sm.COMPACT_MODELS):
+                status = sm.CompactStatus.get(sm.CompactStatus.status_id == 'dave03_00001')
+                self.assertEqual(status.user_id, 'dave03')
+                self.assertEqual(sm.UserStats.get_by_id('dave03').status_count, 1)
+                self.assertEqual(sm.StatusSequence.get_by_id('dave03').next_value, 2)
+            migrated.close()
+
+    def test_migrate_safely(self):
+        '''
+        Test a migration leaves its source alone and replaces the target
+        only after the check
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            source = pw.SqliteDatabase(os.path.join(tmp, 'text.db'))
+            # A file from before the deleted and created_at columns
+            source.execute_sql('CREATE TABLE users (user_id VARCHAR(30) PRIMARY KEY, '
+                               'user_email TEXT, user_name TEXT, user_last_name TEXT)')
+            source.execute_sql('CREATE TABLE status (status_id VARCHAR(30) PRIMARY KEY, '
+                               'user_id VARCHAR(30) REFERENCES users (user_id), '
+                               'status_text TEXT)')
+            source.execute_sql("INSERT INTO users VALUES ('dave03', 'd@uw.edu', 'D', 'Y')")
+            source.execute_sql("INSERT INTO status VALUES ('dave03_00001', 'dave03', 'hi')")
+            target = os.path.join(tmp, 'compact.db')
+            counts = snapshots.migrate_to_compact_keys(source.database, target, dry_run=True)
+            self.assertEqual(counts, (1, 1))
+            self.assertEqual(sorted(os.listdir(tmp)), ['text.db'])
+            self.assertEqual(snapshots.migrate_to_compact_keys(source.database, target), (1, 1))
+            self.assertEqual(sorted(os.listdir(tmp)), ['compact.db', 'text.db'])
+            self.assertNotIn('deleted', [column.name for column in source.get_columns('users')])
+            # A status whose user is missing fails the check
+            source.execute_sql("INSERT INTO status VALUES ('eve_00001', 'eve', 'hi')")
+            source.close()
+            with self.assertRaises(snapshots.MigrationError):
+                snapshots.migrate_to_compact_keys(source.database, target)
+            self.assertEqual(sorted(os.listdir(tmp)), ['compact.db', 'text.db'])
+            migrated = pw.SqliteDatabase(target)
+            with migrated.bind_ctx(sm.COMPACT_MODELS):
+                self.assertEqual([status.status_id for status in sm.CompactStatus.select()],
+                                 ['dave03_00001'])
+            migrated.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
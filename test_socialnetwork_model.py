@@ -0,0 +1,327 @@
+'''
+Unittests for socialnetwork_model.py.
+'''
+import os
+import time
+import zlib
+import shutil
+import unittest
+import tempfile
+import peewee as pw
+import main
+import fixtures
+import socialnetwork_model as sm
+
+MODELS = sm.MODELS
+test_db = fixtures.test_db
+
+
+class TestChangeLog(fixtures.ModelTestCase):
+    '''
+    Test the change data capture log
+    '''
+    def test_changes_since(self):
+        '''
+        Test collection calls, bulk loads and cascades are all logged
+        '''
+        main.load_users(os.path.join('test_files', 'test_good_accounts.csv'),
+                        self.user_collection)
+        main.load_status_updates(os.path.join('test_files', 'test_good_status_updates.csv'),
+                                 self.status_collection)
+        seq = list(main.changes_since(self.user_collection))[-1]['seq']
+        main.update_user('dave03', 'dave@uw.edu', 'Dave', 'Yuen', self.user_collection)
+        main.add_status('dave03', 'dave03_00002', 'hi', self.status_collection)
+        main.delete_user('dave03', self.user_collection)
+        changes = list(main.changes_since(self.status_collection, seq))
+        self.assertEqual([(change['table'], change['op'], change['key'])
+                          for change in changes],
+                         [('users', 'update', 'dave03'),
+                          ('status', 'insert', 'dave03_00002'),
+                          ('status', 'delete', 'dave03_00001'),
+                          ('status', 'delete', 'dave03_00002'),
+                          ('users', 'delete', 'dave03')])
+        self.assertEqual(changes[0]['data']['user_email'], 'dave@uw.edu')
+        self.assertIsInstance(changes[1]['data'].pop('created_at'), float)
+        self.assertEqual(changes[1]['data'], {'user_id': 'dave03', 'status_text': 'hi'})
+        self.assertIsNone(changes[-1]['data'])
+        # Streams in batches, limit caps the total
+        self.assertEqual([change['seq'] for change in
+                          sm.changes_since(seq, limit=3, database=test_db, batch_size=2)],
+                         [seq + 1, seq + 2, seq + 3])
+        self.assertEqual(len(list(sm.changes_since(seq, database=test_db, batch_size=2))), 5)
+
+    def test_retention(self):
+        '''
+        Test compaction keeps the newest entry per key and pruning drops old ones
+        '''
+        main.add_user('dave03', 'dave@uw.edu', 'Dave', 'Yuen', self.user_collection)
+        for i in range(3):
+            main.update_user('dave03', f'dave{i}@uw.edu', 'Dave', 'Yuen', self.user_collection)
+        main.add_user('evmiles97', 'ev@uw.edu', 'Eve', 'Miles', self.user_collection)
+        # Entries after upto_seq are left alone
+        self.assertEqual(sm.compact_changes(upto_seq=3, database=test_db), 2)
+        self.assertEqual(sm.compact_changes(database=test_db), 1)
+        changes = list(sm.changes_since(database=test_db))
+        self.assertEqual([(change['key'], change['op']) for change in changes],
+                         [('dave03', 'update'), ('evmiles97', 'insert')])
+        self.assertEqual(changes[0]['data']['user_email'], 'dave2@uw.edu')
+        self.assertEqual(sm.prune_changes(keep=1, database=test_db), 1)
+        self.assertEqual(sm.prune_changes(max_age=3600, database=test_db), 0)
+        self.assertEqual(sm.prune_changes(max_age=-1, database=test_db), 1)
+        self.assertEqual(sm.prune_changes(database=test_db), 0)
+        # Sequence numbers are not reused after pruning
+        main.add_user('andy14', 'andy@uw.edu', 'Andy', 'Smith', self.user_collection)
+        self.assertEqual(list(sm.changes_since(database=test_db))[0]['seq'],
+                         changes[-1]['seq'] + 1)
+
+    def test_compact_keys(self):
+        '''
+        Test status changes log the owner's user_id under integer keys
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            database = pw.SqliteDatabase(os.path.join(tmp, 'compact.db'),
+                                         pragmas={'foreign_keys': 1})
+            sm.create_tables(sm.COMPACT_MODELS, database)
+            with database.bind_ctx(sm.COMPACT_MODELS):
+                sm.CompactUsers.create(user_id='dave03', user_email='dave@uw.edu',
+                                       user_name='Dave', user_last_name='Yuen')
+                sm.CompactStatus.create(status_id='dave03_00001', user_id='dave03',
+                                        status_text='hi')
+            change = list(sm.changes_since(database=database))[-1]
+            self.assertIsInstance(change['data'].pop('created_at'), float)
+            self.assertEqual(change['data'], {'user_id': 'dave03', 'status_text': 'hi'})
+            database.close()
+
+
+class TestCompression(fixtures.ModelTestCase):
+    '''
+    Test compressed status_text storage
+    '''
+    def setUp(self):
+        '''
+        Bind model classes to test database and turn compression on.
+        '''
+        super().setUp()
+        main.add_user('dave03', 'dave@uw.edu', 'Dave', 'Yuen', self.user_collection)
+        self.text = 'Sunny in Seattle this morning, perfect weather for a hike ' * 3
+
+    def stored(self, status_id):
+        '''
+        Returns the raw status_text column of a status
+        '''
+        return test_db.execute_sql('SELECT status_text FROM status WHERE status_id = ?',
+                                   (status_id,)).fetchone()[0]
+
+    def test_compressed_text(self):
+        '''
+        Test compressed, plain and dictionary rows read back transparently
+        '''
+        main.add_status('dave03', 'dave03_00001', self.text, self.status_collection)
+        sm.Status.status_text.compress = True
+        main.add_status('dave03', 'dave03_00002', self.text, self.status_collection)
+        main.add_status('dave03', 'dave03_00003', 'hi', self.status_collection)
+        self.assertIsInstance(self.stored('dave03_00001'), str)
+        self.assertLess(len(self.stored('dave03_00002')), len(self.text))
+        # Too short to gain from compression
+        self.assertEqual(self.stored('dave03_00003'), 'hi')
+        dict_id = self.status_collection.train_dictionary(samples=10)
+        main.update_status('dave03_00003', 'dave03', self.text, self.status_collection)
+        self.assertEqual(int.from_bytes(self.stored('dave03_00003')[2:6], 'big'), dict_id)
+        for status_id in ['dave03_00001', 'dave03_00002', 'dave03_00003']:
+            self.assertEqual(main.search_status(status_id, self.status_collection).status_text,
+                             self.text)
+        change = list(main.changes_since(self.status_collection))[-1]
+        self.assertEqual(change['data']['status_text'], self.text)
+        # Dictionaries are reloaded from the database
+        sm.CompressedTextField.dictionaries.clear()
+        sm.load_dictionaries(test_db)
+        self.assertEqual(main.search_status('dave03_00003',
+                                            self.status_collection).status_text, self.text)
+        self.assertEqual(sm.recompress_statuses(database=test_db, batch_size=2), 3)
+        self.assertIsInstance(self.stored('dave03_00001'), bytes)
+        # A blob compressed with a dictionary this database never stored
+        compressor = zlib.compressobj(zdict=b'a dictionary nobody registered')
+        with self.assertRaises(ValueError):
+            sm.CompressedTextField.decode(compressor.compress(b'hi') + compressor.flush())
+
+    def test_train_dictionary(self):
+        '''
+        Test the dictionary favours repeated words and respects its size
+        '''
+        data = sm.train_dictionary(['hello world again', 'hello world', 'once'], size=64)
+        self.assertIn(b'hello world', data)
+        self.assertNotIn(b'once', data)
+        self.assertLessEqual(len(sm.train_dictionary([self.text] * 5, size=16)), 16)
+
+    def tearDown(self):
+        '''
+        Turn compression off, remove all tables and close db.
+        '''
+        sm.Status.status_text.compress = False
+        sm.use_dictionary(None)
+        super().tearDown()
+
+
+class TestMaintenance(unittest.TestCase):
+    '''
+    Test post-load maintenance
+    '''
+    def setUp(self):
+        '''
+        Bind model classes to a database file created with incremental
+        auto_vacuum.
+        '''
+        self.tmp = tempfile.mkdtemp()
+        self.database = pw.SqliteDatabase(os.path.join(self.tmp, 'maintain.db'),
+                                          pragmas=sm.PRAGMAS)
+        self.database.bind(MODELS, bind_refs=False, bind_backrefs=False)
+        sm.create_tables(MODELS, self.database)
+        self.user_collection = main.init_user_collection()
+        self.status_collection = main.init_status_collection()
+        self.thresholds = sm.ANALYZE_ROWS, sm.VACUUM_MIN_PAGES
+        sm.ANALYZE_ROWS, sm.VACUUM_MIN_PAGES = 100, 8
+
+    def test_maintain(self):
+        '''
+        Test a big load is analyzed and a mass delete is vacuumed
+        '''
+        accounts = os.path.join(self.tmp, 'accounts.csv')
+        with open(accounts, 'w', encoding='utf-8') as file:
+            file.write('USER_ID,EMAIL,NAME,LASTNAME\n')
+            for i in range(2000):
+                file.write(f'user{i},user{i}@uw.edu,Name,{"Last" * 20}\n')
+        self.assertTrue(main.load_users(accounts, self.user_collection))
+        self.assertGreater(self.database.execute_sql(
+            "SELECT COUNT(*) FROM sqlite_stat1 WHERE tbl = 'users'").fetchone()[0], 0)
+        stats = main.storage_stats(self.user_collection)[0]
+        self.assertEqual(stats['auto_vacuum'], 'incremental')
+        self.assertEqual(stats['pending_changes'], 0)
+        size = stats['file_size']
+        sm.Users.delete().execute(self.database)  # pylint: disable=E1120
+        self.assertGreater(sm.storage_stats(self.database)['freelist_count'], 0)
+        report = main.maintain(self.user_collection)[0]
+        self.assertFalse(report['analyzed'])
+        self.assertGreater(report['vacuumed_pages'], 0)
+        self.assertLess(report['file_size'], size)
+        # A budget of 0 seconds vacuums nothing
+        self.assertEqual(sm.incremental_vacuum(self.database, budget=0), 0)
+
+    def test_enable_incremental_vacuum(self):
+        '''
+        Test an existing file can be switched to incremental vacuum
+        '''
+        path = os.path.join(self.tmp, 'plain.db')
+        database = pw.SqliteDatabase(path)
+        database.execute_sql('CREATE TABLE t (x)')
+        self.assertEqual(sm.storage_stats(database)['auto_vacuum'], 'none')
+        self.assertEqual(sm.incremental_vacuum(database), 0)
+        self.assertTrue(sm.enable_incremental_vacuum(database))
+        self.assertFalse(sm.enable_incremental_vacuum(database))
+        self.assertEqual(sm.storage_stats(database)['auto_vacuum'], 'incremental')
+        database.close()
+
+    def tearDown(self):
+        '''
+        Restore the thresholds, close and delete the database.
+        '''
+        sm.ANALYZE_ROWS, sm.VACUUM_MIN_PAGES = self.thresholds
+        self.database.close()
+        shutil.rmtree(self.tmp)
+
+
+class TestSchema(unittest.TestCase):
+    '''
+    Test how the models are found and related
+    '''
+    def test_status_model(self):
+        '''
+        Test the status model is found by its foreign key, not by position
+        '''
+        self.assertIs(sm.status_model(sm.TextUsers), sm.TextStatus)
+        self.assertIs(sm.status_model(sm.CompactUsers), sm.CompactStatus)
+
+        class Member(sm.BaseModel):
+            '''
+            A users model that only a non-status model references
+            '''
+            user_id = pw.CharField(primary_key=True)
+
+        class Follow(sm.BaseModel):  # pylint: disable=W0612
+            '''
+            A model referencing Member under the same field name
+            '''
+            user = pw.ForeignKeyField(Member)
+
+        with self.assertRaises(ValueError):
+            sm.status_model(Member)
+
+    def test_without_derived_models(self):
+        '''
+        Test tables created without ChangeLog get no change log triggers
+        '''
+        database = pw.SqliteDatabase(':memory:')
+        sm.create_tables([sm.Users, sm.Status], database)
+        self.assertEqual(database.get_tables(), ['status', 'users'])
+        self.assertEqual(database.execute_sql(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger'").fetchone()[0], 0)
+        database.close()
+
+
+class TestUpgrade(unittest.TestCase):
+    '''
+    Test opening a database file written by the original schema
+    '''
+    SCHEMA = [
+        'CREATE TABLE "users" ("user_id" VARCHAR(30) NOT NULL PRIMARY KEY, '
+        '"user_name" VARCHAR(30) NOT NULL, "user_last_name" VARCHAR(100) NOT NULL, '
+        '"user_email" VARCHAR(255) NOT NULL, CHECK (LENGTH(user_id) < 30), '
+        'CHECK (LENGTH(user_name) < 30), CHECK (LENGTH(user_last_name) < 100))',
+        'CREATE TABLE "status" ("status_id" VARCHAR(255) NOT NULL PRIMARY KEY, '
+        '"user_id" VARCHAR(30) NOT NULL, "status_text" VARCHAR(255) NOT NULL, '
+        'FOREIGN KEY ("user_id") REFERENCES "users" ("user_id") ON DELETE CASCADE)',
+        'CREATE INDEX "status_user_id" ON "status" ("user_id")']
+
+    def test_upgrade(self):
+        '''
+        Test new columns are added without losing any users or statuses
+        '''
+        with tempfile.TemporaryDirectory() as tmp:
+            database = pw.SqliteDatabase(os.path.join(tmp, 'old.db'), pragmas=sm.PRAGMAS)
+            for sql in self.SCHEMA:
+                database.execute_sql(sql)
+            for user_id in ['dave03', 'evmiles97']:
+                database.execute_sql('INSERT INTO users VALUES (?, ?, ?, ?)',
+                                     (user_id, 'Name', 'Last', f'{user_id}@uw.edu'))
+            for status_id in ['dave03_00001', 'dave03_00002', 'evmiles97_00001']:
+                database.execute_sql('INSERT INTO status VALUES (?, ?, ?)',
+                                     (status_id, status_id.rsplit('_', 1)[0], 'hi'))
+            sm.create_tables(sm.TEXT_MODELS, database)
+            with database.bind_ctx(sm.TEXT_MODELS):
+                self.assertEqual(sm.TextUsers.select().count(database), 2)
+                self.assertEqual(sm.TextStatus.select().count(database), 3)
+                self.assertFalse(sm.TextUsers.get_by_id('dave03').deleted)
+                self.assertIsNone(sm.TextStatus.get_by_id('dave03_00001').created_at)
+                self.assertEqual(sm.UserStats.get_by_id('dave03').status_count, 2)
+            database.close()
+
+    def test_column_definition(self):
+        '''
+        Test added columns get their constant default inlined, and columns
+        that cannot be added in place are refused
+        '''
+        class Extra(sm.BaseModel):
+            '''
+            A model with the kinds of NOT NULL defaults a new column may have
+            '''
+            label = pw.CharField(default="it's")
+            rank = pw.IntegerField(default=3)
+            stamp = pw.FloatField(default=time.time)
+
+        self.assertTrue(sm.column_definition(Extra, Extra.label).endswith("DEFAULT 'it''s'"))
+        self.assertTrue(sm.column_definition(Extra, Extra.rank).endswith('DEFAULT 3'))
+        with self.assertRaises(sm.SchemaError):
+            sm.column_definition(Extra, Extra.stamp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,29 +2,21 @@
 Unittests for users.py.
 Author: Kathleen Wong
 '''
+import os
 import unittest
+import tempfile
 import peewee as pw
 import users
+import fixtures
 import socialnetwork_model as sm
 
-MODELS = [sm.Users, sm.Status]
-test_db = pw.SqliteDatabase(':memory:')
+test_db = fixtures.test_db
 
 
-class TestUser(unittest.TestCase):
+class TestUser(fixtures.ModelTestCase):
     '''
     Test class for users.py
     '''
-    def setUp(self):
-        '''
-        setUp method to disable logging.
-        '''
-        test_db.bind(MODELS, bind_refs=False, bind_backrefs=False)
-        test_db.connect()
-        test_db.create_tables(MODELS)
-        test_db.execute_sql('PRAGMA foreign_keys = ON;')
-        self.user_collection = users.UserCollection()
-
     def test_init(self):
         '''
         Test __init__ method.
@@ -85,12 +77,84 @@ class TestUser(unittest.TestCase):
         self.assertEqual(user.user_last_name, 'Account')
         self.user_collection.search_user('fail')
 
-    def tearDown(self):
+    def test_find_users(self):
+        '''
+        Test find_users prefix, email and paging
+        '''
+        self.user_collection.add_user('test01', 'Test.One@gmail.com', 'Test', 'Account')
+        self.user_collection.add_user('test02', 'test2@gmail.com', 'Tess', 'Accountant')
+        self.user_collection.add_user('test03', 'test3@gmail.com', 'Other', 'Person')
+        found = self.user_collection.find_users(last_name_prefix='acc')
+        self.assertEqual([user.user_id for user in found], ['test01', 'test02'])
+        found = self.user_collection.find_users(last_name_prefix='ACCOUNTA')
+        self.assertEqual([user.user_id for user in found], ['test02'])
+        found = self.user_collection.find_users(email='test.one@GMAIL.com')
+        self.assertEqual([user.user_id for user in found], ['test01'])
+        found = self.user_collection.find_users(name_prefix='tes', last_name_prefix='account')
+        self.assertEqual(len(found), 2)
+        # Ordered by first name, so Tess comes before Test
+        found = self.user_collection.find_users(name_prefix='te', page=2, page_size=1)
+        self.assertEqual([user.user_id for user in found], ['test01'])
+        self.assertEqual(self.user_collection.find_users(name_prefix='%'), [])
+
+    def test_find_users_query_plan(self):
+        '''
+        Test find_users lookups are answered from the NOCASE indexes
+        '''
+        cases = [({'last_name_prefix': 'acc'}, 'users_user_last_name_nocase'),
+                 ({'name_prefix': 'tes'}, 'users_user_name_nocase'),
+                 ({'email': 'test@gmail.com'}, 'users_user_email_nocase')]
+        for filters, index in cases:
+            sql, params = self.user_collection.find_users_query(**filters).sql()
+            plan = test_db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+            details = ' '.join(row[-1] for row in plan)
+            self.assertIn(f'USING INDEX {index}', details)
+            self.assertNotIn('SCAN', details)
+
+    def test_soft_delete(self):
+        '''
+        Test tombstoning hides a user and purge_deleted removes them
+        '''
+        collection = users.UserCollection(soft_delete=True)
+        collection.add_user('test01', 'test@gmail.com', 'Test', 'Account')
+        collection.add_user('test02', 'test2@gmail.com', 'Test', 'Account')
+        for i in range(5):
+            sm.Status.create(status_id=f'test01_{i}', user_id='test01', status_text='hi')
+        self.assertTrue(collection.delete_user('test01'))
+        self.assertFalse(collection.delete_user('test01'))
+        self.assertIsNone(collection.search_user('test01'))
+        self.assertFalse(collection.modify_user('test01', 'a@b.com', 'A', 'B'))
+        self.assertEqual(len(collection.find_users(last_name_prefix='acc')), 1)
+        # Statuses stay until the purge runs
+        self.assertEqual(sm.Status.select().count(test_db), 5)
+        self.assertEqual(collection.purge_deleted(batch_size=2), (1, 5))
+        self.assertEqual(sm.Status.select().count(test_db), 0)
+        self.assertIsNone(sm.Users.get_or_none(sm.Users.user_id == 'test01'))
+        self.assertEqual(collection.purge_deleted(), (0, 0))
+
+    def test_purger_thread(self):
         '''
-        Remove all tables at end of each test and close db.
+        Test the background purger against a database file
         '''
-        test_db.drop_tables(MODELS)
-        test_db.close()
+        with tempfile.TemporaryDirectory() as tmp:
+            file_db = pw.SqliteDatabase(os.path.join(tmp, 'purge.db'),
+                                        pragmas={'foreign_keys': 1})
+            with file_db.bind_ctx(sm.MODELS):
+                file_db.create_tables(sm.MODELS)
+                collection = users.UserCollection(soft_delete=True)
+                collection.add_user('test01', 'test@gmail.com', 'Test', 'Account')
+                sm.Status.create(status_id='test01_1', user_id='test01', status_text='hi')
+                collection.delete_user('test01')
+                purger = collection.start_purger(interval=0.01)
+                for _ in range(500):
+                    if not sm.Users.select().exists(file_db):
+                        break
+                    purger.stopped.wait(0.01)
+                purger.stop()
+                self.assertFalse(purger.is_alive())
+                self.assertFalse(sm.Users.select().exists(file_db))
+                self.assertFalse(sm.Status.select().exists(file_db))
+            file_db.close()
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,14 +3,11 @@ Unittests for user_status.py.
 Author: Marcus Bakke
 '''
 import unittest
-import peewee as pw
-import user_status
+import fixtures
 import socialnetwork_model as sm
 
-MODELS = [sm.Users, sm.Status]
-test_db = pw.SqliteDatabase(':memory:')
 
-class TestUserStatus(unittest.TestCase):
+class TestUserStatus(fixtures.ModelTestCase):
     '''
     Test class for user_status.py
     '''
@@ -18,15 +15,11 @@ class TestUserStatus(unittest.TestCase):
         '''
         Bind model classes to test database. Initialize collection.
         '''
-        test_db.bind(MODELS, bind_refs=False, bind_backrefs=False)
-        test_db.connect()
-        test_db.create_tables(MODELS)
-        test_db.execute_sql('PRAGMA foreign_keys = ON;')
+        super().setUp()
         sm.Users.create(user_id='test123',
                         user_email='test@email.com',
                         user_name='test',
                         user_last_name='test-test')
-        self.status_collection = user_status.UserStatusCollection()
         self.status_collection.add_status('test123_00001', 'test123', 'test status')
 
     def test_init(self):
@@ -98,12 +91,17 @@ class TestUserStatus(unittest.TestCase):
         self.assertEqual('test status', status.status_text)
         self.assertEqual('test123', status.user.user_id)
 
-    def tearDown(self):
+    def test_tombstoned_user(self):
         '''
-        Remove all tables at end of each test and close db.
+        Test statuses of a tombstoned user are hidden and cannot be added
         '''
-        test_db.drop_tables(MODELS)
-        test_db.close()
+        sm.Users.update(deleted=True).where(sm.Users.user_id == 'test123').execute()
+        self.assertIsNone(self.status_collection.search_status('test123_00001'))
+        self.assertFalse(self.status_collection.modify_status('test123_00001',
+                                                              'test123', 'new'))
+        self.assertFalse(self.status_collection.delete_status('test123_00001'))
+        self.assertFalse(self.status_collection.add_status('test123_00002',
+                                                           'test123', 'new'))
 
 if __name__ == '__main__':
     unittest.main()
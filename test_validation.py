@@ -0,0 +1,66 @@
+'''
+Unittests for validation.py.
+'''
+import unittest
+import validation
+
+
+class TestValidation(unittest.TestCase):
+    '''
+    Test class for validation.py
+    '''
+    def test_rules(self):
+        '''
+        Test each rule accepts and rejects the same values as before
+        '''
+        self.assertTrue(validation.valid_user_id('dave03'))
+        for user_id in ['dave 03', '12345', ' 12 ', '-4']:
+            self.assertFalse(validation.valid_user_id(user_id))
+        self.assertTrue(validation.valid_email('dave@uw.edu'))
+        self.assertFalse(validation.valid_email('dave@uw'))
+        self.assertTrue(validation.valid_name("O'Brien-Smith"))
+        self.assertFalse(validation.valid_name('Marcus-3000'))
+        self.assertTrue(validation.valid_status_id('dave03_00001'))
+        for status_id in ['dave03', 'a_b_00001', '1234_00001', 'dave03_x']:
+            self.assertFalse(validation.valid_status_id(status_id))
+        self.assertEqual(validation.parse_timestamp('1500000000.5'), 1500000000.5)
+        self.assertEqual(validation.parse_timestamp('1970-01-02'), 86400)
+        self.assertEqual(validation.parse_timestamp('1970-01-01T02:00:00+01:00'), 3600)
+        self.assertEqual(validation.parse_timestamp('1970-01-01T01:00:00Z'), 3600)
+        self.assertEqual(validation.parse_timestamp('1970-01-01T01:00:00.500z'), 3600.5)
+        for timestamp in ['yesterday', 'nan', 'inf', 'Z']:
+            self.assertFalse(validation.valid_timestamp(timestamp))
+
+    def test_validate_column(self):
+        '''
+        Test a column gives a mask and error positions, checking each
+        distinct value once
+        '''
+        calls = []
+
+        def rule(value):
+            calls.append(value)
+            return value.isalpha()
+
+        result = validation.validate_column(rule, ['a', 'b1', 'a', None, 'a', 7])
+        self.assertEqual(result.mask, [True, False, True, False, True, False])
+        self.assertEqual(result.errors, [1, 3, 5])
+        self.assertEqual(calls, ['a', 'b1'])
+
+    def test_validate_rows(self):
+        '''
+        Test a chunk of rows reports every failing (position, column)
+        '''
+        rules = {'user_id': validation.valid_user_id,
+                 'status_id': validation.valid_status_id}
+        rows = [{'user_id': 'dave03', 'status_id': 'dave03_00001'},
+                {'user_id': '123', 'status_id': 'dave03_x'},
+                {'user_id': 'dave03', 'status_id': 'dave03_00002'}]
+        result = validation.validate_rows(rows, rules)
+        self.assertEqual(result.mask, [True, False, True])
+        self.assertEqual(result.errors, [(1, 'user_id'), (1, 'status_id')])
+        self.assertGreater(validation.valid_user_id.cache_info().hits, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
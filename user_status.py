@@ -12,72 +12,342 @@ This also appears to occur with Django as well.
 Source: https://stackoverflow.com/questions/115977/using-pylint-with-django
 '''
 # pylint: disable=E1101
+import time
 import logging
+import collections
 import peewee as pw
 import socialnetwork_model as sm
+import sharding
+from collection import RoutedCollection
+from jobs import PeriodicJob
+from groupcommit import queued
+from scheduler import prioritized
 
 
-class UserStatusCollection():
+class UserStatusCollection(RoutedCollection):
     '''
     Collection of UserStatus messages
+
+    With a sharding.ShardSet as shards, each status is stored in the shard
+    of the user who posted it. db points the collection at another
+    database, such as a read-only snapshots.snapshot().
     '''
 
-    def __init__(self):
+    def __init__(self, shards=None, db=None):
         logging.info('UserStatusCollection initialized.')
-        self.database = sm.Status
+        super().__init__(sm.Status, shards, db)
+
+    def db_for_status(self, status_id):
+        '''
+        Returns the shard holding status_id
+        '''
+        return self.db_for(sharding.status_owner(status_id))
+
+    def visible(self):
+        '''
+        Select of statuses whose owner has not been tombstoned
+
+        The owner is selected with each status, so a compact key status
+        reads its user_id from the database it came from.
+        '''
+        users = self.database.user.rel_model
+        return self.database.select(self.database, users).join(users).where(~users.deleted)
 
+    @queued
+    @prioritized
     def add_status(self, status_id, user_id, status_text):
         '''
         add a new status message to the collection
+
+        With status_id None the next id is taken from the user's
+        StatusSequence and returned instead of True.
         '''
+        users = self.database.user.rel_model
+        database = self.db_for(user_id)
+        if self.shards is not None and status_id is not None and \
+                sharding.status_owner(status_id) != user_id:
+            logging.error('Unable to add %s, it does not belong to %s.', status_id, user_id)
+            return False
+        if users.select().where((users.user_id == user_id) & users.deleted).exists(database):
+            logging.error('Unable to add %s, %s is deleted.', status_id, user_id)
+            return False
+        allocated = status_id is None
         try:
-            status = self.database.create(status_id = status_id,
-                                          user_id = user_id,
-                                          status_text = status_text)
-            status.save()
+            with self.write_db(database).atomic():
+                if allocated:
+                    status_id = sm.format_status_id(
+                        user_id, sm.StatusSequence.reserve(user_id, 1, database))
+                else:
+                    sm.StatusSequence.observe([status_id], database)
+                self.database.insert(status_id=status_id,
+                                     user=self.database.user_ref(user_id),
+                                     status_text=status_text).execute(database)
+                sm.UserStats.bump({user_id: 1}, database)
             logging.info('Added status %s by %s.', status_id, user_id)
-            return True
+            return status_id if allocated else True
         except pw.IntegrityError:
             logging.error('Unable to add %s.', status_id)
             return False
 
+    def reserve_status_ids(self, user_id, count):
+        '''
+        Reserves count new status_ids for user_id and returns them
+
+        The ids are never handed out again, so callers can post with them
+        later (possibly from several processes) without collisions.
+        '''
+        database = self.db_for(user_id)
+        first = sm.StatusSequence.reserve(user_id, count, database)
+        return [sm.format_status_id(user_id, number) for number in range(first, first + count)]
+
+    @queued
+    @prioritized
     def modify_status(self, status_id, user_id, status_text):
         '''
         Modifies a status message
         '''
-        try:
-            status = self.database.get(sm.Status.status_id == status_id)
-            status.status_text = status_text
-            status.save()
-            logging.info('Modified status %s by %s.', status_id, user_id)
-            return True
-        except self.database.DoesNotExist:
+        database = self.db_for_status(status_id)
+        visible = self.visible().where(self.database.status_id == status_id)
+        if not visible.exists(database):
             logging.error('Unable to modify %s.', status_id)
             return False
+        (self.database
+         .update(status_text=status_text)
+         .where(self.database.status_id == status_id)
+         .execute(database))
+        logging.info('Modified status %s by %s.', status_id, user_id)
+        return True
 
+    @queued
+    @prioritized
     def delete_status(self, status_id):
         '''
         deletes the status message with id, status_id
         '''
-        try:
-            status = self.database.get(sm.Status.status_id == status_id)
-            status.delete_instance()
-            logging.info('Deleted status %s.', status_id)
-            return True
-        except self.database.DoesNotExist:
+        database = self.db_for_status(status_id)
+        users = self.database.user.rel_model
+        owner = (self.visible()
+                 .select(users.user_id)
+                 .where(self.database.status_id == status_id)
+                 .scalar(database))
+        if owner is None:
             logging.error('Unable to delete %s.', status_id)
             return False
+        with self.write_db(database).atomic():
+            (self.database
+             .delete()
+             .where(self.database.status_id == status_id)
+             .execute(database))
+            sm.UserStats.bump({owner: -1}, database)
+        logging.info('Deleted status %s.', status_id)
+        return True
+
+    def bulk_inserted(self, rows, database):
+        '''
+        Adds the loaded statuses to UserStats and moves the users'
+        StatusSequences past the loaded ids, one upsert each per chunk
+        '''
+        sm.UserStats.bump(collections.Counter(row['user_id'] for row in rows), database)
+        sm.StatusSequence.observe([row['status_id'] for row in rows], database)
 
+    def bulk_removed(self, rows, database):
+        '''
+        Takes statuses backed out of a load off UserStats
+        '''
+        counts = collections.Counter()
+        for row in rows:
+            counts[row['user_id']] -= 1
+        sm.UserStats.bump(counts, database)
+
+    def status_count(self, user_id):
+        '''
+        Returns how many statuses user_id has posted (0 if unknown)
+        '''
+        count = (sm.UserStats
+                 .select(sm.UserStats.status_count)
+                 .where(sm.UserStats.user_id == user_id)
+                 .scalar(self.db_for(user_id)))
+        return count or 0
+
+    def top_posters(self, count=100):
+        '''
+        Returns up to count (user_id, status_count) pairs, most statuses
+        first, read from the status_count index
+
+        Tombstoned users are skipped. Sharded collections take the top
+        count of each shard and merge them.
+        '''
+        users = self.database.user.rel_model
+        query = (sm.UserStats
+                 .select(sm.UserStats.user_id, sm.UserStats.status_count)
+                 .join(users, on=users.user_id == sm.UserStats.user_id)
+                 .where(~users.deleted & (sm.UserStats.status_count > 0))
+                 .order_by(sm.UserStats.status_count.desc(), sm.UserStats.user_id)
+                 .limit(count)
+                 .tuples())
+        top = []
+        for database in self.databases():
+            top.extend(query.execute(database))
+        top.sort(key=lambda pair: (-pair[1], pair[0]))
+        return top[:count]
+
+    def recent_statuses(self, user_id, count=10):
+        '''
+        Returns up to count of user_id's statuses, newest first
+
+        Read backwards along the (user, created_at) index, so the cost
+        does not grow with the user's total. Statuses without a
+        created_at come last.
+        '''
+        users = self.database.user.rel_model
+        query = (self.visible()
+                 .where(users.user_id == user_id)
+                 .order_by(self.database.created_at.desc())
+                 .limit(count))
+        return list(query.execute(self.db_for(user_id)))
+
+    def statuses_between(self, start=None, end=None, count=None):
+        '''
+        Returns statuses created at or after start and before end (epoch
+        seconds; None leaves that side open), oldest first, at most count
+
+        Answered from the created_at index. Sharded collections take up to
+        count from each shard and merge them.
+        '''
+        created_at = self.database.created_at
+        query = self.visible().where(created_at.is_null(False))
+        if start is not None:
+            query = query.where(created_at >= start)
+        if end is not None:
+            query = query.where(created_at < end)
+        query = query.order_by(created_at, self.database.status_id).limit(count)
+        found = []
+        for database in self.databases():
+            found.extend(query.execute(database))
+        found.sort(key=lambda status: (status.created_at, status.status_id))
+        return found[:count]
+
+    def prune_statuses(self, cutoff, batch_size=500, pause=0.0):
+        '''
+        Deletes statuses created before cutoff (epoch seconds)
+
+        Walks the created_at index batch_size statuses at a time and
+        deletes each batch together with its UserStats adjustment. Statuses
+        without a created_at are kept. Databases that lost statuses get
+        sm.maintain afterwards. Returns the number of statuses deleted.
+        '''
+        status = self.database
+        users = status.user.rel_model
+        key = status._meta.primary_key  # pylint: disable=W0212
+        pruned = 0
+        for database in self.databases():
+            pruned_before = pruned
+            while True:
+                # The owner comes from the join: outside sharded mode the
+                # status_id prefix need not name the user
+                batch = (status.select(key, users.user_id)
+                         .join(users)
+                         .where(status.created_at < cutoff)
+                         .order_by(status.created_at)
+                         .limit(batch_size)
+                         .tuples()
+                         .execute(database))
+                counts = collections.Counter()
+                keys = []
+                for row_key, user_id in batch:
+                    keys.append(row_key)
+                    counts[user_id] -= 1
+                if not keys:
+                    break
+                with database.atomic():
+                    status.delete().where(key.in_(keys)).execute(database)
+                    sm.UserStats.bump(counts, database)
+                pruned += len(keys)
+                if len(keys) < batch_size:
+                    break
+                time.sleep(pause)
+            if pruned > pruned_before:
+                logging.info('Pruned %s statuses.', pruned - pruned_before)
+                sm.note_changes(database, pruned - pruned_before)
+                sm.maintain(database)
+        return pruned
+
+    def start_retention(self, max_age, interval=60.0, batch_size=500, pause=0.01):
+        '''
+        Starts a background Retention thread deleting statuses older than
+        max_age seconds
+        '''
+        retention = Retention(self, max_age, interval, batch_size, pause)
+        retention.start()
+        return retention
+
+    def train_dictionary(self, samples=2000, size=4096):
+        '''
+        Trains a status_text compression dictionary on up to samples
+        statuses and stores it in every database of the collection
+
+        Returns the dictionary id. Only used once compression is on (see
+        sm.CompressedTextField).
+        '''
+        texts = []
+        for database in self.databases():
+            query = (self.database
+                     .select(self.database.status_text)
+                     .order_by(pw.fn.RANDOM())
+                     .limit(samples)
+                     .tuples())
+            texts.extend(text for text, in query.execute(database))
+        data = sm.train_dictionary(texts, size)
+        for database in self.databases():
+            dict_id = sm.store_dictionary(data, self.write_db(database))
+        return dict_id
+
+    @prioritized
     def search_status(self, status_id):
         '''
         Find and return a status message by its status_id
 
-        Returns an empty UserStatus object if status_id does not exist
+        Returns None if status_id does not exist or its user is deleted
         '''
         try:
-            status = self.database.get(sm.Status.status_id == status_id)
+            status = (self.visible()
+                      .where(self.database.status_id == status_id)
+                      .get(self.db_for_status(status_id)))
             logging.info('Found status %s.', status_id)
             return status
         except self.database.DoesNotExist:
             logging.error('Unable to find %s.', status_id)
             return None
+
+    @prioritized
+    def search_statuses_many(self, status_ids):
+        '''
+        Searches for many statuses at once
+
+        Returns (found, missing): a dict of status_id -> status and the set
+        of status_ids that do not exist or whose user is deleted. Takes one
+        query per sm.IN_BATCH status_ids (per shard); owners are selected
+        in the same query, so reading user_id costs nothing more.
+        '''
+        status_ids = set(status_ids)
+        found = {status.status_id: status
+                 for status in self.select_many(self.visible(), self.database.status_id,
+                                                status_ids, sharding.status_owner)}
+        missing = status_ids - found.keys()
+        logging.info('Found %s of %s statuses.', len(found), len(status_ids))
+        return found, missing
+
+
+class Retention(PeriodicJob):
+    '''
+    Background thread that runs UserStatusCollection.prune_statuses every
+    interval seconds, deleting statuses older than max_age seconds, until
+    stop() is called
+    '''
+
+    def __init__(self, collection, max_age, interval=60.0, batch_size=500, pause=0.01):
+        super().__init__('status-retention', collection, interval, batch_size, pause)
+        self.max_age = max_age
+
+    def run_once(self):
+        self.collection.prune_statuses(time.time() - self.max_age, self.batch_size, self.pause)
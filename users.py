@@ -3,73 +3,254 @@ Classes for user information for the social network project
 All edits made by Kathleen Wong to incorporate logging issues.
 '''
 # pylint: disable=E1101
+import time
 import logging
 import peewee as pw
 import socialnetwork_model as sm
+from collection import RoutedCollection
+from jobs import PeriodicJob
+from groupcommit import queued
+from scheduler import prioritized
 
 
-class UserCollection:
+class UserCollection(RoutedCollection):
     '''
     Contains a collection of Users objects
+
+    With soft_delete=True, delete_user only tombstones the user; the user
+    and their statuses are removed later by purge_deleted. With a
+    sharding.ShardSet as shards, each user is stored in the shard its
+    user_id hashes to. db points the collection at another database, such
+    as a read-only snapshots.snapshot().
     '''
 
-    def __init__(self):
+    def __init__(self, soft_delete=False, shards=None, db=None):
         logging.info('UserCollection initialized.')
-        self.database = sm.Users
+        super().__init__(sm.Users, shards, db)
+        self.soft_delete = soft_delete
 
+    @queued
+    @prioritized
     def add_user(self, user_id, user_email, user_name, user_last_name):
         '''
         Adds a new user to the collection
         '''
         try:
-            user = self.database.create(user_id=user_id,
-                                        user_email=user_email,
-                                        user_name=user_name,
-                                        user_last_name=user_last_name)
-            user.save()
+            self.database.insert(user_id=user_id,
+                                 user_email=user_email,
+                                 user_name=user_name,
+                                 user_last_name=user_last_name).execute(self.db_for(user_id))
             logging.info('Added user %s', user_id)
             return True
         except pw.IntegrityError:
             logging.error('Unable to add %s.', user_id)
             return False
 
+    @queued
+    @prioritized
     def modify_user(self, user_id, user_email, user_name, user_last_name):
         '''
         Modifies an existing user
         '''
-        try:
-            user = self.database.get(self.database.user_id == user_id)
-            user.user_email = user_email
-            user.user_name = user_name
-            user.user_last_name = user_last_name
-            user.save()
-            logging.info('Modified user %s.', user_id)
-            return True
-        except self.database.DoesNotExist:
+        updated = (self.database
+                   .update(user_email=user_email,
+                           user_name=user_name,
+                           user_last_name=user_last_name)
+                   .where((self.database.user_id == user_id) & ~self.database.deleted)
+                   .execute(self.db_for(user_id)))
+        if not updated:
             logging.error('Unable to user %s.', user_id)
             return False
+        logging.info('Modified user %s.', user_id)
+        return True
 
+    @queued
+    @prioritized
     def delete_user(self, user_id):
         '''
         Deletes an existing user
+
+        Their statuses are removed by the ON DELETE CASCADE foreign key.
         '''
-        try:
-            user = self.database.get(sm.Users.user_id == user_id)
-            user.delete_instance()
-            logging.info('Deleted user %s.', user_id)
-            return True
-        except self.database.DoesNotExist:
+        if self.soft_delete:
+            return self.tombstone_user(user_id)
+        database = self.db_for(user_id)
+        with self.write_db(database).atomic():
+            deleted = (self.database
+                       .delete()
+                       .where(self.database.user_id == user_id)
+                       .execute(database))
+            (sm.UserStats.delete()  # pylint: disable=E1120
+             .where(sm.UserStats.user_id == user_id)
+             .execute(database))
+        if not deleted:
             logging.error('Unable to delete %s.', user_id)
             return False
+        logging.info('Deleted user %s.', user_id)
+        return True
 
+    @queued
+    def tombstone_user(self, user_id):
+        '''
+        Marks a user as deleted without touching their statuses
+        '''
+        updated = (self.database
+                   .update(deleted=True)
+                   .where((self.database.user_id == user_id) & ~self.database.deleted)
+                   .execute(self.db_for(user_id)))
+        if not updated:
+            logging.error('Unable to delete %s.', user_id)
+            return False
+        logging.info('Tombstoned user %s.', user_id)
+        return True
+
+    @prioritized
     def search_user(self, user_id):
         '''
         Searches for user data
         '''
         try:
-            user = self.database.get(sm.Users.user_id == user_id)
+            user = (self.database
+                    .select()
+                    .where((self.database.user_id == user_id) & ~self.database.deleted)
+                    .get(self.db_for(user_id)))
             logging.info('Found user %s.', user_id)
             return user
         except self.database.DoesNotExist:
             logging.error('Unable to find %s.', user_id)
             return None
+
+    @prioritized
+    def search_users_many(self, user_ids):
+        '''
+        Searches for many users at once
+
+        Returns (found, missing): a dict of user_id -> user and the set of
+        user_ids that do not exist or are tombstoned. Takes one query per
+        sm.IN_BATCH user_ids (per shard) however many are asked for.
+        '''
+        user_ids = set(user_ids)
+        query = self.database.select().where(~self.database.deleted)
+        found = {user.user_id: user
+                 for user in self.select_many(query, self.database.user_id, user_ids)}
+        missing = user_ids - found.keys()
+        logging.info('Found %s of %s users.', len(found), len(user_ids))
+        return found, missing
+
+    def find_users_query(self, last_name_prefix=None, email=None, name_prefix=None):
+        '''
+        Builds the query used by find_users
+
+        Name filters are case-insensitive prefixes and email is a
+        case-insensitive exact match, all served by NOCASE indexes.
+        '''
+        query = self.database.select().where(~self.database.deleted)
+        order = []
+        if email is not None:
+            query = query.where(self.database.user_email.collate('NOCASE') == email)
+            order.append(self.database.user_email.collate('NOCASE'))
+        if last_name_prefix is not None:
+            query = query.where(self.database.user_last_name.startswith(last_name_prefix))
+            order.append(self.database.user_last_name.collate('NOCASE'))
+        if name_prefix is not None:
+            query = query.where(self.database.user_name.startswith(name_prefix))
+            order.append(self.database.user_name.collate('NOCASE'))
+        return query.order_by(*order[:1], self.database.user_id)
+
+    def find_users(self, last_name_prefix=None, email=None, name_prefix=None,
+                   page=1, page_size=20):
+        '''
+        Finds users by last name prefix, first name prefix and/or email
+
+        Returns one page (numbered from 1) of matching users as a list.
+        When sharded, each shard returns its first page * page_size matches
+        and the results are merged.
+        '''
+        query = self.find_users_query(last_name_prefix, email, name_prefix)
+        if self.shards is None:
+            found = list(query.paginate(page, page_size).execute(self.db))
+        else:
+            order = ('user_email' if email is not None else
+                     'user_last_name' if last_name_prefix is not None else
+                     'user_name' if name_prefix is not None else 'user_id')
+            found = []
+            for database in self.shards.databases:
+                found.extend(query.limit(page * page_size).execute(database))
+            found.sort(key=lambda user: (getattr(user, order).lower(), user.user_id))
+            found = found[(page - 1) * page_size:page * page_size]
+        logging.info('Found %s users on page %s.', len(found), page)
+        return found
+
+    def bulk_removed(self, rows, database):
+        '''
+        Drops the UserStats of users backed out of a load
+        '''
+        user_ids = [row['user_id'] for row in rows]
+        for i in range(0, len(user_ids), sm.IN_BATCH):
+            (sm.UserStats.delete()  # pylint: disable=E1120
+             .where(sm.UserStats.user_id.in_(user_ids[i:i + sm.IN_BATCH]))
+             .execute(database))
+
+    def purge_deleted(self, batch_size=500, pause=0.0, max_users=None):
+        '''
+        Removes tombstoned users and their statuses
+
+        Statuses are deleted batch_size at a time, pausing between batches
+        (see jobs.PeriodicJob). Databases that had tombstones get
+        sm.maintain afterwards. Returns (users purged, statuses purged).
+        '''
+        status = sm.status_model(self.database)
+        users_purged = statuses_purged = 0
+        for database in self.databases():
+            purged_before = users_purged + statuses_purged
+            tombstoned = list(self.database.select()
+                              .where(self.database.deleted)
+                              .limit(max_users)
+                              .execute(database))
+            for user in tombstoned:
+                while True:
+                    batch = (status.select(status.status_id)
+                             .where(status.user == user)
+                             .limit(batch_size))
+                    with database.atomic():
+                        deleted = (status.delete()
+                                   .where(status.status_id.in_(batch))
+                                   .execute(database))
+                    statuses_purged += deleted
+                    if deleted < batch_size:
+                        break
+                    time.sleep(pause)
+                with database.atomic():
+                    (self.database.delete()
+                     .where(self.database.user_id == user.user_id)
+                     .execute(database))
+                    (sm.UserStats.delete()  # pylint: disable=E1120
+                     .where(sm.UserStats.user_id == user.user_id)
+                     .execute(database))
+                users_purged += 1
+                logging.info('Purged user %s.', user.user_id)
+            if tombstoned:
+                sm.note_changes(database, users_purged + statuses_purged - purged_before)
+                sm.maintain(database)
+        return users_purged, statuses_purged
+
+    def start_purger(self, interval=5.0, batch_size=500, pause=0.01):
+        '''
+        Starts a background Purger thread for this collection
+        '''
+        purger = Purger(self, interval, batch_size, pause)
+        purger.start()
+        return purger
+
+
+class Purger(PeriodicJob):
+    '''
+    Background thread that runs UserCollection.purge_deleted every
+    interval seconds until stop() is called
+    '''
+
+    def __init__(self, collection, interval=5.0, batch_size=500, pause=0.01):
+        super().__init__('tombstone-purger', collection, interval, batch_size, pause)
+
+    def run_once(self):
+        self.collection.purge_deleted(self.batch_size, self.pause)
@@ -0,0 +1,150 @@
+'''
+Batch validation of user and status fields
+
+The rules are compiled once at import: the email regex is precompiled,
+name punctuation is removed with a prebuilt translation table and user
+ids (which repeat across thousands of statuses and status ids) are
+memoized. validate_column and validate_rows check whole columns or
+chunks at a time, evaluating each distinct value once per batch, and
+return a validity mask plus the positions that failed.
+
+Values that are not strings are invalid for every rule.
+'''
+import re
+import math
+import functools
+import collections
+from datetime import datetime, timezone
+
+# Source: https://stackoverflow.com/a/8022584
+EMAIL = re.compile(r"^[^\s@]+@([^\s@.,]+\.)+[^\s@.,]{2,}$")
+NAME_PUNCTUATION = str.maketrans('', '', "-'")
+USER_ID_CACHE = 1 << 16
+
+Validation = collections.namedtuple('Validation', ['mask', 'errors'])
+Validation.__doc__ = '''
+mask holds one bool per value (or row); errors lists the failing
+positions (for rows, (position, column) pairs)
+'''
+
+
+@functools.lru_cache(maxsize=USER_ID_CACHE)
+def valid_user_id(user_id):
+    '''
+    A user_id has no spaces and is not a number
+    '''
+    if ' ' in user_id:
+        return False
+    try:
+        int(user_id)
+        return False
+    except ValueError:
+        return True
+
+
+def valid_email(email):
+    '''
+    An email has one @ and a dotted domain
+    '''
+    return EMAIL.match(email) is not None
+
+
+def valid_name(name):
+    '''
+    A name is letters, optionally with hyphens and apostrophes
+    '''
+    return name.translate(NAME_PUNCTUATION).isalpha()
+
+
+def valid_status_id(status_id):
+    '''
+    A status_id is a valid user_id, an underscore and a number
+    '''
+    parts = status_id.split('_')
+    if len(parts) != 2 or not valid_user_id(parts[0]):
+        return False
+    try:
+        int(parts[1])
+        return True
+    except ValueError:
+        return False
+
+
+def valid_status_text(status_text):
+    '''
+    Any text is a valid status
+    '''
+    return isinstance(status_text, str)
+
+
+def parse_timestamp(value):
+    '''
+    Returns a timestamp as epoch seconds, or None if it is not one
+
+    Accepts a number of seconds or an ISO 8601 date/time (UTC unless it
+    carries an offset). A trailing Z means UTC; fromisoformat only takes
+    it from Python 3.11.
+    '''
+    try:
+        seconds = float(value)
+    except ValueError:
+        if value.endswith(('Z', 'z')):
+            value = value[:-1] + '+00:00'
+        try:
+            moment = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        seconds = moment.timestamp()
+    return seconds if math.isfinite(seconds) else None
+
+
+def valid_timestamp(value):
+    '''
+    A timestamp is epoch seconds or an ISO 8601 date/time
+    '''
+    return parse_timestamp(value) is not None
+
+
+def validate_column(rule, values):
+    '''
+    Checks every value with rule, calling it once per distinct value
+
+    Returns a Validation whose errors are the positions of invalid values.
+    '''
+    results = {}
+    mask = []
+    for value in values:
+        if not isinstance(value, str):
+            mask.append(False)
+            continue
+        valid = results.get(value)
+        if valid is None:
+            valid = results[value] = bool(rule(value))
+        mask.append(valid)
+    return Validation(mask, [i for i, valid in enumerate(mask) if not valid])
+
+
+def validate_columns(rows, rules):
+    '''
+    Validates a chunk of rows (dicts) column by column
+
+    rules maps a column to its rule. Returns a dict of column -> mask.
+    '''
+    return {column: validate_column(rule, [row.get(column) for row in rows]).mask
+            for column, rule in rules.items()}
+
+
+def validate_rows(rows, rules):
+    '''
+    Validates a chunk of rows (dicts) against rules (column -> rule)
+
+    Returns a Validation with one bool per row; errors are (position,
+    column) pairs in row order, then rule order.
+    '''
+    masks = validate_columns(rows, rules)
+    errors = [(i, column) for i in range(len(rows))
+              for column in rules if not masks[column][i]]
+    failed = {i for i, _ in errors}
+    return Validation([i not in failed for i in range(len(rows))], errors)